@@ -0,0 +1,132 @@
+"""Кэш контента для пользовательских экранов: страницы игр, сценарии, сюжеты, «Что за формат».
+
+Запись кэша помнит версии контента (database.content_versions), под которыми её прочитали.
+Правка из любого процесса поднимает версию своего вида триггером — следующее чтение
+записей этого вида идёт в БД, остальные отдаются из памяти.
+Записи, зависящие от дня (расписание), помнят и день: со сменой дня запись заменяется,
+а не копится под новым ключом. Оба кэша ограничены CACHE_MAX_ENTRIES — давно не
+нужные записи (например, страницы по курсорам из старых кнопок) вытесняются.
+Админка читает напрямую из db_async, чтобы всегда видеть свежие данные.
+"""
+from collections import OrderedDict
+
+import database
+import db_async
+from config import SCHEDULE_PAGE_SIZE
+
+# Записей в каждом из кэшей; самые давние вытесняются
+CACHE_MAX_ENTRIES = 10_000
+
+_entries: OrderedDict = OrderedDict()  # key -> (версии и день, значение)
+_hits = 0
+_misses = 0
+# Готовые экраны (текст + клавиатура), собранные из кэшированных данных
+_renders: OrderedDict = OrderedDict()
+_render_hits = 0
+_render_misses = 0
+
+
+def _stamp(kinds: tuple, day):
+    # Версии снимаются до чтения: правка во время чтения оставит запись устаревшей, а не наоборот
+    current = database.content_versions()
+    return tuple(current.get(k, 0) for k in kinds), day
+
+
+def _get(store: OrderedDict, key: tuple, stamp):
+    entry = store.get(key)
+    if entry is None or entry[0] != stamp:
+        return None
+    store.move_to_end(key)
+    return entry
+
+
+def _put(store: OrderedDict, key: tuple, stamp, value):
+    store[key] = (stamp, value)
+    store.move_to_end(key)
+    if len(store) > CACHE_MAX_ENTRIES:
+        store.popitem(last=False)
+
+
+async def _cached(kinds: tuple, key: tuple, loader, *args, day=None):
+    global _hits, _misses
+    stamp = _stamp(kinds, day)
+    entry = _get(_entries, key, stamp)
+    if entry is not None:
+        _hits += 1
+        return entry[1]
+    _misses += 1
+    value = await db_async.run_read(loader, *args)
+    _put(_entries, key, stamp, value)
+    return value
+
+
+def scenario_kind(scenario_id: int) -> str:
+    """Вид версии сюжетов одного сценария (триггеры миграции 10)."""
+    return f"scenario:{scenario_id}"
+
+
+async def rendered(kinds: tuple, key: tuple, render, *args, day=None):
+    """Результат await render(*args), запомненный под текущими версиями kinds (и днём day).
+
+    Для экранов, которые целиком определяются контентом: при неизменных версиях
+    повторное нажатие — поиск в словаре вместо сборки HTML и клавиатуры.
+    """
+    global _render_hits, _render_misses
+    stamp = _stamp(kinds, day)
+    entry = _get(_renders, key, stamp)
+    if entry is not None:
+        _render_hits += 1
+        return entry[1]
+    _render_misses += 1
+    value = await render(*args)
+    _put(_renders, key, stamp, value)
+    return value
+
+
+async def get_visible_games_page(until=None, after=None, before=None, limit=8):
+    day = database.today()
+    return await _cached(
+        ("games",),
+        ("games_page", until, after, before, limit),
+        database.get_visible_games_page, day, until, after, before, limit,
+        day=day,
+    )
+
+
+async def get_game(game_id: int):
+    return await _cached(("games",), ("game", game_id), database.get_game, game_id)
+
+
+async def get_scenarios():
+    return await _cached(("scenarios",), ("scenarios",), database.get_scenarios)
+
+
+async def get_story(story_id: int):
+    return await _cached(("stories",), ("story", story_id), database.get_story, story_id)
+
+
+async def get_format_info():
+    return await _cached(("format",), ("format_info",), database.get_format_info)
+
+
+async def warm():
+    """Прочитать всё, что нужно первым экранам, до начала приёма апдейтов."""
+    await get_visible_games_page(limit=SCHEDULE_PAGE_SIZE)
+    await get_format_info()
+    await get_scenarios()
+
+
+def stats() -> dict:
+    total = _hits + _misses
+    return {
+        "hits": _hits,
+        "misses": _misses,
+        "hit_rate": _hits / total if total else 0.0,
+        "entries": len(_entries),
+        "renders": len(_renders),
+        "render_hits": _render_hits,
+        "render_misses": _render_misses,
+        "versions": database.content_versions(),
+        "version_checks": database.version_checks,
+        "version_reloads": database.version_reloads,
+    }
@@ -0,0 +1,163 @@
+"""Проверка планов запросов database.py.
+
+Вызывает каждую публичную функцию database.py на временной БД, перехватывает
+выполненный SQL и прогоняет его через EXPLAIN QUERY PLAN. Полный проход
+(SCAN без индекса) по таблице, которая растёт, считается регрессией.
+
+Запуск: python check_query_plans.py — код возврата 1, если есть проблемы.
+"""
+import inspect
+import re
+import sys
+import tempfile
+from pathlib import Path
+
+import database
+
+# Таблицы, которые растут вместе с аудиторией или контентом
+GROWABLE_TABLES = {
+    "user_events", "leads", "holiday_orders", "questions", "subscriptions",
+    "user_utm", "scheduled_posts", "funnel_log", "stories", "games", "known_users",
+    "user_activity", "user_events_daily", "event_types_daily", "user_profiles", "media_files",
+}
+
+# Функции, которым полный проход нужен по смыслу (админские списки целиком)
+FULL_SCAN_OK = {
+    "get_visible_stories": "не используется ботом",
+    "get_image_urls": "прогрев картинок при запуске: нужны все сюжеты",
+    "get_media_files": "реестр картинок целиком загружается в память",
+}
+
+# Служебные функции модуля, а не запросы
+SKIP = {"get_conn", "close_conn", "transaction", "create_tables", "today", "content_version", "content_versions"}
+
+CALLS = {
+    "get_visible_games": lambda: database.get_visible_games(),
+    "get_visible_games_page": lambda: (
+        database.get_visible_games_page(until="2030-02-01", after=("2030-01-01 19:00", 1)),
+        database.get_visible_games_page(before=("2030-01-01 19:00", 1)),
+    ),
+    "get_all_games": lambda: database.get_all_games(),
+    "get_game": lambda: database.get_game(1),
+    "add_game": lambda: database.add_game("Игра", "01.01.2030", "19:00", "Место", "1000₽", "", 10),
+    "update_game": lambda: database.update_game(1, name="Игра", game_date="02.01.2030"),
+    "toggle_game_visibility": lambda: database.toggle_game_visibility(1),
+    "delete_game": lambda: database.delete_game(2),
+    "add_lead": lambda: database.add_lead(1, "u", "Имя", "+7900", 1, "Игра", 2),
+    "get_leads": lambda: database.get_leads(),
+    "add_question": lambda: database.add_question(1, "u", "Имя", "Вопрос"),
+    "add_holiday_order": lambda: database.add_holiday_order(1, "u", "Имя", "+7900"),
+    "get_holiday_orders": lambda: database.get_holiday_orders(),
+    "get_setting": lambda: database.get_setting("follow_up_enabled"),
+    "set_setting": lambda: database.set_setting("follow_up_enabled", "1"),
+    "save_user_utm": lambda: database.save_user_utm(1, "vk", "post", "feb"),
+    "get_user_utm": lambda: database.get_user_utm(1),
+    "add_subscription": lambda: database.add_subscription(1, "u", "Имя", ""),
+    "log_user_event": lambda: database.log_user_event(1, "u", "Имя", "", "cmd:/start"),
+    "log_user_events": lambda: database.log_user_events([(1, "u", "Имя", "", "cb:menu"), (2, "", "", "", "msg")]),
+    "rollup_user_events": lambda: database.rollup_user_events(),
+    "archive_user_events": lambda: database.archive_user_events(0),
+    "reclaim_free_pages": lambda: database.reclaim_free_pages(),
+    "maintain_user_events": lambda: database.maintain_user_events(0),
+    "get_event_type_totals": lambda: database.get_event_type_totals(),
+    "iter_users_for_export": lambda: list(database.iter_users_for_export()),
+    "get_users_for_broadcast": lambda: database.get_users_for_broadcast("with_lead"),
+    "count_users_for_broadcast": lambda: database.count_users_for_broadcast("without_lead"),
+    "get_subscriptions": lambda: database.get_subscriptions(),
+    "add_scheduled_post": lambda: database.add_scheduled_post(
+        "Пост", None, None, False, False, False, True, "2030-01-01 00:00:00"
+    ),
+    "get_scheduled_posts": lambda: database.get_scheduled_posts(),
+    "get_due_scheduled_posts": lambda: database.get_due_scheduled_posts("2030-01-01 00:00:00"),
+    "mark_scheduled_post_status": lambda: database.mark_scheduled_post_status(1, "sent"),
+    "cancel_scheduled_post": lambda: database.cancel_scheduled_post(1),
+    "get_funnel_steps": lambda: database.get_funnel_steps(),
+    "get_active_funnel_steps": lambda: database.get_active_funnel_steps(),
+    "add_funnel_step": lambda: database.add_funnel_step(1, "Шаг"),
+    "update_funnel_step": lambda: database.update_funnel_step(1, text="Шаг"),
+    "was_funnel_step_sent": lambda: database.was_funnel_step_sent(1, 1),
+    "mark_funnel_step_sent": lambda: database.mark_funnel_step_sent(1, 1),
+    "get_due_funnel": lambda: (
+        database.get_due_funnel(2_000_000_000),
+        database.get_due_funnel(2_000_000_000, step_ids=(1, 2)),
+    ),
+    "get_next_funnel_due": lambda: database.get_next_funnel_due(),
+    "count_due_funnel": lambda: database.count_due_funnel(2_000_000_000),
+    "postpone_funnel_step": lambda: database.postpone_funnel_step(1, 2_000_000_000),
+    "reschedule_funnel": lambda: database.reschedule_funnel(),
+    "delete_funnel_step": lambda: database.delete_funnel_step(1),
+    "get_visible_stories": lambda: database.get_visible_stories(),
+    "get_all_stories": lambda: database.get_all_stories(),
+    "get_story": lambda: database.get_story(1),
+    "add_story": lambda: database.add_story("Сюжет", "Текст", scenario_id=1),
+    "update_story": lambda: database.update_story(1, title="Сюжет"),
+    "toggle_story_visibility": lambda: database.toggle_story_visibility(1),
+    "swap_story_order": lambda: database.swap_story_order(2, "up"),
+    "delete_story": lambda: database.delete_story(3),
+    "get_stories_by_scenario": lambda: database.get_stories_by_scenario(1),
+    "add_scenario": lambda: database.add_scenario("Сценарий"),
+    "get_scenarios": lambda: database.get_scenarios(),
+    "get_scenario": lambda: database.get_scenario(1),
+    "update_scenario": lambda: database.update_scenario(1, "Сценарий", ""),
+    "delete_scenario": lambda: database.delete_scenario(2),
+    "get_format_screens": lambda: database.get_format_screens(),
+    "update_format_screen": lambda: database.update_format_screen(1, "Экран", "Текст"),
+    "get_format_info": lambda: database.get_format_info(),
+    "update_format_info": lambda: database.update_format_info(text="Текст"),
+    "get_media_files": lambda: database.get_media_files(),
+    "save_media_file": lambda: database.save_media_file("https://example.com/a.jpg", "AgAD"),
+    "delete_media_file": lambda: database.delete_media_file("https://example.com/a.jpg"),
+    "get_image_urls": lambda: database.get_image_urls(),
+}
+
+_NOT_PLANNED = re.compile(r"^\s*(BEGIN|COMMIT|ROLLBACK|PRAGMA|SAVEPOINT|RELEASE)\b", re.I)
+_SCAN = re.compile(r"^SCAN (\w+)")
+
+
+def _public_functions():
+    return {
+        name
+        for name, obj in vars(database).items()
+        if inspect.isfunction(obj)
+        and obj.__module__ == database.__name__
+        and not name.startswith("_")
+        and name not in SKIP
+    }
+
+
+def check() -> list[str]:
+    problems = []
+    missing = sorted(_public_functions() - CALLS.keys())
+    problems += [f"{name}: нет вызова в CALLS — добавьте его сюда" for name in missing]
+
+    database.DATABASE_PATH = Path(tempfile.mkdtemp()) / "plans.db"
+    database.create_tables()
+    conn = database.get_conn()
+    for name, call in CALLS.items():
+        statements = []
+        conn.set_trace_callback(statements.append)
+        try:
+            call()
+        finally:
+            conn.set_trace_callback(None)
+        for sql in statements:
+            if _NOT_PLANNED.match(sql):
+                continue
+            for row in conn.execute("EXPLAIN QUERY PLAN " + sql):
+                detail = row[-1]
+                m = _SCAN.match(detail)
+                if not m or "INDEX" in detail or m.group(1) not in GROWABLE_TABLES:
+                    continue
+                if name in FULL_SCAN_OK:
+                    continue
+                problems.append(f"{name}: {detail}\n    {' '.join(sql.split())}")
+    database.close_conn()
+    return problems
+
+
+if __name__ == "__main__":
+    found = check()
+    for line in found:
+        print(line)
+    print(f"Проверено функций: {len(CALLS)}, проблем: {len(found)}")
+    sys.exit(1 if found else 0)
@@ -0,0 +1,74 @@
+"""Проверка конвертера разметки и разбиения HTML из utils.py на случайных текстах.
+
+Генерирует (фиксированный seed) тексты со случайной разметкой *, _, __, ~, символами
+<, >, &, переводами строк, эмодзи вне BMP и длинными словами. Для каждого проверяет:
+Telegram примет text_to_telegram_html(text); каждая часть split_telegram_html тоже
+валидна и не длиннее лимита (в UTF-16); видимый текст частей — это исходный видимый
+текст, из которого убраны только пробелы на местах разреза.
+
+Запуск: python check_telegram_html.py — код возврата 1, если есть проблемы.
+"""
+import random
+import sys
+
+from utils import _utf16_len, split_telegram_html, telegram_html_error, telegram_html_to_text, text_to_telegram_html
+
+SEED = 20240601
+CASES = 1000
+# (limit, first_limit): обычное сообщение, подпись к фото, мелкие лимиты — много разрезов
+LIMITS = [(4096, None), (4096, 1024), (200, 50), (7, 3)]
+
+_TOKENS = [
+    "*", "_", "__", "~", "**", "<", ">", "&", "&amp;", "<b>", " ", " ", "  ", "\n", "\n\n",
+    ". ", "! ", "…", "😀", "👨‍👩‍👧", "ё", "игра", "Квиз", "word", "x" * 120,
+]
+
+
+def _random_text(rnd: random.Random) -> str:
+    size = rnd.choice((5, 50, 500, 3000))
+    return "".join(rnd.choice(_TOKENS) for _ in range(rnd.randrange(size)))
+
+
+def _cut_whitespace_only(text: str, pieces: list[str]) -> bool:
+    """pieces идут подряд в text, между ними (и по краям) — только пробельные символы."""
+    pos = 0
+    for piece in pieces:
+        k = text.find(piece, pos)
+        if k == -1 or text[pos:k].strip():
+            return False
+        pos = k + len(piece)
+    return not text[pos:].strip()
+
+
+def check() -> list[str]:
+    problems = []
+    rnd = random.Random(SEED)
+    for case in range(CASES):
+        source = _random_text(rnd)
+        html = text_to_telegram_html(source)
+        error = telegram_html_error(html)
+        if error:
+            problems.append(f"#{case} text_to_telegram_html: {error}\n    {source[:200]!r}")
+            continue
+        visible = telegram_html_to_text(html)
+        for limit, first_limit in LIMITS:
+            parts = split_telegram_html(html, limit, first_limit)
+            where = f"#{case} split_telegram_html(limit={limit}, first_limit={first_limit})"
+            for i, part in enumerate(parts):
+                cap = first_limit if i == 0 and first_limit else limit
+                error = telegram_html_error(part)
+                if error:
+                    problems.append(f"{where} часть {i}: {error}")
+                elif _utf16_len(telegram_html_to_text(part)) > cap:
+                    problems.append(f"{where} часть {i}: длиннее {cap}")
+            if not _cut_whitespace_only(visible, [telegram_html_to_text(p) for p in parts]):
+                problems.append(f"{where}: видимый текст частей не совпадает с исходным\n    {source[:200]!r}")
+    return problems
+
+
+if __name__ == "__main__":
+    found = check()
+    for line in found:
+        print(line)
+    print(f"Проверено текстов: {CASES}, проблем: {len(found)}")
+    sys.exit(1 if found else 0)
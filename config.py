@@ -30,3 +30,41 @@ POST_CHANNEL_2 = _int_or_none(os.getenv("POST_CHANNEL_2"))
 POST_CHAT_ID = _int_or_none(os.getenv("POST_CHAT_ID"))
 # Тема форума в POST_CHAT_ID (число из ссылки t.me/groupname/7 → 7). Пусто = без темы (General).
 POST_CHAT_THREAD_ID = _int_or_none(os.getenv("POST_CHAT_THREAD_ID"))
+
+# Служебный чат/канал, куда при запуске отправляются картинки сюжетов и «Что за формат»,
+# чтобы получить их file_id (пусто = file_id запоминаются при первом показе пользователю)
+MEDIA_STORAGE_CHAT_ID = _int_or_none(os.getenv("MEDIA_STORAGE_CHAT_ID"))
+
+# Буфер логирования действий пользователей (UserLogMiddleware): пишется пачками
+USER_LOG_QUEUE_SIZE = int(os.getenv("USER_LOG_QUEUE_SIZE", "10000"))
+USER_LOG_FLUSH_MS = int(os.getenv("USER_LOG_FLUSH_MS", "500"))
+USER_LOG_FLUSH_ROWS = int(os.getenv("USER_LOG_FLUSH_ROWS", "500"))
+# При переполнении: drop — отбрасывать новые, sample — после половины очереди писать
+# каждое USER_LOG_SAMPLE_EVERY-е событие, block — ждать места (тормозит ответы бота)
+USER_LOG_OVERFLOW = (os.getenv("USER_LOG_OVERFLOW") or "drop").strip().lower()
+USER_LOG_SAMPLE_EVERY = max(1, int(os.getenv("USER_LOG_SAMPLE_EVERY", "10")))
+
+# Автоворонка: сообщений в секунду (Bot API допускает ~30 на всех получателей) и сколько
+# отправок идёт одновременно. Темп сам снижается после RetryAfter и при наплыве пользователей
+FUNNEL_SEND_RATE = max(1.0, float(os.getenv("FUNNEL_SEND_RATE", "20")))
+FUNNEL_CONCURRENCY = max(1, int(os.getenv("FUNNEL_CONCURRENCY", "8")))
+
+
+def _hours_range(value: str | None):
+    """«22-9» → (22, 9); пусто, с ошибкой или начало = конец — None."""
+    try:
+        start, end = (int(h) % 24 for h in (value or "").split("-"))
+    except ValueError:
+        return None
+    return (start, end) if start != end else None
+
+# Тихие часы автоворонки по FUNNEL_TIMEZONE, например «22-9»: шаги с задержкой не отправляются
+# (уйдут утром в обычном темпе), шаги «сразу» — как обычно. Пусто = без тихих часов
+FUNNEL_QUIET_HOURS = _hours_range(os.getenv("FUNNEL_QUIET_HOURS"))
+FUNNEL_TIMEZONE = os.getenv("FUNNEL_TIMEZONE") or "Europe/Moscow"
+
+# Игр на одной странице расписания и выбора игры при записи
+SCHEDULE_PAGE_SIZE = max(1, int(os.getenv("SCHEDULE_PAGE_SIZE", "8")))
+
+# Сколько дней сырые события user_events хранятся в основной БД; старше — в помесячный архив
+USER_EVENTS_RETENTION_DAYS = int(os.getenv("USER_EVENTS_RETENTION_DAYS", "90"))
@@ -1,23 +1,171 @@
+import re
 import sqlite3
-from datetime import datetime
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 
 from config import DATABASE_PATH
+from utils import game_starts_at
 
 Path(DATABASE_PATH).parent.mkdir(parents=True, exist_ok=True)
 
+# Одно соединение на поток: открывается при первом обращении и живёт до конца потока.
+# PRAGMA применяются один раз, подготовленные выражения кешируются (cached_statements).
+_local = threading.local()
+
 
 def get_conn():
-    conn = sqlite3.connect(DATABASE_PATH, timeout=15.0)
-    conn.execute("PRAGMA journal_mode=WAL")
-    conn.execute("PRAGMA busy_timeout=10000")
+    """Соединение текущего потока (autocommit; транзакции — только через transaction())."""
+    conn = getattr(_local, "conn", None)
+    if conn is None:
+        conn = sqlite3.connect(
+            DATABASE_PATH,
+            timeout=15.0,
+            isolation_level=None,
+            cached_statements=256,
+        )
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA busy_timeout=10000")
+        # В WAL достаточно NORMAL: fsync на чекпоинте, а не на каждом COMMIT
+        conn.execute("PRAGMA synchronous=NORMAL")
+        _local.conn = conn
+        _local.tx_depth = 0
     return conn
 
 
+def close_conn():
+    """Закрыть соединение текущего потока (при остановке бота)."""
+    conn = getattr(_local, "conn", None)
+    if conn is not None:
+        _local.conn = None
+        conn.close()
+
+
+@contextmanager
+def transaction():
+    """Пишущая транзакция: BEGIN IMMEDIATE → COMMIT, при исключении ROLLBACK.
+
+    Вложенный вызов не открывает новую транзакцию, а работает внутри внешней.
+    """
+    conn = get_conn()
+    depth = _local.tx_depth
+    if depth == 0:
+        conn.execute("BEGIN IMMEDIATE")
+    _local.tx_depth = depth + 1
+    try:
+        yield conn.cursor()
+    except BaseException:
+        _local.tx_depth = depth
+        if depth == 0:
+            conn.execute("ROLLBACK")
+        raise
+    _local.tx_depth = depth
+    if depth == 0:
+        conn.execute("COMMIT")
+
+
+def _fetchall(sql: str, params=()):
+    return get_conn().execute(sql, params).fetchall()
+
+
+def _fetchone(sql: str, params=()):
+    return get_conn().execute(sql, params).fetchone()
+
+
+# --- Версии контента ---
+# Версия на каждый вид контента хранится в content_versions и поднимается триггерами
+# (миграция 9) в той же транзакции, что и правка, — из любого потока и любого процесса.
+# PRAGMA data_version на отдельном соединении меняется, только когда кто-то другой
+# закоммитил изменения в файл БД; тогда строки версий перечитываются. Проверка без
+# изменений — одно PRAGMA без чтения таблиц. cache.py сверяет с версиями свои записи.
+CONTENT_TABLES = {
+    "games": "games",
+    "scenarios": "scenarios",
+    "stories": "stories",
+    "format_screens": "format",
+    "format_info": "format",
+    "funnel_steps": "funnel",
+    "settings": "settings",
+}
+# media_files → "media" (миграция 11)
+
+_versions_lock = threading.Lock()
+_versions_conn = None
+_data_version = None
+_content_versions: dict = {}
+version_checks = 0
+version_reloads = 0
+
+
+def content_versions() -> dict:
+    """Текущие версии контента {вид: версия}; при изменении файла БД перечитывает их."""
+    global _versions_conn, _data_version, _content_versions, version_checks, version_reloads
+    with _versions_lock:
+        if _versions_conn is None:
+            _versions_conn = sqlite3.connect(
+                DATABASE_PATH, timeout=15.0, isolation_level=None, check_same_thread=False
+            )
+        version_checks += 1
+        # data_version читается до версий: коммит между ними просто вызовет ещё одно перечитывание
+        data_version = _versions_conn.execute("PRAGMA data_version").fetchone()[0]
+        if data_version != _data_version:
+            _content_versions = dict(_versions_conn.execute("SELECT kind, version FROM content_versions"))
+            _data_version = data_version
+            version_reloads += 1
+        return _content_versions
+
+
+def content_version(kind: str) -> int:
+    return content_versions().get(kind, 0)
+
+
+# --- Миграции схемы ---
+# Номер применённой миграции хранится в PRAGMA user_version. Новые миграции добавляются
+# только в конец MIGRATIONS; уже выпущенные не меняются.
+
 def create_tables():
+    """Применить недостающие миграции одной транзакцией.
+
+    Миграция может вернуть команды, которые нельзя выполнить в транзакции (VACUUM), —
+    они выполняются сразу после COMMIT, до приёма апдейтов.
+    Если схема актуальна — стоит одного чтения PRAGMA user_version.
+    Возвращает [(миграция, секунды)] для отчёта о запуске.
+    """
+    version = _fetchone("PRAGMA user_version")[0]
+    if version >= MIGRATIONS[-1][0]:
+        return []
+    timings = []
+    after_commit = []
+    with transaction() as cur:
+        for num, name, migrate in MIGRATIONS:
+            if num <= version:
+                continue
+            started = time.perf_counter()
+            statements = migrate(cur)
+            timings.append((f"{num}: {name}", time.perf_counter() - started))
+            if statements:
+                after_commit.append((f"{num}: {name} (после COMMIT)", statements))
+        cur.execute(f"PRAGMA user_version = {MIGRATIONS[-1][0]}")
     conn = get_conn()
-    cur = conn.cursor()
+    for name, statements in after_commit:
+        started = time.perf_counter()
+        for sql in statements:
+            conn.execute(sql)
+        timings.append((name, time.perf_counter() - started))
+    return timings
+
 
+def _add_column(cur, table: str, column: str, decl: str):
+    """ALTER TABLE ADD COLUMN, если колонки ещё нет."""
+    cur.execute(f"PRAGMA table_info({table})")
+    if column not in {r[1] for r in cur.fetchall()}:
+        cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {decl}")
+
+
+def _migration_base_schema(cur):
+    """Исходная схема. Идемпотентна: старые БД без user_version могли получить часть колонок раньше."""
     cur.execute("""
     CREATE TABLE IF NOT EXISTS games (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -121,14 +269,8 @@ def create_tables():
     )
     """)
     # Миграции для уже существующей таблицы (старые БД без колонок кнопки)
-    try:
-        cur.execute("ALTER TABLE funnel_steps ADD COLUMN button_text TEXT")
-    except sqlite3.OperationalError:
-        pass
-    try:
-        cur.execute("ALTER TABLE funnel_steps ADD COLUMN button_url TEXT")
-    except sqlite3.OperationalError:
-        pass
+    _add_column(cur, "funnel_steps", "button_text", "TEXT")
+    _add_column(cur, "funnel_steps", "button_url", "TEXT")
 
     # Лог отправленных шагов автоворонки (чтобы не дублировать сообщения)
     cur.execute("""
@@ -170,10 +312,7 @@ def create_tables():
     """)
 
     # Миграция: добавляем scenario_id, если его нет
-    try:
-        cur.execute("ALTER TABLE stories ADD COLUMN scenario_id INTEGER REFERENCES scenarios(id)")
-    except sqlite3.OperationalError:
-        pass  # Колонка уже есть
+    _add_column(cur, "stories", "scenario_id", "INTEGER REFERENCES scenarios(id)")
 
     cur.execute("""
     CREATE TABLE IF NOT EXISTS scenarios (
@@ -202,10 +341,7 @@ def create_tables():
         video_url TEXT
     )
     """)
-    try:
-        cur.execute("ALTER TABLE format_info ADD COLUMN video_url TEXT")
-    except sqlite3.OperationalError:
-        pass
+    _add_column(cur, "format_info", "video_url", "TEXT")
     cur.execute("INSERT OR IGNORE INTO format_info (id, text) VALUES (1, 'Сюжетная игра (ролевой квест) — это как фильм, только ты внутри истории.\n\nТебе дают роль и цель, дальше события разворачиваются через общение и решения. Ведущий всё ведёт и помогает.')")
     cur.execute(
         "UPDATE format_info SET video_url = ? WHERE id = 1 AND (video_url IS NULL OR video_url = '')",
@@ -232,36 +368,20 @@ def create_tables():
     )
     """)
     # Миграции для уже существующей таблицы отложенных постов
-    try:
-        cur.execute("ALTER TABLE scheduled_posts ADD COLUMN button_text TEXT")
-    except sqlite3.OperationalError:
-        pass
-    try:
-        cur.execute("ALTER TABLE scheduled_posts ADD COLUMN button_url TEXT")
-    except sqlite3.OperationalError:
-        pass
-    try:
-        cur.execute("ALTER TABLE scheduled_posts ADD COLUMN send_to_admins INTEGER DEFAULT 0")
-    except sqlite3.OperationalError:
-        pass
+    _add_column(cur, "scheduled_posts", "button_text", "TEXT")
+    _add_column(cur, "scheduled_posts", "button_url", "TEXT")
+    _add_column(cur, "scheduled_posts", "send_to_admins", "INTEGER DEFAULT 0")
 
     # Исправляем существующие сюжеты: если hidden NULL (старые записи), делаем видимым
     cur.execute("UPDATE stories SET hidden = 0 WHERE hidden IS NULL")
-    
-    conn.commit()
-    conn.close()
-
-    seed_format_screens()
 
+    _seed_format_screens(cur)
 
-def seed_demo_data():
-    """Заполняет демо-данными для тестирования админки."""
-    conn = get_conn()
-    cur = conn.cursor()
 
+def _migration_demo_data(cur):
+    """Заполняет демо-данными для тестирования админки (только пустую БД)."""
     cur.execute("SELECT COUNT(*) FROM games")
     if cur.fetchone()[0] > 0:
-        conn.close()
         return  # уже есть данные
 
     games = [
@@ -312,11 +432,11 @@ def seed_demo_data():
         ("Где-то на Диком Западе", "Ковбои, шериф и ограбление банка"),
         ("Тайна «Восточного экспресса»", "Детектив в поезде"),
     ]
-    
+
     for s in scenarios:
         cur.execute("INSERT INTO scenarios (name, description) VALUES (?, ?)", s)
         sid = cur.lastrowid
-        
+
         # Добавляем по 3 сюжета в каждый сценарий
         for i in range(1, 4):
             title = f"Глава {i}: Начало истории {s[0]}"
@@ -327,89 +447,585 @@ def seed_demo_data():
                 (title, content, "", None, i-1, sid),
             )
 
-    conn.commit()
-    conn.close()
 
+def _seed_format_screens(cur):
+    """Заполняет экраны формата, если пусто."""
+    cur.execute("SELECT COUNT(*) FROM format_screens")
+    if cur.fetchone()[0] > 0:
+        return
 
-# Games
-def get_visible_games():
-    conn = get_conn()
-    cur = conn.cursor()
+    # Данные из handlers/format_funnel.py
+    screens = [
+        ("Что за формат?", "Сюжетная игра (ролевой квест) — это как фильм, только ты внутри истории.\n\nТебе дают роль и цель, дальше события разворачиваются через общение и решения. Ведущий всё ведёт и помогает."),
+        ("Не с кем?", "Если не с кем выбраться в люди — это идеальный формат.\n\nМожно прийти одному/одной: тебя мягко включат в игру, и компания появляется сама."),
+        ("Знакомства без кринжа", "Здесь не нужно «знакомиться специально».\n\nЕсть сюжет и общая задача — разговор начинается сам, и всё получается естественно."),
+        ("Надоело одно и то же", "Если устал(а) от «бар/кино/просто посидеть» — это другой уровень досуга.\n\nВместо фона — эмоции, интрига, смех и ощущение «вау, было не как обычно»."),
+        ("Я не умею / я интроверт", "Никакого опыта не нужно. Не надо быть актёром и «играть роль».\n\nПравила простые, включиться можно спокойно — ведущий подскажет, как комфортно участвовать."),
+        ("Хочу свою тусовку в ЕКБ", "Мы собираем комьюнити в Екатеринбурге: регулярные встречи и «свои» люди.\n\nМожно просто вступить в чат, познакомиться и выбрать удобную дату."),
+        ("Готов(а) попробовать?", "Частая реакция после первой игры:\n«Пришёл(ла) без ожиданий — втянулся(ась) за 10 минут и ушёл(ла) с новыми знакомыми».\n\nГотов(а) попробовать? Выбирай: записаться на ближайшую игру или зайти в чат.")
+    ]
+    
+    video_url = "https://www.youtube.com/watch?v=x3Ir917gDiM&list=PLDqVqfBsY9O-fPcm-pK-TpYWfnuJWSBFI"
+    
+    for i, (title, text) in enumerate(screens):
+        v_url = video_url if i in [0, 1, 2] else None
+        cur.execute(
+            "INSERT INTO format_screens (title, text, order_num, video_url) VALUES (?, ?, ?, ?)",
+            (title, text, i, v_url)
+        )
+
+
+def _migration_hot_indexes(cur):
+    """Индексы под горячие запросы (проверяются check_query_plans.py)."""
+    for sql in (
+        # Агрегат для выгрузки и DISTINCT tg_id для рассылки
+        "CREATE INDEX IF NOT EXISTS idx_user_events_tg ON user_events(tg_id, created_at)",
+        # DISTINCT tg_id и телефоны для выгрузки читаются только из индекса
+        "CREATE INDEX IF NOT EXISTS idx_leads_tg_phone ON leads(tg_id, phone)",
+        "CREATE INDEX IF NOT EXISTS idx_leads_created ON leads(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_leads_game ON leads(game_id)",
+        "CREATE INDEX IF NOT EXISTS idx_holiday_orders_tg_phone ON holiday_orders(tg_id, phone)",
+        "CREATE INDEX IF NOT EXISTS idx_holiday_orders_created ON holiday_orders(created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_started ON subscriptions(started_at)",
+        # Воркер отложенных постов: status = 'scheduled' AND run_at_utc <= ? каждые 30 с
+        "CREATE INDEX IF NOT EXISTS idx_scheduled_posts_due ON scheduled_posts(status, run_at_utc)",
+        "CREATE INDEX IF NOT EXISTS idx_scheduled_posts_run_at ON scheduled_posts(run_at_utc)",
+        "CREATE INDEX IF NOT EXISTS idx_stories_scenario ON stories(scenario_id, order_num)",
+        "CREATE INDEX IF NOT EXISTS idx_stories_order ON stories(order_num, created_at)",
+        "CREATE INDEX IF NOT EXISTS idx_games_visible ON games(hidden, game_date, game_time)",
+        "CREATE INDEX IF NOT EXISTS idx_funnel_log_step ON funnel_log(step_id)",
+    ):
+        cur.execute(sql)
+
+
+def _migration_games_starts_at(cur):
+    """games.starts_at «YYYY-MM-DD HH:MM»: сортировка и выборка ближайших игр по индексу.
+    Строки с нераспознанной датой остаются с NULL — админка показывает их отдельно."""
+    _add_column(cur, "games", "starts_at", "TEXT")
+    rows = cur.execute("SELECT id, game_date, game_time FROM games").fetchall()
+    cur.executemany(
+        "UPDATE games SET starts_at = ? WHERE id = ?",
+        [(game_starts_at(d, t), gid) for gid, d, t in rows],
+    )
+    cur.execute("DROP INDEX IF EXISTS idx_games_visible")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_games_upcoming ON games(hidden, starts_at)")
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_games_starts_at ON games(starts_at)")
+
+
+def _create_known_users_trigger(cur, table: str, ts: str, has_lead: int):
+    cur.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_{table}_known_users AFTER INSERT ON {table}
+    BEGIN
+        INSERT INTO known_users (tg_id, has_lead, first_seen, last_seen)
+        VALUES (NEW.tg_id, {has_lead}, NEW.{ts}, NEW.{ts})
+        ON CONFLICT(tg_id) DO UPDATE SET
+            has_lead = MAX(has_lead, excluded.has_lead),
+            first_seen = MIN(first_seen, excluded.first_seen),
+            last_seen = MAX(last_seen, excluded.last_seen);
+    END
+    """)
+
+
+def _migration_known_users(cur):
+    """known_users: все, кого бот знает, с флагом заявки. Ведётся триггерами на исходных таблицах,
+    поэтому аудитория рассылки — один индексный запрос, не зависящий от числа событий."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS known_users (
+        tg_id INTEGER PRIMARY KEY,
+        has_lead INTEGER NOT NULL DEFAULT 0,
+        first_seen TIMESTAMP,
+        last_seen TIMESTAMP
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_known_users_lead ON known_users(has_lead)")
+    for table, ts, has_lead in (
+        ("subscriptions", "started_at", 0),
+        ("user_events", "created_at", 0),
+        ("leads", "created_at", 1),
+        ("holiday_orders", "created_at", 1),
+    ):
+        _create_known_users_trigger(cur, table, ts, has_lead)
+        cur.execute(f"""
+        INSERT INTO known_users (tg_id, has_lead, first_seen, last_seen)
+        SELECT tg_id, {has_lead}, MIN({ts}), MAX({ts}) FROM {table} WHERE true GROUP BY tg_id
+        ON CONFLICT(tg_id) DO UPDATE SET
+            has_lead = MAX(has_lead, excluded.has_lead),
+            first_seen = MIN(first_seen, excluded.first_seen),
+            last_seen = MAX(last_seen, excluded.last_seen)
+        """)
+
+
+def _migration_user_activity(cur):
+    """user_activity: агрегат по пользователю для выгрузки, обновляется триггером на каждое событие.
+    events — набор типов событий через запятую, не длиннее ~200 символов (как и в выгрузке)."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_activity (
+        tg_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        first_seen TIMESTAMP,
+        last_seen TIMESTAMP,
+        event_count INTEGER NOT NULL DEFAULT 0,
+        events TEXT NOT NULL DEFAULT '',
+        phone TEXT
+    )
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_activity_last_seen ON user_activity(last_seen)")
+    cur.execute("""
+    CREATE TRIGGER IF NOT EXISTS trg_user_events_activity AFTER INSERT ON user_events
+    BEGIN
+        INSERT INTO user_activity (tg_id, username, first_name, last_name, first_seen, last_seen, event_count, events)
+        VALUES (NEW.tg_id, NEW.username, NEW.first_name, NEW.last_name, NEW.created_at, NEW.created_at, 1, NEW.event_type)
+        ON CONFLICT(tg_id) DO UPDATE SET
+            username = excluded.username,
+            first_name = excluded.first_name,
+            last_name = excluded.last_name,
+            first_seen = COALESCE(first_seen, excluded.first_seen),
+            last_seen = excluded.last_seen,
+            event_count = event_count + 1,
+            events = CASE
+                WHEN events = '' THEN excluded.events
+                WHEN length(events) >= 200 OR instr(',' || events || ',', ',' || excluded.events || ',') > 0 THEN events
+                ELSE events || ',' || excluded.events
+            END;
+    END
+    """)
+    cur.execute("""
+    INSERT INTO user_activity (tg_id, username, first_name, last_name, first_seen, last_seen, event_count, events)
+    SELECT tg_id, username, first_name, last_name, MIN(created_at), MAX(created_at), COUNT(*),
+           substr(GROUP_CONCAT(DISTINCT event_type), 1, 200)
+    FROM user_events GROUP BY tg_id
+    """)
+    # Телефон: первый известный из заявок, дальше не перезаписывается
+    keep_first_phone = "phone = CASE WHEN phone IS NULL OR phone = '' THEN excluded.phone ELSE phone END"
+    for table in ("leads", "holiday_orders"):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_activity_phone AFTER INSERT ON {table}
+        WHEN NEW.phone IS NOT NULL AND NEW.phone != ''
+        BEGIN
+            INSERT INTO user_activity (tg_id, phone) VALUES (NEW.tg_id, NEW.phone)
+            ON CONFLICT(tg_id) DO UPDATE SET {keep_first_phone};
+        END
+        """)
+        cur.execute(f"""
+        INSERT INTO user_activity (tg_id, phone)
+        SELECT tg_id, phone FROM {table} WHERE phone IS NOT NULL AND phone != '' ORDER BY id
+        ON CONFLICT(tg_id) DO UPDATE SET {keep_first_phone}
+        """)
+
+
+def _migration_user_events_rollups(cur):
+    """Дневные свёртки user_events (по пользователю и по типу события) для ретеншна сырых строк."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_events_daily (
+        tg_id INTEGER NOT NULL,
+        day TEXT NOT NULL,
+        events INTEGER NOT NULL,
+        PRIMARY KEY (tg_id, day)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS event_types_daily (
+        day TEXT NOT NULL,
+        event_type TEXT NOT NULL,
+        events INTEGER NOT NULL,
+        users INTEGER NOT NULL,
+        PRIMARY KEY (day, event_type)
+    ) WITHOUT ROWID
+    """)
+    cur.execute("CREATE INDEX IF NOT EXISTS idx_user_events_created ON user_events(created_at)")
+
+
+def _split_event_type_v8(event_type: str) -> tuple[str, str | None]:
+    """Разбор шаблонов в том виде, в каком его выпустила миграция 8 (не меняется)."""
+    head, *rest = event_type.split("_")
+    args = [p for p in rest if _EVENT_ARG.fullmatch(p)]
+    if not args:
+        return event_type, None
+    name = "_".join([head] + [p for p in rest if not _EVENT_ARG.fullmatch(p)])
+    return name, "_".join(args)
+
+
+def _migration_event_types(cur):
+    """user_events без повторяющегося текста: тип события — id шаблона из event_types
+    (числовые части callback-данных — в args), профиль — в user_profiles, пишется только при изменении.
+    Таблица user_events пересобирается; её триггеры создаются заново."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS event_types (
+        id INTEGER PRIMARY KEY,
+        name TEXT NOT NULL UNIQUE
+    )
+    """)
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS user_profiles (
+        tg_id INTEGER PRIMARY KEY,
+        username TEXT,
+        first_name TEXT,
+        last_name TEXT,
+        updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    # Последние известные имена уже собраны в user_activity
+    cur.execute("""
+    INSERT OR IGNORE INTO user_profiles (tg_id, username, first_name, last_name)
+    SELECT tg_id, username, first_name, last_name FROM user_activity WHERE event_count > 0
+    """)
+
+    cur.execute("CREATE TEMP TABLE event_type_map (event_type TEXT PRIMARY KEY, type_id INTEGER, args TEXT)")
+    for (event_type,) in cur.execute("SELECT DISTINCT event_type FROM user_events").fetchall():
+        name, args = _split_event_type_v8(event_type)
+        cur.execute(
+            "INSERT INTO event_type_map (event_type, type_id, args) VALUES (?, ?, ?)",
+            (event_type, _intern_event_type(cur, name), args),
+        )
+    cur.execute("""
+    CREATE TABLE user_events_new (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        tg_id INTEGER NOT NULL,
+        type_id INTEGER NOT NULL REFERENCES event_types(id),
+        args TEXT,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    )
+    """)
+    cur.execute("""
+    INSERT INTO user_events_new (id, tg_id, type_id, args, created_at)
+    SELECT e.id, e.tg_id, m.type_id, m.args, e.created_at
+    FROM user_events e JOIN event_type_map m ON m.event_type = e.event_type
+    ORDER BY e.id
+    """)
+    cur.execute("DROP TABLE event_type_map")
+    cur.execute("DROP TABLE user_events")
+    cur.execute("ALTER TABLE user_events_new RENAME TO user_events")
+    cur.execute("CREATE INDEX idx_user_events_tg ON user_events(tg_id, created_at)")
+    cur.execute("CREATE INDEX idx_user_events_created ON user_events(created_at)")
+    _create_known_users_trigger(cur, "user_events", "created_at", 0)
+
+    # user_activity: имена теперь в user_profiles, набор событий — из шаблонов
+    for column in ("username", "first_name", "last_name"):
+        cur.execute(f"ALTER TABLE user_activity DROP COLUMN {column}")
+    cur.execute("""
+    WITH agg AS (
+        SELECT e.tg_id, substr(GROUP_CONCAT(DISTINCT t.name), 1, 200) AS events
+        FROM user_events e JOIN event_types t ON t.id = e.type_id GROUP BY e.tg_id
+    )
+    UPDATE user_activity SET events = agg.events FROM agg WHERE user_activity.tg_id = agg.tg_id
+    """)
+    cur.execute("""
+    CREATE TRIGGER trg_user_events_activity AFTER INSERT ON user_events
+    BEGIN
+        INSERT INTO user_activity (tg_id, first_seen, last_seen, event_count, events)
+        VALUES (NEW.tg_id, NEW.created_at, NEW.created_at, 1, (SELECT name FROM event_types WHERE id = NEW.type_id))
+        ON CONFLICT(tg_id) DO UPDATE SET
+            first_seen = COALESCE(first_seen, excluded.first_seen),
+            last_seen = excluded.last_seen,
+            event_count = event_count + 1,
+            events = CASE
+                WHEN events = '' THEN excluded.events
+                WHEN length(events) >= 200 OR instr(',' || events || ',', ',' || excluded.events || ',') > 0 THEN events
+                ELSE events || ',' || excluded.events
+            END;
+    END
+    """)
+
+
+
+def _migration_content_versions(cur):
+    """Версии контента в БД: триггер на каждую вставку, правку и удаление в таблицах
+    CONTENT_TABLES поднимает версию вида — её видят кэши всех процессов."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS content_versions (
+        kind TEXT PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 0
+    ) WITHOUT ROWID
+    """)
+    for table, kind in CONTENT_TABLES.items():
+        _create_version_triggers(cur, table, kind)
+
+
+def _create_version_triggers(cur, table: str, kind: str):
+    cur.execute("INSERT OR IGNORE INTO content_versions (kind) VALUES (?)", (kind,))
+    for op in ("INSERT", "UPDATE", "DELETE"):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_version_{op.lower()} AFTER {op} ON {table}
+        BEGIN
+            UPDATE content_versions SET version = version + 1 WHERE kind = '{kind}';
+        END
+        """)
+
+
+def _migration_scenario_story_versions(cur):
+    """Версия сюжетов каждого сценария (kind «scenario:<id>»): правка сюжета пересобирает
+    индекс навигации только своего сценария. Перенос сюжета поднимает оба сценария."""
+    for op, rows in (("INSERT", ("NEW",)), ("UPDATE", ("NEW", "OLD")), ("DELETE", ("OLD",))):
+        body = "".join(
+            f"""
+                INSERT INTO content_versions (kind, version)
+                SELECT 'scenario:' || {row}.scenario_id, 1 WHERE {row}.scenario_id IS NOT NULL
+                ON CONFLICT(kind) DO UPDATE SET version = version + 1;"""
+            for row in rows
+        )
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_stories_scenario_version_{op.lower()} AFTER {op} ON stories
+        BEGIN{body}
+        END
+        """)
+
+
+def _migration_media_files(cur):
+    """Реестр file_id для картинок по URL. Смена картинки сюжета или «Что за формат»
+    в админке удаляет записи старого и нового URL — картинка загрузится заново."""
+    cur.execute("""
+    CREATE TABLE IF NOT EXISTS media_files (
+        url TEXT PRIMARY KEY,
+        file_id TEXT NOT NULL,
+        created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+    ) WITHOUT ROWID
+    """)
+    _create_version_triggers(cur, "media_files", "media")
+    for table in ("stories", "format_info"):
+        cur.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_{table}_media_update AFTER UPDATE OF image_url ON {table}
+        BEGIN
+            DELETE FROM media_files WHERE url IN (OLD.image_url, NEW.image_url);
+        END
+        """)
+
+def _migration_funnel_cursor(cur):
+    """subscriptions.funnel_step_id / funnel_due_at: кому и когда слать следующий шаг воронки.
+    NULL — воронка пройдена. Планировщик берёт только подошедших по частичному индексу."""
+    _add_column(cur, "subscriptions", "funnel_step_id", "INTEGER")
+    _add_column(cur, "subscriptions", "funnel_due_at", "INTEGER")
+    cur.execute("""
+    UPDATE subscriptions SET (funnel_step_id, funnel_due_at) = (
+        SELECT f.id, CAST(strftime('%s', subscriptions.started_at) AS INTEGER) + f.delay_hours * 3600
+        FROM funnel_steps f
+        WHERE f.is_active = 1
+          AND NOT EXISTS (SELECT 1 FROM funnel_log l WHERE l.tg_id = subscriptions.tg_id AND l.step_id = f.id)
+        ORDER BY f.delay_hours, f.order_num, f.id
+        LIMIT 1
+    )
+    """)
     cur.execute(
+        "CREATE INDEX IF NOT EXISTS idx_subscriptions_funnel_due ON subscriptions(funnel_due_at) "
+        "WHERE funnel_due_at IS NOT NULL"
+    )
+
+
+def _migration_funnel_activation(cur):
+    """Политика включения шага воронки (funnel_steps.activation):
+    all — всем по задержке от первого захода; new — только подписавшимся после включения шага;
+    spread — тем, у кого срок шага уже прошёл, равномерно за spread_hours после включения шага
+    или смены задержки. activated_at / changed_at — unix-время этих событий."""
+    _add_column(cur, "funnel_steps", "activation", "TEXT NOT NULL DEFAULT 'all'")
+    _add_column(cur, "funnel_steps", "spread_hours", "INTEGER NOT NULL DEFAULT 0")
+    _add_column(cur, "funnel_steps", "activated_at", "INTEGER")
+    _add_column(cur, "funnel_steps", "changed_at", "INTEGER")
+
+
+def _cursor_template(name: str) -> str:
+    """«cb:sch:0a:n:…|12» → «cb:sch»; остальные имена — как есть."""
+    if name.startswith("cb:"):
+        prefix, sep, _ = name[3:].partition(":")
+        if sep:
+            return "cb:" + prefix
+    return name
+
+
+def _migration_event_type_cursors(cur):
+    """Шаблоны событий с курсорами страниц («cb:sch:0a:n:…|12», «cb:rpage:n:…»), накопленные до
+    разбора «cb:префикс:…», сливаются в шаблон «cb:префикс»: user_events переводятся на него
+    (хвост — в args), дневные свёртки складываются, выборка событий в user_activity чистится,
+    лишние строки event_types удаляются."""
+    rows = cur.execute("SELECT id, name FROM event_types WHERE name LIKE 'cb:%:%'").fetchall()
+    if not rows:
+        return
+    cur.execute("""
+    CREATE TEMP TABLE event_type_merge (
+        old_id INTEGER PRIMARY KEY, new_id INTEGER, old_name TEXT, new_name TEXT, tail TEXT
+    )
+    """)
+    for type_id, name in rows:
+        template = _cursor_template(name)
+        cur.execute(
+            "INSERT INTO event_type_merge VALUES (?, ?, ?, ?, ?)",
+            (type_id, _intern_event_type(cur, template), name, template, name[len(template) + 1:]),
+        )
+    cur.execute("""
+    UPDATE user_events SET
+        type_id = m.new_id,
+        args = CASE WHEN user_events.args IS NULL THEN m.tail ELSE m.tail || '_' || user_events.args END
+    FROM event_type_merge m WHERE user_events.type_id = m.old_id
+    """)
+    cur.execute("""
+    INSERT INTO event_types_daily (day, event_type, events, users)
+    SELECT d.day, m.new_name, SUM(d.events), SUM(d.users)
+    FROM event_types_daily d JOIN event_type_merge m ON m.old_name = d.event_type
+    WHERE 1 GROUP BY d.day, m.new_name
+    ON CONFLICT(day, event_type) DO UPDATE SET
+        events = events + excluded.events, users = users + excluded.users
+    """)
+    cur.execute("DELETE FROM event_types_daily WHERE event_type IN (SELECT old_name FROM event_type_merge)")
+    # Выборка событий пользователя — имена через запятую (до 200 символов)
+    for tg_id, events in cur.execute(
+        "SELECT tg_id, events FROM user_activity WHERE events LIKE '%cb:%:%'"
+    ).fetchall():
+        names = dict.fromkeys(_cursor_template(n) for n in events.split(","))
+        cur.execute("UPDATE user_activity SET events = ? WHERE tg_id = ?", (",".join(names)[:200], tg_id))
+    cur.execute("DELETE FROM event_types WHERE id IN (SELECT old_id FROM event_type_merge)")
+    cur.execute("DROP TABLE event_type_merge")
+
+
+def _migration_incremental_vacuum(cur):
+    """auto_vacuum=INCREMENTAL: место после архивации user_events плановое обслуживание
+    возвращает порциями (reclaim_free_pages). Переключение режима требует полного VACUUM —
+    он идёт один раз при запуске, после COMMIT миграций и до приёма апдейтов."""
+    return ["PRAGMA auto_vacuum = INCREMENTAL", "VACUUM"]
+
+
+MIGRATIONS = [
+    (1, "base schema", _migration_base_schema),
+    (2, "demo data", _migration_demo_data),
+    (3, "hot query indexes", _migration_hot_indexes),
+    (4, "games.starts_at", _migration_games_starts_at),
+    (5, "known_users", _migration_known_users),
+    (6, "user_activity", _migration_user_activity),
+    (7, "user_events rollups", _migration_user_events_rollups),
+    (8, "event_types and user_profiles", _migration_event_types),
+    (9, "content_versions", _migration_content_versions),
+    (10, "per-scenario story versions", _migration_scenario_story_versions),
+    (11, "media_files", _migration_media_files),
+    (12, "funnel cursor", _migration_funnel_cursor),
+    (13, "funnel step activation", _migration_funnel_activation),
+    (14, "event type cursors", _migration_event_type_cursors),
+    (15, "incremental auto_vacuum", _migration_incremental_vacuum),
+]
+
+
+# Курсор автоворонки подписчика: следующий неотправленный активный шаг и время его отправки
+# (unix-секунды) с учётом политики включения шага. {after} — условие «после шага» или пусто
+# для первого шага. Отложенные политикой spread получают сдвиг по tg_id внутри окна.
+_FUNNEL_STARTED = "CAST(strftime('%s', subscriptions.started_at) AS INTEGER)"
+_FUNNEL_DUE = f"{_FUNNEL_STARTED} + f.delay_hours * 3600"
+_FUNNEL_CURSOR = f"""
+    SELECT f.id, CASE
+        WHEN f.activation = 'spread' AND f.spread_hours > 0 AND {_FUNNEL_DUE} < f.changed_at
+        THEN f.changed_at + subscriptions.tg_id % (f.spread_hours * 3600)
+        ELSE {_FUNNEL_DUE}
+    END
+    FROM funnel_steps f
+    WHERE f.is_active = 1 {{after}}
+      AND (f.activation != 'new' OR {_FUNNEL_STARTED} >= f.activated_at)
+      AND NOT EXISTS (SELECT 1 FROM funnel_log l WHERE l.tg_id = subscriptions.tg_id AND l.step_id = f.id)
+    ORDER BY f.delay_hours, f.order_num, f.id
+    LIMIT 1
+"""
+_FUNNEL_FIRST = _FUNNEL_CURSOR.format(after="")
+_FUNNEL_AFTER = _FUNNEL_CURSOR.format(
+    after="AND (f.delay_hours, f.order_num, f.id) > (SELECT delay_hours, order_num, id FROM funnel_steps WHERE id = ?)"
+)
+
+
+# Games
+def today() -> str:
+    """Начало сегодняшнего дня в формате games.starts_at: сегодняшние игры ещё в расписании."""
+    return datetime.now().strftime("%Y-%m-%d")
+
+
+def get_visible_games(from_date: str | None = None):
+    """Видимые игры, начиная с from_date (по умолчанию — сегодня), по времени начала."""
+    return _fetchall(
         "SELECT id, name, game_date, game_time, place, price, description, limit_places "
-        "FROM games WHERE hidden = 0 ORDER BY game_date, game_time"
+        "FROM games WHERE hidden = 0 AND starts_at >= ? ORDER BY starts_at",
+        (from_date or today(),),
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
-def get_all_games():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, name, game_date, game_time, place, price, description, limit_places, hidden "
-        "FROM games ORDER BY game_date, game_time"
+def get_visible_games_page(from_date=None, until=None, after=None, before=None, limit=8):
+    """Страница видимых игр по ключу (starts_at, id) — без OFFSET, читается только сама страница.
+
+    after — ключ последней игры предыдущей страницы (листаем вперёд), before — первой игры
+    текущей (назад); until — верхняя граница starts_at, не включая её. Возвращает
+    (игры по возрастанию starts_at, есть ли ещё игры в направлении листания).
+    Строка игры — как в get_visible_games, последним полем starts_at.
+    """
+    where = ["hidden = 0", "starts_at >= ?"]
+    params = [from_date or today()]
+    if until:
+        where.append("starts_at < ?")
+        params.append(until)
+    order = "starts_at, id"
+    if after:
+        where.append("(starts_at, id) > (?, ?)")
+        params += after
+    elif before:
+        where.append("(starts_at, id) < (?, ?)")
+        params += before
+        order = "starts_at DESC, id DESC"
+    rows = _fetchall(
+        "SELECT id, name, game_date, game_time, place, price, description, limit_places, starts_at "
+        f"FROM games WHERE {' AND '.join(where)} ORDER BY {order} LIMIT ?",
+        (*params, limit + 1),
+    )
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    if before:
+        rows.reverse()
+    return rows, has_more
+
+
+def get_all_games(from_date: str | None = None):
+    """Для админки: предстоящие игры и игры с нераспознанной датой (они идут первыми)."""
+    cols = "SELECT id, name, game_date, game_time, place, price, description, limit_places, hidden FROM games "
+    # Два диапазона по индексу вместо OR, который превращается в полный проход
+    return _fetchall(cols + "WHERE starts_at IS NULL ORDER BY id") + _fetchall(
+        cols + "WHERE starts_at >= ? ORDER BY starts_at", (from_date or today(),)
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 def get_game(game_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM games WHERE id = ?", (game_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return _fetchone("SELECT * FROM games WHERE id = ?", (game_id,))
 
 
 def add_game(name, game_date, game_time, place, price, description, limit_places):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """INSERT INTO games (name, game_date, game_time, place, price, description, limit_places)
-           VALUES (?, ?, ?, ?, ?, ?, ?)""",
-        (name, game_date, game_time or "", place or "", price or "", description or "", limit_places or 0),
-    )
-    gid = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return gid
+    with transaction() as cur:
+        cur.execute(
+            """INSERT INTO games (name, game_date, game_time, place, price, description, limit_places, starts_at)
+               VALUES (?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                name, game_date, game_time or "", place or "", price or "", description or "",
+                limit_places or 0, game_starts_at(game_date, game_time),
+            ),
+        )
+        return cur.lastrowid
 
 
 def update_game(gid, **kwargs):
     if not kwargs:
         return
-    conn = get_conn()
-    cur = conn.cursor()
-    cols = list(kwargs.keys())
-    vals = list(kwargs.values()) + [gid]
-    sql = "UPDATE games SET " + ", ".join(f"{c}=?" for c in cols) + " WHERE id=?"
-    cur.execute(sql, vals)
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        if "game_date" in kwargs or "game_time" in kwargs:
+            row = cur.execute("SELECT game_date, game_time FROM games WHERE id = ?", (gid,)).fetchone()
+            if row:
+                kwargs["starts_at"] = game_starts_at(
+                    kwargs.get("game_date", row[0]), kwargs.get("game_time", row[1])
+                )
+        cols = list(kwargs.keys())
+        vals = list(kwargs.values()) + [gid]
+        cur.execute("UPDATE games SET " + ", ".join(f"{c}=?" for c in cols) + " WHERE id=?", vals)
 
 
 def toggle_game_visibility(game_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE games SET hidden = 1 - hidden WHERE id = ?", (game_id,))
-    cur.execute("SELECT hidden FROM games WHERE id = ?", (game_id,))
-    h = cur.fetchone()[0]
-    conn.commit()
-    conn.close()
-    return h
+    with transaction() as cur:
+        cur.execute("UPDATE games SET hidden = 1 - hidden WHERE id = ?", (game_id,))
+        cur.execute("SELECT hidden FROM games WHERE id = ?", (game_id,))
+        return cur.fetchone()[0]
 
 
 def delete_game(game_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE leads SET game_id = NULL WHERE game_id = ?", (game_id,))
-    cur.execute("DELETE FROM games WHERE id = ?", (game_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("UPDATE leads SET game_id = NULL WHERE game_id = ?", (game_id,))
+        cur.execute("DELETE FROM games WHERE id = ?", (game_id,))
 
 
 # Leads
@@ -426,227 +1042,217 @@ def add_lead(
     utm_medium=None,
     utm_campaign=None,
 ):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """INSERT INTO leads (tg_id, username, name, phone, game_id, game_name, participants_count, comment,
-           utm_source, utm_medium, utm_campaign) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
-        (
-            tg_id,
-            username or "",
-            name or "",
-            phone or "",
-            game_id,
-            game_name or "",
-            participants_count or 1,
-            comment or "",
-            utm_source or "",
-            utm_medium or "",
-            utm_campaign or "",
-        ),
-    )
-    lid = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return lid
+    with transaction() as cur:
+        cur.execute(
+            """INSERT INTO leads (tg_id, username, name, phone, game_id, game_name, participants_count, comment,
+               utm_source, utm_medium, utm_campaign) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)""",
+            (
+                tg_id,
+                username or "",
+                name or "",
+                phone or "",
+                game_id,
+                game_name or "",
+                participants_count or 1,
+                comment or "",
+                utm_source or "",
+                utm_medium or "",
+                utm_campaign or "",
+            ),
+        )
+        return cur.lastrowid
 
 
 def get_leads(limit=100):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    return _fetchall(
         "SELECT id, tg_id, username, name, phone, game_name, participants_count, comment, status, created_at "
         "FROM leads ORDER BY created_at DESC LIMIT ?",
         (limit,),
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 # Questions
 def add_question(tg_id, username, name, question_text):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO questions (tg_id, username, name, question_text) VALUES (?, ?, ?, ?)",
-        (tg_id, username or "", name or "", question_text),
-    )
-    qid = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return qid
+    with transaction() as cur:
+        cur.execute(
+            "INSERT INTO questions (tg_id, username, name, question_text) VALUES (?, ?, ?, ?)",
+            (tg_id, username or "", name or "", question_text),
+        )
+        return cur.lastrowid
 
 
 def add_holiday_order(tg_id, username, name, phone):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT INTO holiday_orders (tg_id, username, name, phone) VALUES (?, ?, ?, ?)",
-        (tg_id, username or "", name or "", phone or ""),
-    )
-    oid = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return oid
+    with transaction() as cur:
+        cur.execute(
+            "INSERT INTO holiday_orders (tg_id, username, name, phone) VALUES (?, ?, ?, ?)",
+            (tg_id, username or "", name or "", phone or ""),
+        )
+        return cur.lastrowid
 
 
 def get_holiday_orders(limit=10000):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    return _fetchall(
         "SELECT id, tg_id, username, name, phone, created_at FROM holiday_orders ORDER BY created_at DESC LIMIT ?",
         (limit,),
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 # Settings
 def get_setting(key: str, default="0"):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT value FROM settings WHERE key = ?", (key,))
-    row = cur.fetchone()
-    conn.close()
+    row = _fetchone("SELECT value FROM settings WHERE key = ?", (key,))
     return row[0] if row else default
 
 
 def save_user_utm(tg_id: int, utm_source=None, utm_medium=None, utm_campaign=None):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """INSERT INTO user_utm (tg_id, utm_source, utm_medium, utm_campaign) VALUES (?, ?, ?, ?)
-           ON CONFLICT(tg_id) DO UPDATE SET utm_source=excluded.utm_source, utm_medium=excluded.utm_medium,
-           utm_campaign=excluded.utm_campaign, updated_at=CURRENT_TIMESTAMP""",
-        (tg_id, utm_source or "", utm_medium or "", utm_campaign or ""),
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute(
+            """INSERT INTO user_utm (tg_id, utm_source, utm_medium, utm_campaign) VALUES (?, ?, ?, ?)
+               ON CONFLICT(tg_id) DO UPDATE SET utm_source=excluded.utm_source, utm_medium=excluded.utm_medium,
+               utm_campaign=excluded.utm_campaign, updated_at=CURRENT_TIMESTAMP""",
+            (tg_id, utm_source or "", utm_medium or "", utm_campaign or ""),
+        )
 
 
 def add_subscription(tg_id: int, username: str = None, first_name: str = None, last_name: str = None):
-    """Первый контакт: кто нажал /start. INSERT OR IGNORE — один раз на пользователя."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """INSERT OR IGNORE INTO subscriptions (tg_id, username, first_name, last_name)
-           VALUES (?, ?, ?, ?)""",
-        (tg_id, username or "", first_name or "", last_name or ""),
-    )
-    conn.commit()
-    conn.close()
+    """Первый контакт: кто нажал /start. INSERT OR IGNORE — один раз на пользователя.
+
+    True — пользователь новый (запись добавлена, курсор воронки — на первом шаге).
+    """
+    with transaction() as cur:
+        cur.execute(
+            """INSERT OR IGNORE INTO subscriptions (tg_id, username, first_name, last_name)
+               VALUES (?, ?, ?, ?)""",
+            (tg_id, username or "", first_name or "", last_name or ""),
+        )
+        if cur.rowcount == 0:
+            return False
+        cur.execute(
+            f"UPDATE subscriptions SET (funnel_step_id, funnel_due_at) = ({_FUNNEL_FIRST}) WHERE tg_id = ?",
+            (tg_id,),
+        )
+        return True
+
+
+# Кэш id шаблонов событий: пишет только поток-писатель, пополняется после COMMIT
+_event_type_ids: dict[str, int] = {}
+_EVENT_ARG = re.compile(r"-?\d+")
+
+
+def _split_event_type(event_type: str) -> tuple[str, str | None]:
+    """«cb:story_nav_2_1» → («cb:story_nav», «2_1»): числовые части callback-данных — отдельно.
+    У данных вида «префикс:…» (курсоры страниц расписания и записи) шаблон — «cb:префикс»,
+    всё после первого двоеточия — аргументы: иначе каждая страница стала бы новым шаблоном.
+
+    >>> _split_event_type("cb:story_nav_2_1")
+    ('cb:story_nav', '2_1')
+    >>> _split_event_type("cb:sch:0a:n:2026-11-02 19:00|12")
+    ('cb:sch', '0a:n:2026-11-02 19:00|12')
+    >>> _split_event_type("cb:rpage:p:2026-11-02 19:00|12")
+    ('cb:rpage', 'p:2026-11-02 19:00|12')
+    >>> _split_event_type("msg:start")
+    ('msg:start', None)
+    """
+    if event_type.startswith("cb:"):
+        prefix, sep, tail = event_type[3:].partition(":")
+        if sep:
+            return "cb:" + prefix, tail
+    head, *rest = event_type.split("_")
+    args = [p for p in rest if _EVENT_ARG.fullmatch(p)]
+    if not args:
+        return event_type, None
+    name = "_".join([head] + [p for p in rest if not _EVENT_ARG.fullmatch(p)])
+    return name, "_".join(args)
+
+
+def _intern_event_type(cur, name: str) -> int:
+    cur.execute("INSERT OR IGNORE INTO event_types (name) VALUES (?)", (name,))
+    cur.execute("SELECT id FROM event_types WHERE name = ?", (name,))
+    return cur.fetchone()[0]
 
 
 def log_user_event(tg_id: int, username: str, first_name: str, last_name: str, event_type: str):
     """Логирует действие пользователя (любая кнопка, сообщение)."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """INSERT INTO user_events (tg_id, username, first_name, last_name, event_type)
-           VALUES (?, ?, ?, ?, ?)""",
-        (tg_id, username or "", first_name or "", last_name or "", event_type[:100]),
+    log_user_events([(tg_id, username, first_name, last_name, event_type)])
+
+
+def log_user_events(rows):
+    """Пакетная запись событий [(tg_id, username, first_name, last_name, event_type)] одной транзакцией.
+    Профиль в user_profiles переписывается, только если имя изменилось."""
+    profiles = {}
+    events = []
+    new_types = {}
+    with transaction() as cur:
+        for tg_id, username, first_name, last_name, event_type in rows:
+            name, args = _split_event_type((event_type or "")[:100])
+            type_id = _event_type_ids.get(name) or new_types.get(name)
+            if type_id is None:
+                type_id = new_types[name] = _intern_event_type(cur, name)
+            events.append((tg_id, type_id, args))
+            profiles[tg_id] = (tg_id, username or "", first_name or "", last_name or "")
+        cur.executemany(
+            """INSERT INTO user_profiles (tg_id, username, first_name, last_name) VALUES (?, ?, ?, ?)
+               ON CONFLICT(tg_id) DO UPDATE SET
+                   username = excluded.username, first_name = excluded.first_name,
+                   last_name = excluded.last_name, updated_at = CURRENT_TIMESTAMP
+               WHERE (username, first_name, last_name)
+                     IS NOT (excluded.username, excluded.first_name, excluded.last_name)""",
+            list(profiles.values()),
+        )
+        cur.executemany("INSERT INTO user_events (tg_id, type_id, args) VALUES (?, ?, ?)", events)
+    _event_type_ids.update(new_types)
+
+
+def iter_users_for_export(limit=50000):
+    """Строки выгрузки пользователей из user_activity, по одной, от последних активных:
+    tg_id, username, first_name, last_name, first_seen, last_seen, event_count, events_sample, phone."""
+    cur = get_conn().execute(
+        """SELECT a.tg_id, p.username, p.first_name, p.last_name, a.first_seen, a.last_seen, a.event_count,
+                  substr(a.events, 1, 200), COALESCE(a.phone, '')
+           FROM user_activity a LEFT JOIN user_profiles p ON p.tg_id = a.tg_id
+           WHERE a.last_seen IS NOT NULL
+           ORDER BY a.last_seen DESC LIMIT ?""",
+        (limit,),
     )
-    conn.commit()
-    conn.close()
+    while True:
+        rows = cur.fetchmany(500)
+        if not rows:
+            return
+        yield from rows
 
 
-def get_users_for_export(limit=50000):
-    """Агрегат по пользователям: tg_id, username, first_name, last_name, first_seen, last_seen, event_count, events_sample, phone."""
-    try:
-        conn = get_conn()
-        cur = conn.cursor()
-        cur.execute("""
-            SELECT tg_id, username, first_name, last_name,
-                   MIN(created_at) as first_seen, MAX(created_at) as last_seen,
-                   COUNT(*) as event_count,
-                   GROUP_CONCAT(DISTINCT event_type) as events
-            FROM user_events
-            GROUP BY tg_id
-            ORDER BY last_seen DESC
-            LIMIT ?
-        """, (limit,))
-        rows = cur.fetchall()
-        cur.execute("SELECT tg_id, phone FROM leads WHERE phone != '' AND phone IS NOT NULL")
-        lead_phones = {r[0]: r[1] for r in cur.fetchall()}
-        cur.execute("SELECT tg_id, phone FROM holiday_orders WHERE phone != '' AND phone IS NOT NULL")
-        for r in cur.fetchall():
-            if r[0] not in lead_phones:
-                lead_phones[r[0]] = r[1]
-        conn.close()
-        result = []
-        for r in rows:
-            tg_id, uname, fname, lname, first_seen, last_seen, cnt, events = r
-            phone = lead_phones.get(tg_id, "")
-            result.append((tg_id, uname, fname, lname, first_seen, last_seen, cnt, (events or "")[:200], phone))
-        return result
-    except sqlite3.OperationalError:
-        try:
-            conn.close()
-        except Exception:
-            pass
-        return []
+_AUDIENCE_WHERE = {
+    "with_lead": " WHERE has_lead = 1",
+    "without_lead": " WHERE has_lead = 0",
+}
 
 
 def get_users_for_broadcast(filter_type: str = "all"):
     """
-    Список tg_id для рассылки.
+    Список tg_id для рассылки (из known_users).
 
     filter_type:
       - "all"         — все, кто когда-либо контактировал с ботом
                         (subscriptions ∪ user_events ∪ leads ∪ holiday_orders)
       - "with_lead"   — только пользователи, у которых есть лид/заявка
       - "without_lead"— все остальные
+    Неизвестные значения фильтра — как "all".
     """
-    try:
-        conn = get_conn()
-        cur = conn.cursor()
-
-        # Базовый пул пользователей: все, кого мы хоть где-то знаем.
-        cur.execute("SELECT DISTINCT tg_id FROM subscriptions")
-        subs_ids = {r[0] for r in cur.fetchall()}
-
-        cur.execute("SELECT DISTINCT tg_id FROM user_events")
-        events_ids = {r[0] for r in cur.fetchall()}
+    where = _AUDIENCE_WHERE.get(filter_type, "")
+    return [r[0] for r in _fetchall("SELECT tg_id FROM known_users" + where)]
 
-        cur.execute("SELECT DISTINCT tg_id FROM leads")
-        lead_ids = {r[0] for r in cur.fetchall()}
-        cur.execute("SELECT DISTINCT tg_id FROM holiday_orders")
-        lead_ids.update(r[0] for r in cur.fetchall())
 
-        all_ids = subs_ids | events_ids | lead_ids
-
-        if filter_type == "with_lead":
-            result = all_ids & lead_ids
-        elif filter_type == "without_lead":
-            result = all_ids - lead_ids
-        else:
-            # "all" и любые неизвестные значения фильтра — шлём всем известным.
-            result = all_ids
-
-        conn.close()
-        return list(result)
-
-    except sqlite3.OperationalError:
-        try:
-            conn.close()
-        except Exception:
-            pass
-        return []
+def count_users_for_broadcast(filter_type: str = "all") -> int:
+    """Размер аудитории рассылки без выборки самих tg_id."""
+    where = _AUDIENCE_WHERE.get(filter_type, "")
+    return _fetchone("SELECT COUNT(*) FROM known_users" + where)[0]
 
 
 def get_subscriptions(limit=10000):
     """Список подписок (первый контакт) для экспорта."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    return _fetchall(
         "SELECT tg_id, username, first_name, last_name, started_at FROM subscriptions ORDER BY started_at DESC LIMIT ?",
         (limit,),
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 # --- Scheduled posts (отложенный постинг) ---
@@ -664,40 +1270,34 @@ def add_scheduled_post(
     button_url: str | None = None,
 ):
     """Создать отложенный пост."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        INSERT INTO scheduled_posts
-        (text, media_type, media_file_id,
-        send_to_channel1, send_to_channel2, send_to_chat, send_to_admins,
-        run_at_utc, status, button_text, button_url)
-        VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'scheduled', ?, ?)
-        """,
-        (
-            text or "",
-            media_type,
-            media_file_id,
-            1 if send_to_channel1 else 0,
-            1 if send_to_channel2 else 0,
-            1 if send_to_chat else 0,
-            1 if send_to_admins else 0,
-            run_at_utc,
-            button_text or None,
-            button_url or None,
-        ),
-    )
-    pid = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return pid
+    with transaction() as cur:
+        cur.execute(
+            """
+            INSERT INTO scheduled_posts
+            (text, media_type, media_file_id,
+            send_to_channel1, send_to_channel2, send_to_chat, send_to_admins,
+            run_at_utc, status, button_text, button_url)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, 'scheduled', ?, ?)
+            """,
+            (
+                text or "",
+                media_type,
+                media_file_id,
+                1 if send_to_channel1 else 0,
+                1 if send_to_channel2 else 0,
+                1 if send_to_chat else 0,
+                1 if send_to_admins else 0,
+                run_at_utc,
+                button_text or None,
+                button_url or None,
+            ),
+        )
+        return cur.lastrowid
 
 
 def get_scheduled_posts(limit: int = 50):
     """Список отложенных постов для админки (последние N штук)."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    return _fetchall(
         """
         SELECT id, text, media_type, media_file_id, send_to_channel1,
                send_to_channel2, send_to_chat, send_to_admins, run_at_utc, status, last_error,
@@ -708,16 +1308,11 @@ def get_scheduled_posts(limit: int = 50):
         """,
         (limit,),
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 def get_due_scheduled_posts(now_utc: str, limit: int = 50):
     """Посты, которые пора отправить (run_at_utc <= now_utc, статус scheduled)."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    return _fetchall(
         """
         SELECT id, text, media_type, media_file_id, send_to_channel1,
                send_to_channel2, send_to_chat, send_to_admins, button_text, button_url
@@ -728,62 +1323,45 @@ def get_due_scheduled_posts(now_utc: str, limit: int = 50):
         """,
         (now_utc, limit),
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 def mark_scheduled_post_status(pid: int, status: str, error: str | None = None):
     """Обновить статус отложенного поста."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """
-        UPDATE scheduled_posts
-        SET status = ?, last_error = ?
-        WHERE id = ?
-        """,
-        (status, (error or "")[:500], pid),
-    )
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute(
+            """
+            UPDATE scheduled_posts
+            SET status = ?, last_error = ?
+            WHERE id = ?
+            """,
+            (status, (error or "")[:500], pid),
+        )
 
 
 def cancel_scheduled_post(pid: int):
     """Удалить отложенный пост полностью."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM scheduled_posts WHERE id = ?", (pid,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("DELETE FROM scheduled_posts WHERE id = ?", (pid,))
 
 
 # --- Autopipeline (onboarding funnel) ---
 
 def get_funnel_steps():
     """Все шаги автоворонки (для админки)."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, order_num, delay_hours, text, media_type, media_file_id, is_active, button_text, button_url "
+    return _fetchall(
+        "SELECT id, order_num, delay_hours, text, media_type, media_file_id, is_active, button_text, button_url, "
+        "activation, spread_hours "
         "FROM funnel_steps ORDER BY delay_hours, order_num, id"
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 def get_active_funnel_steps():
     """Активные шаги автоворонки (для планировщика)."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "SELECT id, order_num, delay_hours, text, media_type, media_file_id, button_text, button_url "
+    return _fetchall(
+        "SELECT id, order_num, delay_hours, text, media_type, media_file_id, button_text, button_url, "
+        "activation, spread_hours, activated_at, changed_at "
         "FROM funnel_steps WHERE is_active = 1 ORDER BY delay_hours, order_num, id"
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 def add_funnel_step(
@@ -793,399 +1371,529 @@ def add_funnel_step(
     media_file_id: str | None = None,
     button_text: str | None = None,
     button_url: str | None = None,
+    activation: str = "all",
+    spread_hours: int = 0,
 ):
-    """Добавить шаг автоворонки."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT COALESCE(MAX(order_num), 0) FROM funnel_steps")
-    max_order = cur.fetchone()[0] or 0
-    order_num = max_order + 1
-    cur.execute(
-        """INSERT INTO funnel_steps (
-               order_num, delay_hours, text, media_type, media_file_id,
-               is_active, button_text, button_url
-           )
-           VALUES (?, ?, ?, ?, ?, 1, ?, ?)""",
-        (
-            order_num,
-            delay_hours,
-            text or "",
-            media_type or None,
-            media_file_id or None,
-            (button_text or None),
-            (button_url or None),
-        ),
-    )
-    sid = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return sid
+    """Добавить шаг автоворонки. activation: all / new / spread (см. миграцию 13)."""
+    now = int(time.time())
+    with transaction() as cur:
+        cur.execute("SELECT COALESCE(MAX(order_num), 0) FROM funnel_steps")
+        max_order = cur.fetchone()[0] or 0
+        order_num = max_order + 1
+        cur.execute(
+            """INSERT INTO funnel_steps (
+                   order_num, delay_hours, text, media_type, media_file_id,
+                   is_active, button_text, button_url,
+                   activation, spread_hours, activated_at, changed_at
+               )
+               VALUES (?, ?, ?, ?, ?, 1, ?, ?, ?, ?, ?, ?)""",
+            (
+                order_num,
+                delay_hours,
+                text or "",
+                media_type or None,
+                media_file_id or None,
+                (button_text or None),
+                (button_url or None),
+                activation,
+                spread_hours,
+                now,
+                now,
+            ),
+        )
+        return cur.lastrowid
 
 
 def update_funnel_step(step_id: int, **kwargs):
-    """Обновить шаг автоворонки."""
+    """Обновить шаг автоворонки.
+
+    Включение шага — новая точка отсчёта для политик new и spread; смена задержки или
+    политики — для spread.
+    """
     if not kwargs:
         return
-    conn = get_conn()
-    cur = conn.cursor()
+    now = int(time.time())
+    if kwargs.get("is_active"):
+        kwargs.update(activated_at=now, changed_at=now)
+    elif kwargs.keys() & {"delay_hours", "activation", "spread_hours"}:
+        kwargs["changed_at"] = now
     cols = list(kwargs.keys())
     vals = list(kwargs.values()) + [step_id]
     sql = "UPDATE funnel_steps SET " + ", ".join(f"{c}=?" for c in cols) + " WHERE id=?"
-    cur.execute(sql, vals)
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute(sql, vals)
 
 
 def delete_funnel_step(step_id: int):
     """Удалить шаг автоворонки (и лог по нему)."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM funnel_log WHERE step_id = ?", (step_id,))
-    cur.execute("DELETE FROM funnel_steps WHERE id = ?", (step_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("DELETE FROM funnel_log WHERE step_id = ?", (step_id,))
+        cur.execute("DELETE FROM funnel_steps WHERE id = ?", (step_id,))
 
 
 def was_funnel_step_sent(tg_id: int, step_id: int) -> bool:
     """Проверить, был ли уже отправлен пользователю указанный шаг автоворонки."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    row = _fetchone(
         "SELECT 1 FROM funnel_log WHERE tg_id = ? AND step_id = ? LIMIT 1",
         (tg_id, step_id),
     )
-    row = cur.fetchone()
-    conn.close()
     return bool(row)
 
 
-def get_funnel_log_sent_set():
-    """Все пары (tg_id, step_id), уже отправленные. Один запрос — чтобы не блокировать БД в цикле."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT tg_id, step_id FROM funnel_log")
-    rows = cur.fetchall()
-    conn.close()
-    return {(r[0], r[1]) for r in rows}
+def mark_funnel_step_sent(tg_id: int, step_id: int):
+    """Отметить шаг автоворонки как отправленный пользователю и в той же транзакции
+    передвинуть его курсор на следующий неотправленный шаг.
+
+    Если шаг удалили, пока он отправлялся, его места в порядке шагов уже нет — курсор
+    ставится на первый неотправленный шаг, как при пересчёте, а не обнуляется."""
+    with transaction() as cur:
+        cur.execute("SELECT 1 FROM funnel_steps WHERE id = ?", (step_id,))
+        if cur.fetchone() is None:
+            cur.execute(
+                f"UPDATE subscriptions SET (funnel_step_id, funnel_due_at) = ({_FUNNEL_FIRST}) WHERE tg_id = ?",
+                (tg_id,),
+            )
+            return
+        cur.execute(
+            "INSERT OR IGNORE INTO funnel_log (tg_id, step_id) VALUES (?, ?)",
+            (tg_id, step_id),
+        )
+        cur.execute(
+            f"UPDATE subscriptions SET (funnel_step_id, funnel_due_at) = ({_FUNNEL_AFTER}) WHERE tg_id = ?",
+            (step_id, tg_id),
+        )
 
 
-def mark_funnel_step_sent(tg_id: int, step_id: int):
-    """Отметить шаг автоворонки как отправленный пользователю."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        "INSERT OR IGNORE INTO funnel_log (tg_id, step_id) VALUES (?, ?)",
-        (tg_id, step_id),
+def get_due_funnel(now: int, limit: int = 100, step_ids: tuple = ()):
+    """Кому пора слать шаг воронки: [(tg_id, step_id)] по времени, не больше limit. Диапазон по индексу.
+    step_ids — только эти шаги (в тихие часы: шаги без задержки)."""
+    only = f" AND funnel_step_id IN ({', '.join('?' * len(step_ids))})" if step_ids else ""
+    return _fetchall(
+        f"SELECT tg_id, funnel_step_id FROM subscriptions WHERE funnel_due_at <= ?{only} "
+        "ORDER BY funnel_due_at LIMIT ?",
+        (now, *step_ids, limit),
     )
-    conn.commit()
-    conn.close()
+
+
+def count_due_funnel(now: int) -> int:
+    """Сколько подписчиков ждут шага воронки к моменту now (для админки: очередь и ETA)."""
+    return _fetchone("SELECT COUNT(*) FROM subscriptions WHERE funnel_due_at <= ?", (now,))[0]
+
+
+def get_next_funnel_due() -> int | None:
+    """Время ближайшей отправки воронки (unix-секунды); None — слать некому."""
+    return _fetchone("SELECT MIN(funnel_due_at) FROM subscriptions WHERE funnel_due_at IS NOT NULL")[0]
+
+
+def postpone_funnel_step(tg_id: int, due_at: int):
+    """Перенести отправку текущего шага (после неудачной попытки)."""
+    with transaction() as cur:
+        cur.execute("UPDATE subscriptions SET funnel_due_at = ? WHERE tg_id = ?", (due_at, tg_id))
+
+
+def reschedule_funnel(after_id: int = 0, batch: int = 20000) -> int | None:
+    """Пересчитать курсоры подписчиков с id в (after_id, after_id + batch] после смены
+    расписания шагов. Пачка — короткая транзакция, между пачками проходят другие записи.
+    Возвращает after_id следующей пачки; None — подписчики кончились."""
+    with transaction() as cur:
+        cur.execute(
+            f"UPDATE subscriptions SET (funnel_step_id, funnel_due_at) = ({_FUNNEL_FIRST}) "
+            "WHERE id > ? AND id <= ?",
+            (after_id, after_id + batch),
+        )
+        cur.execute("SELECT 1 FROM subscriptions WHERE id > ? LIMIT 1", (after_id + batch,))
+        return after_id + batch if cur.fetchone() else None
 
 
 def get_user_utm(tg_id: int):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT utm_source, utm_medium, utm_campaign FROM user_utm WHERE tg_id = ?", (tg_id,))
-    row = cur.fetchone()
-    conn.close()
+    row = _fetchone("SELECT utm_source, utm_medium, utm_campaign FROM user_utm WHERE tg_id = ?", (tg_id,))
     return {"utm_source": row[0], "utm_medium": row[1], "utm_campaign": row[2]} if row else {}
 
 
 def set_setting(key: str, value: str):
+    with transaction() as cur:
+        cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
+
+
+# --- Ретеншн user_events: свёртки, архив, освобождение места ---
+# created_at в user_events — UTC (CURRENT_TIMESTAMP), дни свёрток тоже UTC.
+ARCHIVE_DIR = Path(DATABASE_PATH).parent / "archive"
+# Строк за одну порцию переноса в архив и страниц за один incremental_vacuum
+ARCHIVE_BATCH = 5000
+VACUUM_PAGES = 1000
+# Пауза между порциями: иначе обслуживание сразу снова берёт блокировку,
+# и записи бота из другого потока ждут её по busy_timeout (до секунды и больше)
+MAINTENANCE_PAUSE = 0.05
+
+
+def _utc_day(days_ago: int = 0) -> str:
+    return (datetime.now(timezone.utc) - timedelta(days=days_ago)).strftime("%Y-%m-%d")
+
+
+def _day_after(day: str) -> str:
+    return (datetime.strptime(day, "%Y-%m-%d") + timedelta(days=1)).strftime("%Y-%m-%d")
+
+
+def rollup_user_events(stop=None) -> int:
+    """Свернуть завершённые (до сегодняшнего UTC) дни, ещё не попавшие в свёртки. Возвращает число дней.
+    Каждый день — своя короткая транзакция вместе с отметкой user_events_rolled_until:
+    записи бота ждут не дольше одного дня свёртки, прерванный проход (stop()) продолжится с того же дня."""
+    today = _utc_day()
+    rolled_until = get_setting("user_events_rolled_until", "")
+    day = _day_after(rolled_until) if rolled_until else ""
+    days = 0
+    while day < today:
+        if stop and stop():
+            return days
+        # Следующий день с событиями: пустые дни пропускаются одним поиском по индексу
+        first = _fetchone("SELECT MIN(created_at) FROM user_events WHERE created_at >= ?", (day,))[0]
+        if first is None or first[:10] >= today:
+            break
+        day, next_day = first[:10], _day_after(first[:10])
+        with transaction() as cur:
+            cur.execute(
+                """INSERT INTO user_events_daily (tg_id, day, events)
+                   SELECT tg_id, ?, COUNT(*) FROM user_events
+                   WHERE created_at >= ? AND created_at < ? GROUP BY tg_id
+                   ON CONFLICT(tg_id, day) DO UPDATE SET events = excluded.events""",
+                (day, day, next_day),
+            )
+            cur.execute(
+                """INSERT INTO event_types_daily (day, event_type, events, users)
+                   SELECT ?, t.name, COUNT(*), COUNT(DISTINCT e.tg_id)
+                   FROM user_events e JOIN event_types t ON t.id = e.type_id
+                   WHERE e.created_at >= ? AND e.created_at < ? GROUP BY e.type_id
+                   ON CONFLICT(day, event_type) DO UPDATE SET events = excluded.events, users = excluded.users""",
+                (day, day, next_day),
+            )
+            cur.execute(
+                "INSERT OR REPLACE INTO settings (key, value) VALUES ('user_events_rolled_until', ?)", (day,)
+            )
+        days += 1
+        day = next_day
+        time.sleep(MAINTENANCE_PAUSE)
+    # Дни без событий до вчерашнего включительно тоже считаются свёрнутыми
+    if _utc_day(1) > rolled_until:
+        set_setting("user_events_rolled_until", _utc_day(1))
+    return days
+
+
+def _next_month(month: str) -> str:
+    y, m = (int(x) for x in month.split("-"))
+    return f"{y + m // 12}-{m % 12 + 1:02d}-01"
+
+
+def archive_user_events(retention_days: int, stop=None) -> int:
+    """Перенести сырые события старше retention_days (и только уже свёрнутые дни) в помесячные
+    файлы ARCHIVE_DIR/user_events_YYYY-MM.db. Имена не архивируются — они есть в user_activity.
+    Перенос идемпотентен (INSERT OR IGNORE по id), так что прерванный запуск безопасно повторить.
+    Копия в архив и удаление из основной БД — разные транзакции: в WAL транзакция над двумя
+    файлами не атомарна, поэтому удаляются только строки, которые уже закоммичены в архиве.
+    Переносится порциями по ARCHIVE_BATCH строк, каждая — две короткие транзакции."""
+    rolled_until = get_setting("user_events_rolled_until", "")
+    if not rolled_until:
+        return 0
+    before = min(_utc_day(retention_days), rolled_until)
+    months = [
+        r[0]
+        for r in _fetchall(
+            "SELECT DISTINCT substr(created_at, 1, 7) FROM user_events WHERE created_at < ?", (before,)
+        )
+    ]
+    if not months:
+        return 0
+    ARCHIVE_DIR.mkdir(parents=True, exist_ok=True)
     conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)", (key, value))
-    conn.commit()
-    conn.close()
+    moved = 0
+    for month in months:
+        lo, hi = f"{month}-01", min(_next_month(month), before)
+        conn.execute("ATTACH DATABASE ? AS arc", (str(ARCHIVE_DIR / f"user_events_{month}.db"),))
+        try:
+            with transaction() as cur:
+                cur.execute("""
+                CREATE TABLE IF NOT EXISTS arc.user_events (
+                    id INTEGER PRIMARY KEY,
+                    tg_id INTEGER NOT NULL,
+                    event_type TEXT NOT NULL,
+                    created_at TIMESTAMP,
+                    args TEXT
+                )
+                """)
+                # Архивы до появления event_types — без args
+                if "args" not in {r[1] for r in cur.execute("PRAGMA arc.table_info(user_events)")}:
+                    cur.execute("ALTER TABLE arc.user_events ADD COLUMN args TEXT")
+            chunk = (
+                "SELECT id FROM main.user_events WHERE created_at >= ? AND created_at < ? "
+                "ORDER BY created_at LIMIT ?"
+            )
+            while not (stop and stop()):
+                with transaction() as cur:
+                    cur.execute(
+                        f"""INSERT OR IGNORE INTO arc.user_events (id, tg_id, event_type, args, created_at)
+                           SELECT e.id, e.tg_id, t.name, e.args, e.created_at
+                           FROM main.user_events e JOIN main.event_types t ON t.id = e.type_id
+                           WHERE e.id IN ({chunk})""",
+                        (lo, hi, ARCHIVE_BATCH),
+                    )
+                with transaction() as cur:
+                    cur.execute(
+                        f"""DELETE FROM main.user_events
+                           WHERE id IN ({chunk})
+                             AND EXISTS (SELECT 1 FROM arc.user_events a WHERE a.id = main.user_events.id)""",
+                        (lo, hi, ARCHIVE_BATCH),
+                    )
+                    deleted = cur.rowcount
+                moved += deleted
+                if deleted < ARCHIVE_BATCH:
+                    break
+                time.sleep(MAINTENANCE_PAUSE)
+        finally:
+            conn.execute("DETACH DATABASE arc")
+    return moved
+
+
+def reclaim_free_pages(max_pages: int = VACUUM_PAGES) -> int:
+    """Вернуть ОС до max_pages свободных страниц (PRAGMA incremental_vacuum). Возвращает число страниц.
+    В режим auto_vacuum=INCREMENTAL БД переводит миграция 15; в другом режиме — 0."""
+    if _fetchone("PRAGMA auto_vacuum")[0] != 2:
+        return 0
+    free = _fetchone("PRAGMA freelist_count")[0]
+    # executescript проходит прагму до конца; execute() освободил бы одну страницу за вызов
+    get_conn().executescript(f"PRAGMA incremental_vacuum({int(max_pages)})")
+    return free - _fetchone("PRAGMA freelist_count")[0]
+
+
+def maintain_user_events(retention_days: int, stop=None) -> dict:
+    """Плановое обслуживание user_events: свёртки → архив → освобождение места.
+    Всё идёт короткими порциями; stop() — прервать после текущей порции (остановка бота)."""
+    days = rollup_user_events(stop)
+    moved = archive_user_events(retention_days, stop)
+    pages = 0
+    while moved and not (stop and stop()):
+        freed = reclaim_free_pages()
+        if not freed:
+            break
+        pages += freed
+        time.sleep(MAINTENANCE_PAUSE)
+    return {"rolled_days": days, "archived_rows": moved, "freed_pages": pages}
+
+
+def get_event_type_totals(days: int = 7, limit: int = 10):
+    """Топ типов событий за последние days дней: свёртки + ещё не свёрнутый хвост сырых событий.
+    [(event_type, events, users)]; users по хвосту и свёрткам складываются (оценка сверху)."""
+    since = _utc_day(days)
+    rolled_until = get_setting("user_events_rolled_until", "")
+    tail_from = max(since, _day_after(rolled_until)) if rolled_until else since
+    return _fetchall(
+        """SELECT event_type, SUM(events) AS n, SUM(users) FROM (
+               SELECT event_type, events, users FROM event_types_daily WHERE day >= ? AND day <= ?
+               UNION ALL
+               SELECT t.name, COUNT(*), COUNT(DISTINCT e.tg_id)
+               FROM user_events e JOIN event_types t ON t.id = e.type_id
+               WHERE e.created_at >= ? GROUP BY e.type_id
+           ) GROUP BY event_type ORDER BY n DESC LIMIT ?""",
+        (since, rolled_until or "", tail_from, limit),
+    )
 
 
 # Stories
 def get_visible_stories():
     """Получить видимые сюжеты."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    return _fetchall(
         "SELECT id, title, content, image_url, game_id, order_num "
         "FROM stories WHERE hidden = 0 ORDER BY created_at DESC"
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 def get_all_stories():
     """Получить все сюжеты для админки."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    return _fetchall(
         "SELECT id, title, content, image_url, game_id, order_num, hidden "
         "FROM stories ORDER BY order_num, created_at"
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 def get_story(story_id: int):
     """Получить сюжет по ID."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT * FROM stories WHERE id = ?", (story_id,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return _fetchone("SELECT * FROM stories WHERE id = ?", (story_id,))
 
 
 def add_story(title, content, image_url=None, game_id=None, order_num=0, scenario_id=None):
     """Добавить новый сюжет."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
-        """INSERT INTO stories (title, content, image_url, game_id, order_num, hidden, scenario_id)
-           VALUES (?, ?, ?, ?, ?, 0, ?)""",
-        (title, content or "", image_url or "", game_id, order_num or 0, scenario_id),
-    )
-    sid = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return sid
+    with transaction() as cur:
+        cur.execute(
+            """INSERT INTO stories (title, content, image_url, game_id, order_num, hidden, scenario_id)
+               VALUES (?, ?, ?, ?, ?, 0, ?)""",
+            (title, content or "", image_url or "", game_id, order_num or 0, scenario_id),
+        )
+        return cur.lastrowid
 
 
 def update_story(sid, **kwargs):
     """Обновить сюжет."""
     if not kwargs:
         return
-    conn = get_conn()
-    cur = conn.cursor()
     cols = list(kwargs.keys())
     vals = list(kwargs.values()) + [sid]
     sql = "UPDATE stories SET " + ", ".join(f"{c}=?" for c in cols) + " WHERE id=?"
-    cur.execute(sql, vals)
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute(sql, vals)
 
 
 def toggle_story_visibility(story_id: int):
     """Переключить видимость сюжета."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE stories SET hidden = 1 - hidden WHERE id = ?", (story_id,))
-    cur.execute("SELECT hidden FROM stories WHERE id = ?", (story_id,))
-    h = cur.fetchone()[0]
-    conn.commit()
-    conn.close()
-    return h
+    with transaction() as cur:
+        cur.execute("UPDATE stories SET hidden = 1 - hidden WHERE id = ?", (story_id,))
+        cur.execute("SELECT hidden FROM stories WHERE id = ?", (story_id,))
+        return cur.fetchone()[0]
 
 
 def delete_story(story_id: int):
     """Удалить сюжет."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM stories WHERE id = ?", (story_id,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("DELETE FROM stories WHERE id = ?", (story_id,))
 
 
 # --- Scenarios ---
 
 def add_scenario(name, description=""):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("INSERT INTO scenarios (name, description) VALUES (?, ?)", (name, description))
-    sid = cur.lastrowid
-    conn.commit()
-    conn.close()
-    return sid
+    with transaction() as cur:
+        cur.execute("INSERT INTO scenarios (name, description) VALUES (?, ?)", (name, description))
+        return cur.lastrowid
 
 
 def get_scenarios():
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, description FROM scenarios ORDER BY created_at")
-    rows = cur.fetchall()
-    conn.close()
-    return rows
+    return _fetchall("SELECT id, name, description FROM scenarios ORDER BY created_at")
 
 
 def get_scenario(sid):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("SELECT id, name, description FROM scenarios WHERE id = ?", (sid,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    return _fetchone("SELECT id, name, description FROM scenarios WHERE id = ?", (sid,))
 
 
 def update_scenario(sid, name, description):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("UPDATE scenarios SET name = ?, description = ? WHERE id = ?", (name, description, sid))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("UPDATE scenarios SET name = ?, description = ? WHERE id = ?", (name, description, sid))
 
 
 def delete_scenario(sid):
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute("DELETE FROM stories WHERE scenario_id = ?", (sid,))
-    cur.execute("DELETE FROM scenarios WHERE id = ?", (sid,))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        cur.execute("DELETE FROM stories WHERE scenario_id = ?", (sid,))
+        cur.execute("DELETE FROM scenarios WHERE id = ?", (sid,))
 
 
 def get_stories_by_scenario(scenario_id):
     """Получить сюжеты конкретного сценария."""
-    conn = get_conn()
-    cur = conn.cursor()
-    cur.execute(
+    return _fetchall(
         "SELECT id, title, content, image_url, game_id, order_num, hidden, scenario_id "
         "FROM stories WHERE scenario_id = ? ORDER BY order_num, created_at",
         (scenario_id,)
     )
-    rows = cur.fetchall()
-    conn.close()
-    return rows
 
 
 # --- Format Screens ---
 
 def get_format_screens():
-    conn = get_conn()
-    cur = conn.cursor()
     # Проверяем наличие таблицы (на случай если миграция не прошла)
     try:
-        cur.execute("SELECT id, title, text, video_url FROM format_screens ORDER BY order_num")
-        rows = cur.fetchall()
+        return _fetchall("SELECT id, title, text, video_url FROM format_screens ORDER BY order_num")
     except sqlite3.OperationalError:
         return []
-    conn.close()
-    return rows
 
 
 def update_format_screen(sid, title, text, video_url=None):
-    conn = get_conn()
-    cur = conn.cursor()
-    if video_url is not None:
-        cur.execute("UPDATE format_screens SET title = ?, text = ?, video_url = ? WHERE id = ?", (title, text, video_url, sid))
-    else:
-        cur.execute("UPDATE format_screens SET title = ?, text = ? WHERE id = ?", (title, text, sid))
-    conn.commit()
-    conn.close()
+    with transaction() as cur:
+        if video_url is not None:
+            cur.execute("UPDATE format_screens SET title = ?, text = ?, video_url = ? WHERE id = ?", (title, text, video_url, sid))
+        else:
+            cur.execute("UPDATE format_screens SET title = ?, text = ? WHERE id = ?", (title, text, sid))
 
 
 # --- Format Info (один экран "Что это за формат?") ---
 
 def get_format_info():
     """Получить информацию о формате (один экран). Возвращает (text, image_url, video_url)."""
-    conn = get_conn()
-    cur = conn.cursor()
     try:
-        cur.execute("SELECT text, image_url, video_url FROM format_info WHERE id = 1")
-        row = cur.fetchone()
+        row = _fetchone("SELECT text, image_url, video_url FROM format_info WHERE id = 1")
     except sqlite3.OperationalError:
         try:
-            cur.execute("SELECT text, image_url FROM format_info WHERE id = 1")
-            row = cur.fetchone()
+            row = _fetchone("SELECT text, image_url FROM format_info WHERE id = 1")
             if row:
                 row = (row[0], row[1], None)
         except Exception:
             row = None
-        conn.close()
-        if row:
-            return row[0], row[1], row[2] if len(row) > 2 else None
-        return None, None, None
-    conn.close()
     if row:
-        return row[0], row[1], (row[2] if len(row) > 2 else None)
+        return row[0], row[1], row[2]
     return None, None, None
 
 
 def update_format_info(text=None, image_url=None, video_url=None):
-    conn = get_conn()
-    cur = conn.cursor()
-    if text is not None and image_url is not None and video_url is not None:
-        cur.execute("UPDATE format_info SET text = ?, image_url = ?, video_url = ? WHERE id = 1", (text, image_url, video_url))
-    elif text is not None and image_url is not None:
-        cur.execute("UPDATE format_info SET text = ?, image_url = ? WHERE id = 1", (text, image_url))
-    elif text is not None:
-        cur.execute("UPDATE format_info SET text = ? WHERE id = 1", (text,))
-    elif image_url is not None:
-        cur.execute("UPDATE format_info SET image_url = ? WHERE id = 1", (image_url,))
-    elif video_url is not None:
-        cur.execute("UPDATE format_info SET video_url = ? WHERE id = 1", (video_url,))
-    conn.commit()
-    conn.close()
-
-
-def seed_format_screens():
-    """Заполняет экраны формата, если пусто."""
-    conn = get_conn()
-    cur = conn.cursor()
-    try:
-        cur.execute("SELECT COUNT(*) FROM format_screens")
-        if cur.fetchone()[0] > 0:
-            conn.close()
-            return
-    except sqlite3.OperationalError:
-        conn.close()
-        return
+    with transaction() as cur:
+        if text is not None and image_url is not None and video_url is not None:
+            cur.execute("UPDATE format_info SET text = ?, image_url = ?, video_url = ? WHERE id = 1", (text, image_url, video_url))
+        elif text is not None and image_url is not None:
+            cur.execute("UPDATE format_info SET text = ?, image_url = ? WHERE id = 1", (text, image_url))
+        elif text is not None:
+            cur.execute("UPDATE format_info SET text = ? WHERE id = 1", (text,))
+        elif image_url is not None:
+            cur.execute("UPDATE format_info SET image_url = ? WHERE id = 1", (image_url,))
+        elif video_url is not None:
+            cur.execute("UPDATE format_info SET video_url = ? WHERE id = 1", (video_url,))
 
-    # Данные из handlers/format_funnel.py
-    screens = [
-        ("Что за формат?", "Сюжетная игра (ролевой квест) — это как фильм, только ты внутри истории.\n\nТебе дают роль и цель, дальше события разворачиваются через общение и решения. Ведущий всё ведёт и помогает."),
-        ("Не с кем?", "Если не с кем выбраться в люди — это идеальный формат.\n\nМожно прийти одному/одной: тебя мягко включат в игру, и компания появляется сама."),
-        ("Знакомства без кринжа", "Здесь не нужно «знакомиться специально».\n\nЕсть сюжет и общая задача — разговор начинается сам, и всё получается естественно."),
-        ("Надоело одно и то же", "Если устал(а) от «бар/кино/просто посидеть» — это другой уровень досуга.\n\nВместо фона — эмоции, интрига, смех и ощущение «вау, было не как обычно»."),
-        ("Я не умею / я интроверт", "Никакого опыта не нужно. Не надо быть актёром и «играть роль».\n\nПравила простые, включиться можно спокойно — ведущий подскажет, как комфортно участвовать."),
-        ("Хочу свою тусовку в ЕКБ", "Мы собираем комьюнити в Екатеринбурге: регулярные встречи и «свои» люди.\n\nМожно просто вступить в чат, познакомиться и выбрать удобную дату."),
-        ("Готов(а) попробовать?", "Частая реакция после первой игры:\n«Пришёл(ла) без ожиданий — втянулся(ась) за 10 минут и ушёл(ла) с новыми знакомыми».\n\nГотов(а) попробовать? Выбирай: записаться на ближайшую игру или зайти в чат.")
-    ]
-    
-    video_url = "https://www.youtube.com/watch?v=x3Ir917gDiM&list=PLDqVqfBsY9O-fPcm-pK-TpYWfnuJWSBFI"
-    
-    for i, (title, text) in enumerate(screens):
-        v_url = video_url if i in [0, 1, 2] else None
-        cur.execute(
-            "INSERT INTO format_screens (title, text, order_num, video_url) VALUES (?, ?, ?, ?)",
-            (title, text, i, v_url)
-        )
-    conn.commit()
-    conn.close()
+
+# --- Реестр картинок (file_id по URL) ---
+
+def get_media_files() -> dict:
+    """{url: file_id} — картинки, уже загруженные в Telegram."""
+    return dict(_fetchall("SELECT url, file_id FROM media_files"))
+
+
+def save_media_file(url: str, file_id: str):
+    with transaction() as cur:
+        cur.execute("INSERT OR REPLACE INTO media_files (url, file_id) VALUES (?, ?)", (url, file_id))
+
+
+def delete_media_file(url: str):
+    with transaction() as cur:
+        cur.execute("DELETE FROM media_files WHERE url = ?", (url,))
+
+
+def get_image_urls() -> list:
+    """Картинки по URL из видимых сюжетов и «Что за формат» — для прогрева при запуске."""
+    rows = _fetchall(
+        "SELECT image_url FROM stories WHERE hidden = 0 AND image_url LIKE 'http%' "
+        "UNION SELECT image_url FROM format_info WHERE image_url LIKE 'http%'"
+    )
+    return sorted({r[0].strip() for r in rows})
 
 
 def swap_story_order(story_id, direction):
     """Меняет порядок сюжета (direction: 'up' или 'down')."""
-    conn = get_conn()
-    cur = conn.cursor()
-    
-    # Получаем текущий сюжет
-    cur.execute("SELECT id, order_num, scenario_id FROM stories WHERE id = ?", (story_id,))
-    current = cur.fetchone()
-    if not current:
-        conn.close()
-        return
-        
-    sid, order_num, scenario_id = current
-    
-    # Ищем соседа
-    if direction == 'up':
-        # Тот, у кого order_num меньше текущего (максимальный из меньших)
-        cur.execute(
-            "SELECT id, order_num FROM stories WHERE scenario_id = ? AND order_num < ? ORDER BY order_num DESC LIMIT 1",
-            (scenario_id, order_num)
-        )
-    else: # down
-        # Тот, у кого order_num больше текущего (минимальный из больших)
-        cur.execute(
-            "SELECT id, order_num FROM stories WHERE scenario_id = ? AND order_num > ? ORDER BY order_num ASC LIMIT 1",
-            (scenario_id, order_num)
-        )
-        
-    neighbor = cur.fetchone()
-    if neighbor:
-        nid, n_order = neighbor
-        # Меняем местами order_num
-        cur.execute("UPDATE stories SET order_num = ? WHERE id = ?", (n_order, sid))
-        cur.execute("UPDATE stories SET order_num = ? WHERE id = ?", (order_num, nid))
-        conn.commit()
-        
-    conn.close()
+    with transaction() as cur:
+        # Получаем текущий сюжет
+        cur.execute("SELECT id, order_num, scenario_id FROM stories WHERE id = ?", (story_id,))
+        current = cur.fetchone()
+        if not current:
+            return
+
+        sid, order_num, scenario_id = current
+
+        # Ищем соседа
+        if direction == 'up':
+            # Тот, у кого order_num меньше текущего (максимальный из меньших)
+            cur.execute(
+                "SELECT id, order_num FROM stories WHERE scenario_id = ? AND order_num < ? ORDER BY order_num DESC LIMIT 1",
+                (scenario_id, order_num)
+            )
+        else: # down
+            # Тот, у кого order_num больше текущего (минимальный из больших)
+            cur.execute(
+                "SELECT id, order_num FROM stories WHERE scenario_id = ? AND order_num > ? ORDER BY order_num ASC LIMIT 1",
+                (scenario_id, order_num)
+            )
+
+        neighbor = cur.fetchone()
+        if neighbor:
+            nid, n_order = neighbor
+            # Меняем местами order_num
+            cur.execute("UPDATE stories SET order_num = ? WHERE id = ?", (n_order, sid))
+            cur.execute("UPDATE stories SET order_num = ? WHERE id = ?", (order_num, nid))
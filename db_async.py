@@ -0,0 +1,208 @@
+"""Асинхронный доступ к БД для хэндлеров.
+
+Чтение идёт в ограниченном пуле потоков, запись — в одном выделенном потоке-писателе
+через его очередь. Event loop никогда не ждёт SQLite (busy_timeout до 10 с), а записи
+не конкурируют между собой за блокировку БД.
+Плановое обслуживание user_events идёт в своём потоке (и своём соединении) короткими
+транзакциями: очередь писателя за ним не стоит.
+"""
+import asyncio
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import wraps
+
+import database
+
+READ_WORKERS = 4
+
+
+class _Lane:
+    """Пул потоков + метрики: глубина очереди и время ожидания до начала выполнения."""
+
+    def __init__(self, name: str, workers: int):
+        self.name = name
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix=f"db-{name}")
+        self._lock = threading.Lock()
+        self.queued = 0
+        self.running = 0
+        self.done = 0
+        self.errors = 0
+        self.wait_total = 0.0
+        self.wait_max = 0.0
+
+    def _call(self, enqueued_at: float, func, args, kwargs):
+        wait = time.perf_counter() - enqueued_at
+        with self._lock:
+            self.queued -= 1
+            self.running += 1
+            self.wait_total += wait
+            if wait > self.wait_max:
+                self.wait_max = wait
+        try:
+            return func(*args, **kwargs)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        finally:
+            with self._lock:
+                self.running -= 1
+                self.done += 1
+
+    def submit(self, func, *args, **kwargs) -> Future:
+        with self._lock:
+            self.queued += 1
+        return self._executor.submit(self._call, time.perf_counter(), func, args, kwargs)
+
+    async def run(self, func, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(func, *args, **kwargs))
+
+    def stats(self) -> dict:
+        with self._lock:
+            done = self.done
+            return {
+                "queued": self.queued,
+                "running": self.running,
+                "done": done,
+                "errors": self.errors,
+                "wait_avg_ms": (self.wait_total / done * 1000) if done else 0.0,
+                "wait_max_ms": self.wait_max * 1000,
+            }
+
+    def shutdown(self):
+        self._executor.shutdown(wait=True)
+
+
+_reads = _Lane("read", READ_WORKERS)
+_writes = _Lane("write", 1)
+_maintenance = _Lane("maintenance", 1)
+_stopping = threading.Event()
+
+
+async def run_read(func, *args, **kwargs):
+    """Выполнить произвольную читающую функцию в пуле чтения."""
+    return await _reads.run(func, *args, **kwargs)
+
+
+async def run_write(func, *args, **kwargs):
+    """Выполнить произвольную пишущую функцию в потоке-писателе."""
+    return await _writes.run(func, *args, **kwargs)
+
+
+def submit_write(func, *args, **kwargs) -> Future:
+    """Поставить запись в очередь писателя, не дожидаясь результата."""
+    return _writes.submit(func, *args, **kwargs)
+
+
+def stats() -> dict:
+    return {"read": _reads.stats(), "write": _writes.stats(), "maintenance": _maintenance.stats()}
+
+
+def shutdown():
+    """Дождаться записи всего, что уже в очереди (при остановке бота); обслуживание
+    прерывается после текущей порции."""
+    _stopping.set()
+    _maintenance.shutdown()
+    _reads.shutdown()
+    _writes.shutdown()
+
+
+def _reader(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await _reads.run(func, *args, **kwargs)
+    return wrapper
+
+
+def _writer(func):
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        return await _writes.run(func, *args, **kwargs)
+    return wrapper
+
+
+# Games
+get_visible_games = _reader(database.get_visible_games)
+get_visible_games_page = _reader(database.get_visible_games_page)
+get_all_games = _reader(database.get_all_games)
+get_game = _reader(database.get_game)
+add_game = _writer(database.add_game)
+update_game = _writer(database.update_game)
+toggle_game_visibility = _writer(database.toggle_game_visibility)
+delete_game = _writer(database.delete_game)
+
+# Leads / questions / orders
+add_lead = _writer(database.add_lead)
+get_leads = _reader(database.get_leads)
+add_question = _writer(database.add_question)
+add_holiday_order = _writer(database.add_holiday_order)
+get_holiday_orders = _reader(database.get_holiday_orders)
+
+# Users
+save_user_utm = _writer(database.save_user_utm)
+get_user_utm = _reader(database.get_user_utm)
+add_subscription = _writer(database.add_subscription)
+log_user_event = _writer(database.log_user_event)
+log_user_events = _writer(database.log_user_events)
+
+
+async def maintain_user_events(retention_days: int) -> dict:
+    return await _maintenance.run(database.maintain_user_events, retention_days, _stopping.is_set)
+
+
+get_event_type_totals = _reader(database.get_event_type_totals)
+get_users_for_broadcast = _reader(database.get_users_for_broadcast)
+count_users_for_broadcast = _reader(database.count_users_for_broadcast)
+get_subscriptions = _reader(database.get_subscriptions)
+
+# Settings
+get_setting = _reader(database.get_setting)
+set_setting = _writer(database.set_setting)
+
+# Scheduled posts
+add_scheduled_post = _writer(database.add_scheduled_post)
+get_scheduled_posts = _reader(database.get_scheduled_posts)
+get_due_scheduled_posts = _reader(database.get_due_scheduled_posts)
+mark_scheduled_post_status = _writer(database.mark_scheduled_post_status)
+cancel_scheduled_post = _writer(database.cancel_scheduled_post)
+
+# Funnel
+get_funnel_steps = _reader(database.get_funnel_steps)
+get_active_funnel_steps = _reader(database.get_active_funnel_steps)
+add_funnel_step = _writer(database.add_funnel_step)
+update_funnel_step = _writer(database.update_funnel_step)
+delete_funnel_step = _writer(database.delete_funnel_step)
+mark_funnel_step_sent = _writer(database.mark_funnel_step_sent)
+get_due_funnel = _reader(database.get_due_funnel)
+get_next_funnel_due = _reader(database.get_next_funnel_due)
+count_due_funnel = _reader(database.count_due_funnel)
+postpone_funnel_step = _writer(database.postpone_funnel_step)
+reschedule_funnel = _writer(database.reschedule_funnel)
+
+# Stories / scenarios
+get_all_stories = _reader(database.get_all_stories)
+get_story = _reader(database.get_story)
+add_story = _writer(database.add_story)
+update_story = _writer(database.update_story)
+toggle_story_visibility = _writer(database.toggle_story_visibility)
+delete_story = _writer(database.delete_story)
+swap_story_order = _writer(database.swap_story_order)
+get_stories_by_scenario = _reader(database.get_stories_by_scenario)
+add_scenario = _writer(database.add_scenario)
+get_scenarios = _reader(database.get_scenarios)
+get_scenario = _reader(database.get_scenario)
+update_scenario = _writer(database.update_scenario)
+delete_scenario = _writer(database.delete_scenario)
+
+# Format
+get_format_screens = _reader(database.get_format_screens)
+update_format_screen = _writer(database.update_format_screen)
+get_format_info = _reader(database.get_format_info)
+update_format_info = _writer(database.update_format_info)
+
+# Media registry
+get_media_files = _reader(database.get_media_files)
+save_media_file = _writer(database.save_media_file)
+delete_media_file = _writer(database.delete_media_file)
+get_image_urls = _reader(database.get_image_urls)
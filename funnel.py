@@ -0,0 +1,250 @@
+"""Планировщик автоворонки поверх курсора в БД.
+
+У каждого подписчика в subscriptions — следующий неотправленный шаг и время его
+отправки (funnel_step_id, funnel_due_at). Воркер берёт подошедших одним запросом
+по частичному индексу и спит ровно до ближайшего funnel_due_at; новая подписка
+будит его. Отметка об отправке сдвигает курсор в той же транзакции.
+Пересчёт всех курсоров — только при смене расписания шагов (шаг добавлен, удалён,
+включён/выключен, сменилась задержка или политика); правка текста лишь подменяет содержимое шага.
+Каждый активный шаг собирается в готовое сообщение (HTML, части, кнопка) один раз на версию
+контента «funnel» — её меняет любая правка funnel_steps; воркер только берёт его и отправляет.
+
+Темп отправки — маркерное ведро (acquire): FUNNEL_SEND_RATE сообщений в секунду,
+до FUNNEL_CONCURRENCY отправок одновременно. После RetryAfter отправки ждут его
+окончания, а темп падает вдвое и затем плавно восстанавливается; пока пользователи
+активно нажимают кнопки, воронка уступает им часть лимита Bot API.
+
+Политика шага (activation) задаётся при добавлении и правке: new — шаг получают только
+подписавшиеся после его включения; spread — тем, у кого срок уже прошёл, шаг уходит
+равномерно за spread_hours, а не всем сразу. В тихие часы (FUNNEL_QUIET_HOURS по
+FUNNEL_TIMEZONE) уходят только шаги «сразу» — ответ на /start не ждёт утра; остальные
+копятся до конца тихих часов.
+"""
+import asyncio
+import time
+from datetime import datetime, timedelta
+from zoneinfo import ZoneInfo
+
+import database
+import db_async
+import outbound
+from config import FUNNEL_CONCURRENCY, FUNNEL_QUIET_HOURS, FUNNEL_SEND_RATE, FUNNEL_TIMEZONE
+from middlewares.user_log import event_log
+
+# Дольше не спим: правка шагов из другого процесса заметится не позже
+MAX_SLEEP = 60
+# Через сколько повторить шаг, который не удалось отправить
+RETRY_DELAY = 60
+
+# Ниже этого темпа воронка не опускается ни при RetryAfter, ни при наплыве пользователей
+MIN_RATE = 1.0
+# За сколько секунд темп восстанавливается от минимума до FUNNEL_SEND_RATE
+RECOVERY_SECONDS = 60
+# Сколько запросов к Bot API в среднем порождает одно действие пользователя (ответ + правка экрана)
+CALLS_PER_ACTION = 2
+
+_tz = ZoneInfo(FUNNEL_TIMEZONE)
+
+_payloads: dict = {}  # step_id -> готовое к отправке сообщение активного шага
+_immediate: tuple = ()  # шаги без задержки и растягивания — их шлём и в тихие часы
+_schedule = None  # задержки и политики активных шагов — при смене курсоры пересчитываются
+_version = None
+_wakeup = asyncio.Event()
+_reschedules = 0
+
+_inflight: dict = {}  # tg_id -> задача отправки
+_rate = FUNNEL_SEND_RATE  # темп после RetryAfter (AIMD), без учёта нагрузки
+_tokens = 0.0
+_refilled = time.monotonic()
+_flood_seen = 0.0
+_load = 0.0  # действий пользователей в секунду (сглаженное)
+_load_at = time.monotonic()
+_load_count = 0
+_sent = 0
+_throttled = 0
+
+
+async def refresh():
+    """Сверить шаги с версией контента «funnel» (дёшево, если ничего не менялось)."""
+    global _payloads, _immediate, _schedule, _version, _reschedules
+    version = database.content_version("funnel")
+    if version == _version:
+        return
+    steps = await db_async.get_active_funnel_steps()
+    # id:delay_hours:activation:spread_hours:activated_at:changed_at
+    schedule = ",".join(":".join(map(str, (s[0], s[2], *s[8:12]))) for s in steps)
+    if _schedule is None:
+        # Расписание, под которое посчитаны курсоры; записи нет — их только что посчитала миграция
+        _schedule = await db_async.get_setting("funnel_schedule", None)
+        if _schedule is None:
+            _schedule = schedule
+            await db_async.set_setting("funnel_schedule", schedule)
+    if schedule != _schedule:
+        after_id = 0
+        while after_id is not None:
+            after_id = await db_async.reschedule_funnel(after_id)
+        # Запоминаем после пересчёта: прерванный пересчёт повторится при следующем запуске
+        await db_async.set_setting("funnel_schedule", schedule)
+        _reschedules += 1
+    _payloads = {s[0]: _compile(s) for s in steps}
+    _immediate = tuple(s[0] for s in steps if s[2] == 0 and s[8] != "spread")
+    _schedule = schedule
+    _version = version
+
+
+def subscribed():
+    """Новый подписчик (/start впервые): его курсор уже в БД — разбудить воркер."""
+    _wakeup.set()
+
+
+def _compile(step) -> outbound.OutboundMessage:
+    text, media_type, media_file_id, button_text, button_url = step[3:8]
+    return outbound.make_message(
+        text or "", media_type, media_file_id, reply_markup=outbound.url_button_markup(button_text, button_url)
+    )
+
+
+def payload(step_id: int) -> outbound.OutboundMessage | None:
+    """Готовое сообщение активного шага; None — шаг удалён или выключен."""
+    return _payloads.get(step_id)
+
+
+def quiet_remaining(now: datetime | None = None) -> float:
+    """Сколько секунд осталось до конца тихих часов; 0 — сейчас не тихие часы."""
+    if not FUNNEL_QUIET_HOURS:
+        return 0.0
+    start, end = FUNNEL_QUIET_HOURS
+    local = now.astimezone(_tz) if now else datetime.now(_tz)
+    hour = local.hour
+    quiet = start <= hour < end if start < end else (hour >= start or hour < end)
+    if not quiet:
+        return 0.0
+    until = local.replace(hour=end, minute=0, second=0, microsecond=0)
+    if until <= local:
+        until += timedelta(days=1)
+    return (until - local).total_seconds()
+
+
+async def due(limit: int = 100):
+    """[(tg_id, step_id)], кому пора слать, по времени; без тех, кому отправка уже идёт.
+    В тихие часы — только шаги «сразу»."""
+    step_ids = ()
+    if quiet_remaining():
+        if not _immediate:
+            return []
+        step_ids = _immediate
+    rows = await db_async.get_due_funnel(int(time.time()), limit + len(_inflight), step_ids)
+    return [(tg_id, step_id) for tg_id, step_id in rows if tg_id not in _inflight][:limit]
+
+
+async def backlog() -> int:
+    """Сколько подписчиков ждут отправки прямо сейчас."""
+    return await db_async.count_due_funnel(int(time.time()))
+
+
+def _interactive_load(now: float) -> float:
+    """Действий пользователей в секунду по счётчику лога действий, сглажено за несколько секунд."""
+    global _load, _load_at, _load_count
+    count = event_log.enqueued + event_log.dropped
+    elapsed = now - _load_at
+    if elapsed >= 1.0:
+        _load = 0.5 * _load + 0.5 * (count - _load_count) / elapsed
+        _load_at, _load_count = now, count
+    return _load
+
+
+def current_rate(now: float | None = None) -> float:
+    """Темп воронки сейчас, сообщений в секунду."""
+    global _rate, _flood_seen, _throttled
+    now = time.monotonic() if now is None else now
+    if outbound.flood_until > _flood_seen:
+        # Новый RetryAfter: мультипликативное снижение
+        _flood_seen = outbound.flood_until
+        _rate = max(MIN_RATE, _rate / 2)
+        _throttled += 1
+    rate = _rate - CALLS_PER_ACTION * _interactive_load(now)
+    return max(MIN_RATE, min(rate, FUNNEL_SEND_RATE))
+
+
+async def acquire():
+    """Дождаться права на следующую отправку: свободное место среди одновременных и маркер."""
+    global _tokens, _refilled, _rate
+    while len(_inflight) >= FUNNEL_CONCURRENCY:
+        await asyncio.wait(set(_inflight.values()), return_when=asyncio.FIRST_COMPLETED)
+    while True:
+        now = time.monotonic()
+        if outbound.flood_until > now:
+            await asyncio.sleep(outbound.flood_until - now)
+            continue
+        rate = current_rate(now)
+        elapsed = now - _refilled
+        _refilled = now
+        # Аддитивное восстановление после RetryAfter
+        _rate = min(FUNNEL_SEND_RATE, _rate + elapsed * FUNNEL_SEND_RATE / RECOVERY_SECONDS)
+        _tokens = min(max(rate, 1.0), _tokens + elapsed * rate)
+        if _tokens >= 1.0:
+            _tokens -= 1.0
+            return
+        await asyncio.sleep((1.0 - _tokens) / rate)
+
+
+def start(tg_id: int, coro):
+    """Запустить отправку подписчику; пока она идёт, due() его не вернёт."""
+    global _sent
+    task = asyncio.create_task(coro)
+    _inflight[tg_id] = task
+    _sent += 1
+
+    def _done(t):
+        _inflight.pop(tg_id, None)
+        if not t.cancelled() and t.exception() is not None:
+            print(f"Ошибка отправки шага автоворонки tg_id={tg_id}: {t.exception()}")
+
+    task.add_done_callback(_done)
+
+
+async def drain(timeout: float):
+    """Дождаться начатых отправок (при остановке бота), не дольше timeout."""
+    if _inflight:
+        await asyncio.wait(set(_inflight.values()), timeout=timeout)
+
+
+async def retry_later(tg_id: int):
+    await db_async.postpone_funnel_step(tg_id, int(time.time()) + RETRY_DELAY)
+
+
+async def wait():
+    """Спать до ближайшей отправки (не дольше MAX_SLEEP) или до новой подписки.
+    Если подошедшие уже отправляются — до окончания одной из отправок; в тихие часы —
+    до их конца или до новой подписки."""
+    if _inflight:
+        await asyncio.wait(set(_inflight.values()), timeout=MAX_SLEEP, return_when=asyncio.FIRST_COMPLETED)
+        return
+    quiet = quiet_remaining()
+    if quiet:
+        # Ближайшая отправка может быть уже просрочена ночью — ориентируемся на конец тихих часов
+        delay = min(quiet, MAX_SLEEP)
+    else:
+        next_due = await db_async.get_next_funnel_due()
+        delay = MAX_SLEEP
+        if next_due is not None:
+            delay = min(delay, max(next_due - time.time(), 0))
+    try:
+        await asyncio.wait_for(_wakeup.wait(), timeout=delay)
+    except asyncio.TimeoutError:
+        pass
+    _wakeup.clear()
+
+
+def stats() -> dict:
+    return {
+        "steps": len(_payloads),
+        "reschedules": _reschedules,
+        "rate": current_rate(),
+        "max_rate": FUNNEL_SEND_RATE,
+        "load": _load,
+        "inflight": len(_inflight),
+        "sent": _sent,
+        "throttled": _throttled,
+        "quiet": quiet_remaining(),
+    }
@@ -14,17 +14,25 @@ from aiogram.types import (
     InputMediaPhoto,
 )
 
-from config import ADMIN_IDS, POST_CHANNEL_1, POST_CHANNEL_2, POST_CHAT_ID
+from config import ADMIN_IDS, FUNNEL_QUIET_HOURS, POST_CHANNEL_1, POST_CHANNEL_2, POST_CHAT_ID
 from datetime import datetime
 from zoneinfo import ZoneInfo
-from utils import broadcast_text_to_html, normalize_telegram_button_url
-from database import (
+from utils import broadcast_text_to_html, normalize_telegram_button_url, parse_game_date, parse_game_time
+import cache
+import funnel
+import media
+import outbound
+import screens
+import db_async
+from database import iter_users_for_export
+from middlewares.user_log import event_log
+from db_async import (
     get_all_games,
     get_leads,
     get_subscriptions,
     get_holiday_orders,
-    get_users_for_export,
     get_users_for_broadcast,
+    count_users_for_broadcast,
     add_game,
     update_game,
     get_game,
@@ -57,6 +65,7 @@ from database import (
     get_scheduled_posts,
     add_scheduled_post,
     cancel_scheduled_post,
+    get_event_type_totals,
 )
 
 router = Router()
@@ -105,11 +114,13 @@ class AdminBroadcastStates(StatesGroup):
 
 class AdminFunnelStates(StatesGroup):
     add_delay = State()
+    add_activation = State()
     add_content = State()
     add_button_text = State()
     add_button_url = State()
     review = State()  # как отложенный пост: предпросмотр + готово
     edit_delay = State()
+    edit_activation = State()
     edit_content = State()
     edit_button_text = State()
     edit_button_url = State()
@@ -154,14 +165,75 @@ async def cmd_admin(message: types.Message):
     await message.answer("Админ-панель:", reply_markup=kb)
 
 
-def _games_list_kb():
-    games = get_all_games()
+def _stats_text(event_totals) -> str:
+    """Технические метрики бота для /stats."""
+    lines = ["📊 Метрики\n", "БД (очередь / в работе / выполнено / ошибки, ожидание ср./макс.):"]
+    for lane, st in db_async.stats().items():
+        lines.append(
+            f"• {lane}: {st['queued']} / {st['running']} / {st['done']} / {st['errors']}, "
+            f"{st['wait_avg_ms']:.1f} / {st['wait_max_ms']:.1f} мс"
+        )
+    cs = cache.stats()
+    lines.append(
+        f"\nКэш контента: попаданий {cs['hits']}, промахов {cs['misses']} ({cs['hit_rate']:.0%}), "
+        f"записей {cs['entries']}, версии {cs['versions']}, "
+        f"готовых экранов {cs['render_hits']}/{cs['render_hits'] + cs['render_misses']}, "
+        f"проверок data_version {cs['version_checks']}, перечитываний {cs['version_reloads']}"
+    )
+    sc = screens.stats()
+    lines.append(
+        f"\nНавигация: переходов {sc['navigations']}, вызовов API {sc['api_calls']} "
+        f"({sc['calls_per_nav']:.2f} на переход), переотправок {sc['resends']}"
+    )
+    ob = outbound.stats()
+    lines.append(
+        f"Исходящие: доставлено {ob.get('sent', 0)}, заблокировали бота {ob.get('blocked', 0)}, "
+        f"ошибок {ob.get('failed', 0)}, RetryAfter {ob.get('retry_after', 0)}, таймаутов {ob.get('timeouts', 0)}, "
+        f"без разметки {ob.get('parse_fallbacks', 0)}"
+    )
+    fn = funnel.stats()
+    lines.append(
+        f"Автоворонка: темп {fn['rate']:.1f}/{fn['max_rate']:.0f} сообщ./с, действий пользователей "
+        f"{fn['load']:.1f}/с, отправляется {fn['inflight']}, начато {fn['sent']}, "
+        f"снижений после RetryAfter {fn['throttled']}, пересчётов расписания {fn['reschedules']}"
+    )
+    md = media.stats()
+    lines.append(
+        f"Картинки: file_id {md['files']}, по file_id {md['hits']}, по URL {md['misses']}, загружено {md['uploads']}"
+    )
+    ev = event_log.stats()
+    lines.append(
+        f"\nЛог действий ({ev['policy']}): в очереди {ev['queued']}, записано {ev['flushed']} "
+        f"пачками {ev['batches']}, отброшено {ev['dropped']}, ошибок {ev['errors']}, "
+        f"последняя запись {ev['last_flush_ms']:.1f} мс"
+    )
+    if event_totals:
+        lines.append("\nСобытия за 7 дней (событий / пользователей):")
+        lines += [f"• {et}: {n} / {users}" for et, n, users in event_totals]
+    return "\n".join(lines)
+
+
+@router.message(Command("stats"))
+async def cmd_stats(message: types.Message):
+    if message.from_user.id not in ADMIN_IDS:
+        return
+    await message.answer(_stats_text(await get_event_type_totals(7)))
+
+
+# Игры с нераспознанной датой не попадают в расписание, пока дату не исправят
+_DATE_WARN = " ⚠️ дата не распознана"
+_DATE_ERROR = "Не понял дату. Формат: ДД.ММ.ГГГГ, например 20.02.2026:"
+_TIME_ERROR = "Не понял время. Формат: ЧЧ:ММ, например 19:00, или «пропустить»:"
+
+
+async def _games_list_kb():
+    games = await get_all_games()
     text = "Игры:\n\n"
     kb = []
     for g in games:
         gid, name, date, time, place, price, desc, limit, hidden = g
         status = "❌" if hidden else "✅"
-        text += f"{status} {name} — {date}\n"
+        text += f"{status} {name} — {date}{_DATE_WARN if parse_game_date(date) is None else ''}\n"
         kb.append([
             InlineKeyboardButton(text=f"{'✅ Показать' if hidden else '❌ Скрыть'}", callback_data=f"adm_toggle_{gid}"),
             InlineKeyboardButton(text="🗑 Удалить", callback_data=f"adm_delete_{gid}"),
@@ -178,7 +250,8 @@ def _schedule_edit_kb(games):
     for g in games:
         gid, name, date, time, place, price, desc, limit, hidden = g
         status = "❌" if hidden else "✅"
-        text += f"{status} {name} — {date}" + (f" {time}" if time else "") + "\n"
+        text += f"{status} {name} — {date}" + (f" {time}" if time else "")
+        text += (_DATE_WARN if parse_game_date(date) is None else "") + "\n"
         kb.append([
             InlineKeyboardButton(text="✏️", callback_data=f"adm_edit_{gid}"),
             InlineKeyboardButton(text=f"{'✅' if hidden else '❌'}", callback_data=f"adm_toggle_s_{gid}"),
@@ -189,7 +262,7 @@ def _schedule_edit_kb(games):
 
 
 async def _refresh_games_list(message: types.Message):
-    text, kb = _games_list_kb()
+    text, kb = await _games_list_kb()
     await message.edit_text(text, reply_markup=kb)
 
 
@@ -198,7 +271,7 @@ async def admin_games_list(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer()
         return
-    text, kb = _games_list_kb()
+    text, kb = await _games_list_kb()
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer()
 
@@ -209,7 +282,7 @@ async def admin_schedule_list(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer()
         return
     await state.clear()
-    games = get_all_games()
+    games = await get_all_games()
     text, kb = _schedule_edit_kb(games)
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer()
@@ -236,7 +309,7 @@ async def admin_edit_game(callback: types.CallbackQuery):
         await callback.answer()
         return
     gid = int(callback.data.split("_")[2])
-    row = get_game(gid)
+    row = await get_game(gid)
     if not row:
         await callback.answer("Игра не найдена", show_alert=True)
         return
@@ -281,9 +354,9 @@ async def admin_edit_field_skip(callback: types.CallbackQuery, state: FSMContext
     data = await state.get_data()
     gid, field = data["edit_gid"], data["edit_field"]
     val = "" if field != "limit_places" else 0
-    update_game(gid, **{field: val})
+    await update_game(gid, **{field: val})
     await state.clear()
-    row = get_game(gid)
+    row = await get_game(gid)
     g = row
     _, name, date, time, place, price, desc, limit, hidden = g[:9]
     text = f"✏️ Редактировать: {name}\n\n{date} {time or ''}\n📍 {place or '—'}\n💰 {price or '—'}\n\n{desc or '—'}\nЛимит: {limit}"
@@ -303,13 +376,21 @@ async def admin_edit_field_value(message: types.Message, state: FSMContext):
             val = int(val or "0")
         except ValueError:
             val = 0
-    elif field == "game_time" and val.lower() in ("пропустить", "-", ""):
-        val = ""
+    elif field == "game_date":
+        val = parse_game_date(val)
+        if val is None:
+            await message.answer(_DATE_ERROR)
+            return
+    elif field == "game_time":
+        val = "" if val.lower() in ("пропустить", "-", "") else parse_game_time(val)
+        if val is None:
+            await message.answer(_TIME_ERROR)
+            return
     elif field in ("place", "price", "description") and val.lower() in ("пропустить", "-", ""):
         val = ""
-    update_game(gid, **{field: val})
+    await update_game(gid, **{field: val})
     await state.clear()
-    row = get_game(gid)
+    row = await get_game(gid)
     g = row
     _, name, date, time, place, price, desc, limit, hidden = g[:9]
     text = f"✏️ Редактировать: {name}\n\n{date} {time or ''}\n📍 {place or '—'}\n💰 {price or '—'}\n\n{desc or '—'}\nЛимит: {limit}"
@@ -317,7 +398,7 @@ async def admin_edit_field_value(message: types.Message, state: FSMContext):
 
 
 async def _refresh_schedule_list(message: types.Message):
-    games = get_all_games()
+    games = await get_all_games()
     text, kb = _schedule_edit_kb(games)
     await message.edit_text(text, reply_markup=kb)
 
@@ -328,7 +409,7 @@ async def admin_delete_game_schedule(callback: types.CallbackQuery):
         await callback.answer()
         return
     gid = int(callback.data.split("_")[3])
-    delete_game(gid)
+    await delete_game(gid)
     await callback.answer("Игра удалена")
     await _refresh_schedule_list(callback.message)
 
@@ -339,7 +420,7 @@ async def admin_toggle_game_schedule(callback: types.CallbackQuery):
         await callback.answer()
         return
     gid = int(callback.data.split("_")[3])
-    h = toggle_game_visibility(gid)
+    h = await toggle_game_visibility(gid)
     status = "скрыта" if h else "показана"
     await callback.answer(f"Игра {status}")
     await _refresh_schedule_list(callback.message)
@@ -351,7 +432,7 @@ async def admin_delete_game(callback: types.CallbackQuery):
         await callback.answer()
         return
     gid = int(callback.data.split("_")[2])
-    delete_game(gid)
+    await delete_game(gid)
     await callback.answer("Игра удалена")
     await _refresh_games_list(callback.message)
 
@@ -362,7 +443,7 @@ async def admin_toggle_game(callback: types.CallbackQuery):
         await callback.answer()
         return
     gid = int(callback.data.split("_")[2])
-    h = toggle_game_visibility(gid)
+    h = await toggle_game_visibility(gid)
     status = "скрыта" if h else "показана"
     await callback.answer(f"Игра {status}")
     await _refresh_games_list(callback.message)
@@ -387,7 +468,11 @@ async def admin_add_name(message: types.Message, state: FSMContext):
 
 @router.message(AdminGameStates.add_date, F.text)
 async def admin_add_date(message: types.Message, state: FSMContext):
-    await state.update_data(game_date=message.text.strip())
+    game_date = parse_game_date(message.text)
+    if game_date is None:
+        await message.answer(_DATE_ERROR)
+        return
+    await state.update_data(game_date=game_date)
     await state.set_state(AdminGameStates.add_time)
     await message.answer("Время (например: 19:00) или «пропустить»:")
 
@@ -395,7 +480,11 @@ async def admin_add_date(message: types.Message, state: FSMContext):
 @router.message(AdminGameStates.add_time, F.text)
 async def admin_add_time(message: types.Message, state: FSMContext):
     t = message.text.strip().lower()
-    await state.update_data(game_time="" if t in ("пропустить", "-", "") else t)
+    game_time = "" if t in ("пропустить", "-", "") else parse_game_time(t)
+    if game_time is None:
+        await message.answer(_TIME_ERROR)
+        return
+    await state.update_data(game_time=game_time)
     await state.set_state(AdminGameStates.add_place)
     await message.answer(
         "Место или «пропустить»:",
@@ -498,7 +587,7 @@ async def admin_skip_limit(callback: types.CallbackQuery, state: FSMContext):
         await callback.answer()
         return
     data = await state.get_data()
-    add_game(
+    await add_game(
         name=data["name"],
         game_date=data["game_date"],
         game_time=data.get("game_time"),
@@ -519,7 +608,7 @@ async def admin_add_limit(message: types.Message, state: FSMContext):
     except ValueError:
         limit = 0
     data = await state.get_data()
-    add_game(
+    await add_game(
         name=data["name"],
         game_date=data["game_date"],
         game_time=data.get("game_time"),
@@ -537,7 +626,7 @@ async def admin_leads_list(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer()
         return
-    leads = get_leads(50)
+    leads = await get_leads(50)
     if not leads:
         text = "Лидов пока нет."
     else:
@@ -569,8 +658,8 @@ def _followup_kb():
 # --- Scheduled posts (отложенный постинг в каналы/чат) ---
 
 
-def _scheduled_list_text_and_kb():
-    rows = get_scheduled_posts(limit=50)
+async def _scheduled_list_text_and_kb():
+    rows = await get_scheduled_posts(limit=50)
     msk = ZoneInfo("Europe/Moscow")
     if not rows:
         text = "📅 Отложенные посты\n\nПока нет запланированных постов."
@@ -625,7 +714,7 @@ async def admin_scheduled_root(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer()
         return
-    text, kb = _scheduled_list_text_and_kb()
+    text, kb = await _scheduled_list_text_and_kb()
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer()
 
@@ -790,43 +879,11 @@ async def _send_followup_style_preview(
     media_kind: str | None,
     kb_cta: InlineKeyboardMarkup | None,
 ) -> None:
-    """Предпросмотр как в рассылке (admin_broadcast_preview): те же send_* и parse_mode."""
-    html_caption = broadcast_text_to_html(text) if text else None
-    parse_mode = "HTML" if html_caption else None
-    try:
-        if media_file_id and media_kind == "photo":
-            await bot.send_photo(
-                chat_id,
-                media_file_id,
-                caption=html_caption or None,
-                parse_mode=parse_mode,
-                reply_markup=kb_cta,
-            )
-        elif media_file_id and media_kind == "video":
-            await bot.send_video(
-                chat_id,
-                media_file_id,
-                caption=html_caption or None,
-                parse_mode=parse_mode,
-                reply_markup=kb_cta,
-            )
-        elif media_file_id and media_kind == "document":
-            await bot.send_document(
-                chat_id,
-                media_file_id,
-                caption=html_caption or None,
-                parse_mode=parse_mode,
-                reply_markup=kb_cta,
-            )
-        else:
-            await bot.send_message(
-                chat_id,
-                html_caption or "—",
-                parse_mode=parse_mode,
-                reply_markup=kb_cta,
-            )
-    except Exception:
-        pass
+    """Предпросмотр как в рассылке: то же сообщение и та же доставка (outbound.deliver)."""
+    msg = outbound.make_message(text, media_kind, media_file_id, reply_markup=kb_cta)
+    if msg.is_empty:
+        msg = outbound.make_message("—", reply_markup=kb_cta)
+    await outbound.deliver(bot, chat_id, msg)
 
 
 def _preview_kb_from_flat_button(btn_text: str | None, btn_url: str | None) -> InlineKeyboardMarkup | None:
@@ -842,11 +899,11 @@ def _preview_kb_from_flat_button(btn_text: str | None, btn_url: str | None) -> I
 
 async def _send_funnel_step_preview_admin(bot, chat_id: int, step_id: int) -> None:
     """Показать админу предпросмотр шага автоворонки (как рассылка / отложенный пост)."""
-    steps = get_funnel_steps()
+    steps = await get_funnel_steps()
     row = next((s for s in steps if s[0] == step_id), None)
     if not row:
         return
-    _id, _order, _delay, text_raw, media_type, media_file_id, _active, bt, bu = row
+    _id, _order, _delay, text_raw, media_type, media_file_id, _active, bt, bu, _act, _spread = row
     kb = _preview_kb_from_flat_button(bt, bu)
     await _send_followup_style_preview(
         bot,
@@ -982,7 +1039,7 @@ async def admin_scheduled_create(callback: types.CallbackQuery, state: FSMContex
 
     btn_text = data.get("sched_button_text")
     btn_url = data.get("sched_button_url")
-    add_scheduled_post(
+    await add_scheduled_post(
         text=text,
         media_type=media_type,
         media_file_id=media_file_id,
@@ -996,7 +1053,7 @@ async def admin_scheduled_create(callback: types.CallbackQuery, state: FSMContex
     )
     await state.clear()
     await callback.answer("Пост запланирован")
-    text_list, kb = _scheduled_list_text_and_kb()
+    text_list, kb = await _scheduled_list_text_and_kb()
     await callback.message.edit_text(text_list, reply_markup=kb)
 
 
@@ -1057,15 +1114,15 @@ async def admin_scheduled_cancel(callback: types.CallbackQuery):
     except ValueError:
         await callback.answer("Некорректный ID", show_alert=True)
         return
-    cancel_scheduled_post(pid)
+    await cancel_scheduled_post(pid)
     await callback.answer("Пост отменён")
-    text, kb = _scheduled_list_text_and_kb()
+    text, kb = await _scheduled_list_text_and_kb()
     await callback.message.edit_text(text, reply_markup=kb)
 
 
 async def _show_followup_screen(callback: types.CallbackQuery):
     """Показать экран Follow-up (без answer — вызывающий должен ответить на callback)."""
-    users_count = len(get_users_for_broadcast("all"))
+    users_count = await count_users_for_broadcast("all")
     text = f"🔄 Follow-up\n\nПользователей в базе: {users_count}"
     await callback.message.edit_text(text, reply_markup=_followup_kb())
 
@@ -1087,20 +1144,26 @@ async def admin_followup(callback: types.CallbackQuery):
             pass
 
 
+def _users_csv():
+    """CSV выгрузки пользователей (выполняется в пуле чтения БД, строки читаются потоком)."""
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(["tg_id", "username", "first_name", "last_name", "first_seen", "last_seen", "event_count", "events_sample", "phone"])
+    count = 0
+    for r in iter_users_for_export():
+        w.writerow(r)
+        count += 1
+    return buf.getvalue().encode("utf-8-sig"), count
+
+
 @router.callback_query(F.data == "admin_export_users")
 async def admin_export_users(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer()
         return
-    rows = get_users_for_export()
-    buf = io.StringIO()
-    w = csv.writer(buf)
-    w.writerow(["tg_id", "username", "first_name", "last_name", "first_seen", "last_seen", "event_count", "events_sample", "phone"])
-    for r in rows:
-        w.writerow(list(r))
-    buf.seek(0)
-    file = BufferedInputFile(buf.getvalue().encode("utf-8-sig"), filename="users.csv")
-    await callback.bot.send_document(callback.message.chat.id, file, caption=f"Пользователи ({len(rows)} записей)")
+    data, count = await db_async.run_read(_users_csv)
+    file = BufferedInputFile(data, filename="users.csv")
+    await callback.bot.send_document(callback.message.chat.id, file, caption=f"Пользователи ({count} записей)")
     await callback.answer("Файл отправлен.")
 
 
@@ -1444,10 +1507,9 @@ async def _admin_broadcast_confirm(msg_target, state: FSMContext, callback=None)
     filter_type = data.get("broadcast_filter", "all")
     # Фильтр получателей: всем / с заявкой / только админам
     if filter_type == "admins":
-        user_ids = ADMIN_IDS
+        count = len(ADMIN_IDS)
     else:
-        user_ids = get_users_for_broadcast(filter_type)
-    count = len(user_ids)
+        count = await count_users_for_broadcast(filter_type)
 
     if not text and not media_items:
         err = "Добавьте текст или медиа."
@@ -1518,13 +1580,22 @@ async def admin_broadcast_preview(callback: types.CallbackQuery, state: FSMConte
         await callback.answer()
         return
     data = await state.get_data()
+    await outbound.deliver(callback.bot, callback.message.chat.id, _broadcast_message(data))
+    await callback.answer("Предпросмотр отправлен.")
+
+
+@router.callback_query(F.data == "admin_broadcast_toggle_cta")
+async def admin_broadcast_toggle_cta(callback: types.CallbackQuery, state: FSMContext):
+    # Хэндлер больше не используется (кнопки нет), оставлен заглушкой на случай старых апдейтов
+    await callback.answer()
+
+
+def _broadcast_message(data: dict) -> outbound.OutboundMessage:
+    """Сообщение рассылки из данных формы: текст, медиа (несколько фото — альбомом), кнопки CTA."""
     text = data.get("broadcast_text", "")
     media_items = data.get("media_items") or []
-    media_kind = data.get("media_kind")
     add_cta = data.get("add_cta", True)
-    bot = callback.bot
-    chat_id = callback.message.chat.id
-    # Строим клавиатуру с кнопками: либо из нового поля cta_buttons, либо из старого cta_text (для обратной совместимости)
+    # Кнопки: либо из нового поля cta_buttons, либо из старого cta_text (для обратной совместимости)
     kb_cta = None
     buttons = data.get("cta_buttons")
     if not buttons:
@@ -1544,23 +1615,15 @@ async def admin_broadcast_preview(callback: types.CallbackQuery, state: FSMConte
                     )
                 )
         kb_cta = InlineKeyboardMarkup(inline_keyboard=[row])
-    media_file_id = media_items[0]["file_id"] if media_items else None
-    mk = media_kind if media_file_id else None
-    await _send_followup_style_preview(
-        bot,
-        chat_id,
-        text=text,
-        media_file_id=media_file_id,
-        media_kind=mk,
-        kb_cta=kb_cta,
+    msg = outbound.make_message(
+        text,
+        data.get("media_kind"),
+        album=tuple(item["file_id"] for item in media_items),
+        reply_markup=kb_cta,
     )
-    await callback.answer("Предпросмотр отправлен.")
-
-
-@router.callback_query(F.data == "admin_broadcast_toggle_cta")
-async def admin_broadcast_toggle_cta(callback: types.CallbackQuery, state: FSMContext):
-    # Хэндлер больше не используется (кнопки нет), оставлен заглушкой на случай старых апдейтов
-    await callback.answer()
+    if msg.is_empty:
+        msg = outbound.make_message("—", reply_markup=kb_cta)
+    return msg
 
 
 @router.callback_query(F.data == "admin_broadcast_send")
@@ -1571,8 +1634,6 @@ async def admin_broadcast_send(callback: types.CallbackQuery, state: FSMContext)
     data = await state.get_data()
     text = data.get("broadcast_text", "")
     media_items = data.get("media_items") or []
-    media_kind = data.get("media_kind")
-    add_cta = data.get("add_cta", True)
     if not text and not media_items:
         await callback.answer("Добавьте текст или медиа.", show_alert=True)
         return
@@ -1580,69 +1641,19 @@ async def admin_broadcast_send(callback: types.CallbackQuery, state: FSMContext)
     if filter_type == "admins":
         user_ids = ADMIN_IDS
     else:
-        user_ids = get_users_for_broadcast(filter_type)
+        user_ids = await get_users_for_broadcast(filter_type)
     await state.clear()
 
-    # Кнопки CTA для рассылки
-    kb_cta = None
-    buttons = data.get("cta_buttons")
-    if not buttons:
-        cta_text = (data.get("cta_text") or "").strip() or None
-        if add_cta and cta_text:
-            buttons = [{"type": "internal", "text": cta_text, "callback": "menu_record"}]
-    if add_cta and buttons:
-        row = []
-        for b in buttons:
-            if b.get("type") == "url":
-                row.append(InlineKeyboardButton(text=b.get("text", "Ссылка"), url=b.get("url", "")))
-            else:
-                row.append(
-                    InlineKeyboardButton(
-                        text=b.get("text", "Подробнее"),
-                        callback_data=b.get("callback", "menu_record"),
-                    )
-                )
-        kb_cta = InlineKeyboardMarkup(inline_keyboard=[row])
-    html_caption = broadcast_text_to_html(text) if text else None
+    msg = _broadcast_message(data)
     total = len(user_ids)
     await callback.message.edit_text(f"📤 Отправка {total} пользователям...")
     sent, failed = 0, 0
     for uid in user_ids:
-        try:
-            if media_items and media_kind == "photo":
-                await callback.bot.send_photo(
-                    uid,
-                    photo=media_items[0]["file_id"],
-                    caption=html_caption or None,
-                    parse_mode="HTML" if html_caption else None,
-                    reply_markup=kb_cta,
-                )
-            elif media_items and media_kind == "video":
-                await callback.bot.send_video(
-                    uid,
-                    video=media_items[0]["file_id"],
-                    caption=html_caption or None,
-                    parse_mode="HTML" if html_caption else None,
-                    reply_markup=kb_cta,
-                )
-            elif media_items and media_kind == "document":
-                await callback.bot.send_document(
-                    uid,
-                    document=media_items[0]["file_id"],
-                    caption=html_caption or None,
-                    parse_mode="HTML" if html_caption else None,
-                    reply_markup=kb_cta,
-                )
-            else:
-                await callback.bot.send_message(
-                    uid,
-                    html_caption or "—",
-                    parse_mode="HTML" if html_caption else None,
-                    reply_markup=kb_cta,
-                )
+        status, _ = await outbound.deliver(callback.bot, uid, msg)
+        if status == outbound.SENT:
             sent += 1
-        except Exception:
-            # Игнорируем ошибки доставки для статистики — администратору показываем полный охват
+        else:
+            # Ошибки доставки не показываем — администратору показываем полный охват
             failed += 1
         await asyncio.sleep(0.05)
     kb = InlineKeyboardMarkup(inline_keyboard=[[InlineKeyboardButton(text="🔙 Назад", callback_data="admin_followup")]])
@@ -1656,15 +1667,66 @@ async def admin_broadcast_send(callback: types.CallbackQuery, state: FSMContext)
 # --- Autopipeline / Onboarding funnel ---
 
 
-def _funnel_list_text_and_kb():
+async def _funnel_queue_text() -> str:
+    """Очередь отправки: сколько ждут сейчас, темп и примерное время до конца."""
+    waiting = await funnel.backlog()
+    st = funnel.stats()
+    now = datetime.now(ZoneInfo("Europe/Moscow")).strftime("%H:%M:%S")
+    quiet = f"\n🌙 Тихие часы: шаги с задержкой — с {FUNNEL_QUIET_HOURS[1]:02d}:00" if st["quiet"] else ""
+    if not waiting:
+        return f"📤 Очередь пуста · {now}{quiet}"
+    # В тихие часы очередь начнёт разбираться только после их конца
+    eta = st["quiet"] + waiting / st["rate"]
+    eta_label = f"{eta:.0f} с" if eta < 60 else f"{eta / 60:.0f} мин" if eta < 3600 else f"{eta / 3600:.1f} ч"
+    return (
+        f"📤 В очереди: {waiting}, темп {st['rate']:.1f} из {st['max_rate']:.0f} сообщ./с, "
+        f"осталось ~{eta_label} · {now}{quiet}"
+    )
+
+
+def _funnel_activation_label(activation: str, spread_hours: int) -> str:
+    if activation == "new":
+        return "только новым"
+    if activation == "spread" and spread_hours:
+        return f"прошедшим срок — за {spread_hours} ч"
+    return "всем"
+
+
+def _funnel_activation_keyboard(current: str | None = None) -> InlineKeyboardMarkup:
+    """Выбор политики шага; current — подпись текущей политики при правке (кнопка «оставить»)."""
+    keep = [[InlineKeyboardButton(text=f"✅ Оставить: {current}", callback_data="admin_funnel_act_keep")]]
+    return InlineKeyboardMarkup(
+        inline_keyboard=(keep if current else []) + [
+            [InlineKeyboardButton(text="🆕 Только новым подписчикам", callback_data="admin_funnel_act_new")],
+            [InlineKeyboardButton(text="📆 Всем, растянуть на 24 ч", callback_data="admin_funnel_act_spread_24")],
+            [InlineKeyboardButton(text="📆 Всем, растянуть на 72 ч", callback_data="admin_funnel_act_spread_72")],
+            [InlineKeyboardButton(text="⚡ Всем сразу", callback_data="admin_funnel_act_all")],
+        ]
+    )
+
+
+FUNNEL_ACTIVATION_PROMPT = (
+    "Кому отправлять шаг?\n\n"
+    "🆕 Только новым — тем, кто зайдёт в бота после сохранения шага.\n"
+    "📆 Растянуть — подписчикам, у которых срок шага уже прошёл, шаг уйдёт равномерно "
+    "за 24 или 72 ч; остальным — по задержке.\n"
+    "⚡ Всем сразу — у кого срок прошёл, получат шаг как можно скорее."
+)
+
+
+async def _funnel_list_text_and_kb():
     """Список шагов автоворонки для админки."""
-    steps = get_funnel_steps()
+    steps = await get_funnel_steps()
+    queue = await _funnel_queue_text()
     if not steps:
-        text = "📬 Автоворонка"
+        text = f"📬 Автоворонка\n\n{queue}"
     else:
-        lines = ["📬 Автоворонка\n"]
+        lines = ["📬 Автоворонка\n", f"{queue}\n"]
         for idx, row in enumerate(steps, start=1):
-            sid, order_num, delay_hours, text_raw, media_type, media_file_id, is_active, button_text, button_url = row
+            (
+                sid, order_num, delay_hours, text_raw, media_type, media_file_id, is_active,
+                button_text, button_url, activation, spread_hours,
+            ) = row
             status = "✅" if is_active else "❌"
             preview = (text_raw or "").strip()
             if not preview:
@@ -1678,11 +1740,13 @@ def _funnel_list_text_and_kb():
             btn_info = ""
             if button_text and button_url:
                 btn_info = f"\n🔗 Кнопка: {button_text} → {button_url}"
-            lines.append(f"{status} Шаг #{idx}: {delay_label}\n{preview}{btn_info}\n")
+            policy = _funnel_activation_label(activation, spread_hours)
+            lines.append(f"{status} Шаг #{idx}: {delay_label}, {policy}\n{preview}{btn_info}\n")
         text = "\n".join(lines)
 
     kb_rows = [
         [InlineKeyboardButton(text="➕ Добавить шаг", callback_data="admin_funnel_add")],
+        [InlineKeyboardButton(text="🔄 Обновить", callback_data="admin_funnel")],
         [InlineKeyboardButton(text="🔙 Назад", callback_data="admin_back")],
     ]
 
@@ -1710,7 +1774,7 @@ async def admin_funnel_root(callback: types.CallbackQuery):
     if callback.from_user.id not in ADMIN_IDS:
         await callback.answer()
         return
-    text, kb = _funnel_list_text_and_kb()
+    text, kb = await _funnel_list_text_and_kb()
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer()
 
@@ -1740,8 +1804,27 @@ async def admin_funnel_add_delay(message: types.Message, state: FSMContext):
         await message.answer("Введи целое число часов (0 или больше).")
         return
     await state.update_data(delay_hours=hours)
+    await state.set_state(AdminFunnelStates.add_activation)
+    await message.answer(FUNNEL_ACTIVATION_PROMPT, reply_markup=_funnel_activation_keyboard())
+
+
+def _parse_funnel_activation(data: str) -> tuple[str, int]:
+    """admin_funnel_act_new / _all / _spread_24 → (activation, spread_hours)."""
+    parts = data.split("_")[3:]
+    if parts[0] == "spread":
+        return "spread", int(parts[1])
+    return parts[0], 0
+
+
+@router.callback_query(AdminFunnelStates.add_activation, F.data.startswith("admin_funnel_act_"))
+async def admin_funnel_add_activation(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    if callback.from_user.id not in ADMIN_IDS:
+        return
+    activation, spread_hours = _parse_funnel_activation(callback.data)
+    await state.update_data(activation=activation, spread_hours=spread_hours)
     await state.set_state(AdminFunnelStates.add_content)
-    await message.answer(
+    await callback.message.answer(
         "📩 Контент шага — одним сообщением:\n"
         "• обычный текст;\n"
         "• фото с подписью;\n"
@@ -1790,7 +1873,14 @@ async def admin_funnel_add_content(message: types.Message, state: FSMContext):
         await message.answer("Нужно добавить либо текст, либо медиа.")
         return
 
-    sid = add_funnel_step(delay_hours=delay_hours, text=text, media_type=media_type, media_file_id=file_id)
+    sid = await add_funnel_step(
+        delay_hours=delay_hours,
+        text=text,
+        media_type=media_type,
+        media_file_id=file_id,
+        activation=data.get("activation", "all"),
+        spread_hours=data.get("spread_hours", 0),
+    )
     await state.update_data(funnel_step_id=sid)
     await state.set_state(AdminFunnelStates.add_button_text)
     await message.answer(
@@ -1805,8 +1895,8 @@ async def admin_funnel_delete(callback: types.CallbackQuery):
         await callback.answer()
         return
     sid = int(callback.data.split("_")[-1])
-    delete_funnel_step(sid)
-    text, kb = _funnel_list_text_and_kb()
+    await delete_funnel_step(sid)
+    text, kb = await _funnel_list_text_and_kb()
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer("Шаг удалён")
 
@@ -1818,15 +1908,14 @@ async def admin_funnel_toggle(callback: types.CallbackQuery):
         return
     sid = int(callback.data.split("_")[-1])
     # переключаем is_active 1 <-> 0
-    from database import get_funnel_steps as _get_all_steps
-    steps = _get_all_steps()
+    steps = await get_funnel_steps()
     current = next((s for s in steps if s[0] == sid), None)
     if not current:
         await callback.answer("Шаг не найден", show_alert=True)
         return
-    _, order_num, delay_hours, text_raw, media_type, media_file_id, is_active, _bt, _bu = current
-    update_funnel_step(sid, is_active=0 if is_active else 1)
-    text, kb = _funnel_list_text_and_kb()
+    is_active = current[6]
+    await update_funnel_step(sid, is_active=0 if is_active else 1)
+    text, kb = await _funnel_list_text_and_kb()
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer("Статус изменён")
 
@@ -1837,13 +1926,15 @@ async def admin_funnel_edit_start(callback: types.CallbackQuery, state: FSMConte
         await callback.answer()
         return
     sid = int(callback.data.split("_")[-1])
-    steps = get_funnel_steps()
+    steps = await get_funnel_steps()
     current = next((s for s in steps if s[0] == sid), None)
     if not current:
         await callback.answer("Шаг не найден", show_alert=True)
         return
-    _, order_num, delay_hours, text_raw, media_type, media_file_id, is_active, button_text, button_url = current
-    await state.update_data(funnel_step_id=sid)
+    _, order_num, delay_hours, text_raw, media_type, media_file_id, is_active, _bt, _bu, activation, spread_hours = current
+    await state.update_data(
+        funnel_step_id=sid, old_delay_hours=delay_hours, old_activation=activation, old_spread_hours=spread_hours
+    )
     await state.set_state(AdminFunnelStates.edit_delay)
     preview = (text_raw or "").strip()
     if len(preview) > 100:
@@ -1851,7 +1942,8 @@ async def admin_funnel_edit_start(callback: types.CallbackQuery, state: FSMConte
     delay_label = "0 (сразу)" if delay_hours == 0 else f"+{delay_hours} ч"
     await callback.message.answer(
         f"Редактирование шага #{sid}.\n"
-        f"Сейчас: {delay_label}, активен: {'да' if is_active else 'нет'}.\n\n"
+        f"Сейчас: {delay_label}, {_funnel_activation_label(activation, spread_hours)}, "
+        f"активен: {'да' if is_active else 'нет'}.\n\n"
         f"Текст:\n{preview or '(пусто)'}\n\n"
         f"Введи новое количество часов (0, 1, 2... 72 и т.д.):"
     )
@@ -1870,11 +1962,35 @@ async def admin_funnel_edit_delay(message: types.Message, state: FSMContext):
     except ValueError:
         await message.answer("Введи целое число часов (0 или больше).")
         return
+    await state.update_data(delay_hours=hours)
+    await state.set_state(AdminFunnelStates.edit_activation)
+    data = await state.get_data()
+    current = _funnel_activation_label(data.get("old_activation", "all"), data.get("old_spread_hours", 0))
+    await message.answer(FUNNEL_ACTIVATION_PROMPT, reply_markup=_funnel_activation_keyboard(current))
+
+
+@router.callback_query(AdminFunnelStates.edit_activation, F.data.startswith("admin_funnel_act_"))
+async def admin_funnel_edit_activation(callback: types.CallbackQuery, state: FSMContext):
+    await callback.answer()
+    if callback.from_user.id not in ADMIN_IDS:
+        return
     data = await state.get_data()
     sid = data.get("funnel_step_id")
-    update_funnel_step(sid, delay_hours=hours)
+    old = {
+        "delay_hours": data.get("old_delay_hours"),
+        "activation": data.get("old_activation"),
+        "spread_hours": data.get("old_spread_hours"),
+    }
+    new = {"delay_hours": data.get("delay_hours", 0)}
+    if callback.data != "admin_funnel_act_keep":
+        new["activation"], new["spread_hours"] = _parse_funnel_activation(callback.data)
+    # Только изменённое: правка без смены задержки и политики не сдвигает changed_at
+    # и не пересчитывает очередь
+    changed = {k: v for k, v in new.items() if v != old[k]}
+    if changed:
+        await update_funnel_step(sid, **changed)
     await state.set_state(AdminFunnelStates.edit_content)
-    await message.answer(
+    await callback.message.answer(
         "Отправь новое сообщение для шага одним сообщением:\n"
         "текст, или фото / видео / файл с подписью (подпись = текст поста).\n\n"
         "Если ничего не меняешь — перешли тот же контент ещё раз."
@@ -1891,7 +2007,7 @@ async def admin_funnel_edit_content(message: types.Message, state: FSMContext):
     if not text and not file_id:
         await message.answer("Нужно добавить либо текст, либо медиа.")
         return
-    update_funnel_step(
+    await update_funnel_step(
         sid,
         text=text,
         media_type=media_type,
@@ -1917,7 +2033,7 @@ async def admin_funnel_add_button_text(message: types.Message, state: FSMContext
         await message.answer("Ошибка: не найден шаг автоворонки.")
         return
     if raw in ("", "-"):
-        update_funnel_step(sid, button_text=None, button_url=None)
+        await update_funnel_step(sid, button_text=None, button_url=None)
         await state.update_data(funnel_step_id=sid)
         await state.set_state(AdminFunnelStates.review)
         await message.answer(
@@ -1950,7 +2066,7 @@ async def admin_funnel_add_button_url(message: types.Message, state: FSMContext)
         await message.answer("Отправьте корректную ссылку, начинающуюся с http:// или https://")
         return
     label = btn_text[:64] if len(btn_text) > 64 else btn_text
-    update_funnel_step(sid, button_text=label, button_url=url)
+    await update_funnel_step(sid, button_text=label, button_url=url)
     await state.update_data(funnel_step_id=sid)
     await state.set_state(AdminFunnelStates.review)
     await message.answer(
@@ -1972,7 +2088,7 @@ async def admin_funnel_edit_button_text(message: types.Message, state: FSMContex
         await message.answer("Ошибка: не найден шаг автоворонки.")
         return
     if raw in ("", "-"):
-        update_funnel_step(sid, button_text=None, button_url=None)
+        await update_funnel_step(sid, button_text=None, button_url=None)
         await state.update_data(funnel_step_id=sid)
         await state.set_state(AdminFunnelStates.review)
         await message.answer(
@@ -2004,7 +2120,7 @@ async def admin_funnel_edit_button_url(message: types.Message, state: FSMContext
         await message.answer("Отправьте корректную ссылку, начинающуюся с http:// или https://")
         return
     label = btn_text[:64] if len(btn_text) > 64 else btn_text
-    update_funnel_step(sid, button_text=label, button_url=url)
+    await update_funnel_step(sid, button_text=label, button_url=url)
     await state.update_data(funnel_step_id=sid)
     await state.set_state(AdminFunnelStates.review)
     await message.answer(
@@ -2033,7 +2149,7 @@ async def admin_funnel_review_done(callback: types.CallbackQuery, state: FSMCont
         await callback.answer()
         return
     await state.clear()
-    text_list, kb = _funnel_list_text_and_kb()
+    text_list, kb = await _funnel_list_text_and_kb()
     try:
         await callback.message.edit_text(text_list, reply_markup=kb)
     except Exception:
@@ -2067,8 +2183,8 @@ async def admin_back(callback: types.CallbackQuery, state: FSMContext):
 
 # --- Scenarios Management ---
 
-def _scenarios_list_kb():
-    scenarios = get_scenarios()
+async def _scenarios_list_kb():
+    scenarios = await get_scenarios()
     text = "Сценарии:\n\n"
     kb = []
     for s in scenarios:
@@ -2087,7 +2203,7 @@ def _scenarios_list_kb():
 
 @router.callback_query(F.data == "admin_scenarios")
 async def admin_scenarios_list(callback: types.CallbackQuery):
-    text, kb = _scenarios_list_kb()
+    text, kb = await _scenarios_list_kb()
     await callback.message.edit_text(text, reply_markup=kb)
     await callback.answer()
 
@@ -2107,28 +2223,28 @@ async def admin_add_scenario_name(message: types.Message, state: FSMContext):
         return
     
     # Создаём сценарий сразу только с названием (без описания)
-    add_scenario(name, "")
+    await add_scenario(name, "")
     await state.clear()
     await message.answer(f"✅ Сценарий «{name}» создан.")
     
     # Показываем список сценариев
-    text, kb = _scenarios_list_kb()
+    text, kb = await _scenarios_list_kb()
     await message.answer(text, reply_markup=kb)
 
 
 @router.callback_query(F.data.startswith("adm_scen_del_"))
 async def admin_delete_scenario(callback: types.CallbackQuery):
     sid = int(callback.data.split("_")[3])
-    delete_scenario(sid)
+    await delete_scenario(sid)
     await callback.answer("Сценарий удалён")
-    text, kb = _scenarios_list_kb()
+    text, kb = await _scenarios_list_kb()
     await callback.message.edit_text(text, reply_markup=kb)
 
 
 @router.callback_query(F.data.startswith("adm_scen_edit_"))
 async def admin_edit_scenario(callback: types.CallbackQuery, state: FSMContext):
     sid = int(callback.data.split("_")[3])
-    scenario = get_scenario(sid)
+    scenario = await get_scenario(sid)
     if not scenario:
         await callback.answer("Сценарий не найден", show_alert=True)
         return
@@ -2144,7 +2260,7 @@ async def admin_edit_scenario_name(message: types.Message, state: FSMContext):
     new_name = message.text.strip()
     data = await state.get_data()
     sid = data["sid"]
-    scenario = get_scenario(sid)
+    scenario = await get_scenario(sid)
     
     name = new_name if new_name != "-" else scenario[1]
     await state.update_data(name=name)
@@ -2158,25 +2274,25 @@ async def admin_edit_scenario_desc(message: types.Message, state: FSMContext):
     new_desc = message.text.strip()
     data = await state.get_data()
     sid = data["sid"]
-    scenario = get_scenario(sid)
+    scenario = await get_scenario(sid)
     
     desc = new_desc if new_desc != "-" else (scenario[2] or "")
-    update_scenario(sid, data["name"], desc)
+    await update_scenario(sid, data["name"], desc)
     await state.clear()
     await message.answer("✅ Сценарий обновлён.")
     
-    text, kb = _scenarios_list_kb()
+    text, kb = await _scenarios_list_kb()
     await message.answer(text, reply_markup=kb)
 
 
 # --- Stories Management (per scenario) ---
 
-def _scenario_stories_kb(scenario_id):
-    scenario = get_scenario(scenario_id)
+async def _scenario_stories_kb(scenario_id):
+    scenario = await get_scenario(scenario_id)
     if not scenario:
         return "Сценарий не найден", None
         
-    stories = get_stories_by_scenario(scenario_id)
+    stories = await get_stories_by_scenario(scenario_id)
     text = f"Сюжеты сценария «{scenario[1]}»:\n\n"
     kb = []
     
@@ -2211,7 +2327,7 @@ def _scenario_stories_kb(scenario_id):
 @router.callback_query(F.data.startswith("adm_scen_stories_"))
 async def admin_scenario_stories(callback: types.CallbackQuery):
     sid = int(callback.data.split("_")[3])
-    text, kb = _scenario_stories_kb(sid)
+    text, kb = await _scenario_stories_kb(sid)
     if not kb:
         await callback.answer(text)
         return
@@ -2225,11 +2341,11 @@ async def admin_toggle_story(callback: types.CallbackQuery):
     sid = int(parts[3])
     scenario_id = int(parts[4])
     
-    h = toggle_story_visibility(sid)
+    h = await toggle_story_visibility(sid)
     status = "скрыт" if h else "показан"
     await callback.answer(f"Сюжет {status}")
     
-    text, kb = _scenario_stories_kb(scenario_id)
+    text, kb = await _scenario_stories_kb(scenario_id)
     await callback.message.edit_text(text, reply_markup=kb)
 
 
@@ -2240,10 +2356,10 @@ async def admin_move_story(callback: types.CallbackQuery):
     scenario_id = int(parts[4])
     direction = parts[5] # up/down
     
-    swap_story_order(sid, direction)
+    await swap_story_order(sid, direction)
     await callback.answer()
     
-    text, kb = _scenario_stories_kb(scenario_id)
+    text, kb = await _scenario_stories_kb(scenario_id)
     await callback.message.edit_text(text, reply_markup=kb)
 
 
@@ -2253,10 +2369,10 @@ async def admin_delete_story(callback: types.CallbackQuery):
     sid = int(parts[3])
     scenario_id = int(parts[4])
     
-    delete_story(sid)
+    await delete_story(sid)
     await callback.answer("Сюжет удалён")
     
-    text, kb = _scenario_stories_kb(scenario_id)
+    text, kb = await _scenario_stories_kb(scenario_id)
     await callback.message.edit_text(text, reply_markup=kb)
 
 
@@ -2266,7 +2382,7 @@ async def admin_edit_story_start(callback: types.CallbackQuery, state: FSMContex
     sid = int(parts[3])
     scenario_id = int(parts[4])
     
-    story = get_story(sid)
+    story = await get_story(sid)
     if not story:
         await callback.answer("Сюжет не найден")
         return
@@ -2296,12 +2412,12 @@ async def admin_edit_story_text_save(message: types.Message, state: FSMContext):
     sid = data["sid"]
     scenario_id = data["scenario_id"]
     new_text = message.text.strip()
-    update_story(sid, content=new_text)  # title остаётся "Сюжет N"
+    await update_story(sid, content=new_text)  # title остаётся "Сюжет N"
     
     await state.clear()
     await message.answer("✅ Текст обновлён.")
     
-    text, kb = _scenario_stories_kb(scenario_id)
+    text, kb = await _scenario_stories_kb(scenario_id)
     await message.answer(text, reply_markup=kb)
 
 
@@ -2333,12 +2449,12 @@ async def _save_story_img(message: types.Message, state: FSMContext, image_url:
     sid = data["sid"]
     scenario_id = data["scenario_id"]
     
-    update_story(sid, image_url=image_url)
+    await update_story(sid, image_url=image_url)
     
     await state.clear()
     await message.answer("✅ Изображение обновлено.")
     
-    text, kb = _scenario_stories_kb(scenario_id)
+    text, kb = await _scenario_stories_kb(scenario_id)
     await message.answer(text, reply_markup=kb)
 
 
@@ -2415,10 +2531,10 @@ async def _finish_add_story(message: types.Message, state: FSMContext):
     scenario_id = data.get("scenario_id")
     
     # Считаем order_num: сколько уже есть сюжетов (Сюжет 1, Сюжет 2, ...)
-    existing = get_stories_by_scenario(scenario_id)
+    existing = await get_stories_by_scenario(scenario_id)
     order_num = len(existing)
     
-    add_story(
+    await add_story(
         title=f"Сюжет {order_num + 1}",
         content=content,
         image_url=image_url,
@@ -2431,7 +2547,7 @@ async def _finish_add_story(message: types.Message, state: FSMContext):
     await message.answer("✅ Сюжет добавлен.")
     
     # Возвращаем меню сюжетов сценария
-    text, kb = _scenario_stories_kb(scenario_id)
+    text, kb = await _scenario_stories_kb(scenario_id)
     await message.answer(text, reply_markup=kb)
 
 
@@ -2439,7 +2555,7 @@ async def _finish_add_story(message: types.Message, state: FSMContext):
 
 @router.callback_query(F.data == "admin_format")
 async def admin_format_edit(callback: types.CallbackQuery):
-    text_db, image_url, _ = get_format_info()
+    text_db, image_url, _ = await get_format_info()
     
     text = "Редактирование «Что это за формат?»\n\n"
     if text_db:
@@ -2463,7 +2579,7 @@ async def admin_format_edit(callback: types.CallbackQuery):
 @router.callback_query(F.data == "adm_fmt_edit_text")
 async def admin_format_edit_text_start(callback: types.CallbackQuery, state: FSMContext):
     await state.set_state(AdminFormatStates.edit_text)
-    text_db, _, _ = get_format_info()
+    text_db, _, _ = await get_format_info()
     current = text_db or "Сюжетная игра (ролевой квест) — это как фильм, только ты внутри истории.\n\nТебе дают роль и цель, дальше события разворачиваются через общение и решения. Ведущий всё ведёт и помогает."
     await callback.message.answer(
         f"Редактирование текста «Что это за формат?».\n\n"
@@ -2476,13 +2592,13 @@ async def admin_format_edit_text_start(callback: types.CallbackQuery, state: FSM
 @router.message(AdminFormatStates.edit_text, F.text)
 async def admin_format_edit_text_save(message: types.Message, state: FSMContext):
     new_text = message.text.strip()
-    _, current_img, _ = get_format_info()  # Сохраняем текущую картинку
-    update_format_info(new_text, current_img or "")
+    _, current_img, _ = await get_format_info()  # Сохраняем текущую картинку
+    await update_format_info(new_text, current_img or "")
     await state.clear()
     await message.answer("✅ Текст обновлён.")
     
     # Возвращаем меню редактирования
-    text_db, image_url, _ = get_format_info()
+    text_db, image_url, _ = await get_format_info()
     text = "Редактирование «Что это за формат?»\n\n"
     if text_db:
         preview = (text_db[:100] + "...") if len(text_db) > 100 else text_db
@@ -2516,13 +2632,13 @@ async def admin_format_edit_img_start(callback: types.CallbackQuery, state: FSMC
 
 @router.callback_query(F.data == "adm_fmt_img_delete")
 async def admin_format_delete_img(callback: types.CallbackQuery, state: FSMContext):
-    update_format_info(image_url="")  # Обновляем только image_url, text оставляем
+    await update_format_info(image_url="")  # Обновляем только image_url, text оставляем
     await state.clear()
     await callback.message.answer("✅ Картинка удалена.")
     await callback.answer()
     
     # Возвращаем меню
-    text_db, image_url, _ = get_format_info()
+    text_db, image_url, _ = await get_format_info()
     text = "Редактирование «Что это за формат?»\n\n"
     if text_db:
         preview = (text_db[:100] + "...") if len(text_db) > 100 else text_db
@@ -2554,12 +2670,12 @@ async def admin_format_edit_img_document(message: types.Message, state: FSMConte
 
 
 async def _admin_format_save_img(message: types.Message, state: FSMContext, file_id: str):
-    update_format_info(image_url=file_id)
+    await update_format_info(image_url=file_id)
     await state.clear()
     await message.answer("✅ Картинка обновлена.")
     
     # Возвращаем меню
-    text_db, image_url, _ = get_format_info()
+    text_db, image_url, _ = await get_format_info()
     text = "Редактирование «Что это за формат?»\n\n"
     if text_db:
         preview = (text_db[:100] + "...") if len(text_db) > 100 else text_db
@@ -2578,7 +2694,7 @@ async def _admin_format_save_img(message: types.Message, state: FSMContext, file
 @router.message(AdminFormatStates.edit_image, F.text)
 async def admin_format_edit_img_text(message: types.Message, state: FSMContext):
     if message.text.strip() == "-":
-        update_format_info(image_url="")
+        await update_format_info(image_url="")
         await state.clear()
         await message.answer("✅ Картинка удалена.")
     else:
@@ -2586,7 +2702,7 @@ async def admin_format_edit_img_text(message: types.Message, state: FSMContext):
         return
     
     # Возвращаем меню
-    text_db, image_url, _ = get_format_info()
+    text_db, image_url, _ = await get_format_info()
     text = "Редактирование «Что это за формат?»\n\n"
     if text_db:
         preview = (text_db[:100] + "...") if len(text_db) > 100 else text_db
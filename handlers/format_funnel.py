@@ -1,87 +1,79 @@
 """Раздел «Что это за формат?» — один экран: картинка (если задана) + текст из админки."""
 from aiogram import Router, types, F
-from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton, InputMediaPhoto
+from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
+import screens
 from config import CHAT_LINK
-from database import get_format_info
-from utils import text_to_telegram_html
+from cache import get_format_info, rendered
+from utils import split_telegram_html, text_to_telegram_html
 
 router = Router()
 
 CAPTION_MAX_LENGTH = 1024
+MESSAGE_MAX_LENGTH = 4096
 
 
-async def format_show_screen(target):
-    """Показать один экран «Что это за формат?»: картинка (если есть) + текст + кнопка видео."""
-    text, image_url, video_url = get_format_info()
+async def _format_pages():
+    """Страницы экрана: [(HTML-текст, подпись к фото, картинка, клавиатура), ...]."""
+    text, image_url, video_url = await get_format_info()
     image_url = (image_url or "").strip()
     video_url = (video_url or "").strip()
 
     if not text:
         text = "Сюжетная игра (ролевой квест) — это как фильм, только ты внутри истории.\n\nТебе дают роль и цель, дальше события разворачиваются через общение и решения. Ведущий всё ведёт и помогает."
     text = text_to_telegram_html(text)
-    caption = text[:CAPTION_MAX_LENGTH]
+    parts = split_telegram_html(text, MESSAGE_MAX_LENGTH, CAPTION_MAX_LENGTH if image_url else None) or [text]
 
-    kb_rows = [
-        [
-            InlineKeyboardButton(text="🎯 Записаться", callback_data="menu_record"),
-            InlineKeyboardButton(text="📆 Расписание", callback_data="menu_schedule"),
-        ],
-        [InlineKeyboardButton(text="💬 Вступить в чат", url=CHAT_LINK)],
-    ]
-    if video_url:
-        kb_rows.append([InlineKeyboardButton(text="🎬 Смотреть видео", url=video_url)])
-    kb_rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data="menu_back")])
-    kb = InlineKeyboardMarkup(inline_keyboard=kb_rows)
+    pages = []
+    for page, part in enumerate(parts):
+        kb_rows = []
+        # Длинный текст — страницы; первая с картинкой
+        if len(parts) > 1:
+            page_buttons = []
+            if page > 0:
+                page_buttons.append(InlineKeyboardButton(text=f"◀️ Стр. {page}", callback_data=f"fmt_page_{page - 1}"))
+            if page < len(parts) - 1:
+                page_buttons.append(InlineKeyboardButton(text=f"Стр. {page + 2} ▶️", callback_data=f"fmt_page_{page + 1}"))
+            kb_rows.append(page_buttons)
+        kb_rows += [
+            [
+                InlineKeyboardButton(text="🎯 Записаться", callback_data="menu_record"),
+                InlineKeyboardButton(text="📆 Расписание", callback_data="menu_schedule"),
+            ],
+            [InlineKeyboardButton(text="💬 Вступить в чат", url=CHAT_LINK)],
+        ]
+        if video_url:
+            kb_rows.append([InlineKeyboardButton(text="🎬 Смотреть видео", url=video_url)])
+        kb_rows.append([InlineKeyboardButton(text="🔙 Назад", callback_data="menu_back")])
+        photo = image_url if page == 0 else ""
+        pages.append((part, part if photo else None, photo, InlineKeyboardMarkup(inline_keyboard=kb_rows)))
+    return pages
 
-    if image_url:
-        if hasattr(target, "bot") and hasattr(target, "message"):
-            try:
-                await target.bot.edit_message_media(
-                    chat_id=target.message.chat.id,
-                    message_id=target.message.message_id,
-                    media=InputMediaPhoto(media=image_url, caption=caption, parse_mode="HTML"),
-                    reply_markup=kb,
-                )
-            except Exception:
-                try:
-                    await target.bot.delete_message(
-                        chat_id=target.message.chat.id,
-                        message_id=target.message.message_id,
-                    )
-                except Exception:
-                    pass
-                await target.bot.send_photo(
-                    chat_id=target.message.chat.id,
-                    photo=image_url,
-                    caption=caption,
-                    parse_mode="HTML",
-                    reply_markup=kb,
-                )
-        else:
-            await target.answer_photo(photo=image_url, caption=caption, parse_mode="HTML", reply_markup=kb)
+
+async def format_show_screen(target, page: int = 0):
+    """Показать экран «Что это за формат?»: картинка (если есть) + текст + кнопка видео.
+
+    Страницы собираются один раз на версию контента «format».
+    """
+    pages = await rendered(("format",), ("format_screen",), _format_pages)
+    text, caption, image_url, kb = pages[min(max(page, 0), len(pages) - 1)]
+
+    if hasattr(target, "bot") and hasattr(target, "message"):
+        await screens.show(target, text, kb, photo=image_url or None, caption=caption)
+    elif image_url:
+        await target.answer_photo(photo=image_url, caption=caption, parse_mode="HTML", reply_markup=kb)
     else:
-        if hasattr(target, "bot") and hasattr(target, "message"):
-            try:
-                await target.bot.edit_message_text(
-                    chat_id=target.message.chat.id,
-                    message_id=target.message.message_id,
-                    text=text,
-                    parse_mode="HTML",
-                    reply_markup=kb,
-                )
-            except Exception:
-                try:
-                    await target.bot.delete_message(
-                        chat_id=target.message.chat.id,
-                        message_id=target.message.message_id,
-                    )
-                except Exception:
-                    pass
-                await target.bot.send_message(
-                    chat_id=target.message.chat.id,
-                    text=text,
-                    parse_mode="HTML",
-                    reply_markup=kb,
-                )
-        else:
-            await target.answer(text, parse_mode="HTML", reply_markup=kb)
+        await target.answer(text, parse_mode="HTML", reply_markup=kb)
+
+
+@router.callback_query(F.data.startswith("fmt_page_"))
+async def cb_format_page(callback: types.CallbackQuery):
+    """Страница длинного текста «Что это за формат?»."""
+    try:
+        await callback.answer()
+    except Exception:
+        pass
+    try:
+        page = int(callback.data.split("_")[2])
+    except ValueError:
+        return
+    await format_show_screen(callback, page)
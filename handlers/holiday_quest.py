@@ -5,7 +5,7 @@ from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 from config import OPERATOR_CHAT_ID
-from database import add_holiday_order
+from db_async import add_holiday_order
 
 router = Router()
 
@@ -55,7 +55,7 @@ async def holiday_quest_phone(message: types.Message, state: FSMContext):
     name = data.get("name", "")
     await state.clear()
     user = message.from_user
-    add_holiday_order(tg_id=user.id, username=user.username, name=name, phone=phone)
+    await add_holiday_order(tg_id=user.id, username=user.username, name=name, phone=phone)
     notify = (
         f"🎂 Заявка: квест на праздник\n\n"
         f"Имя: {name}\n"
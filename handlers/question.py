@@ -3,7 +3,7 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from config import OPERATOR_CHAT_ID
-from database import add_question
+from db_async import add_question
 
 router = Router()
 
@@ -15,7 +15,7 @@ class QuestionStates(StatesGroup):
 @router.message(QuestionStates.waiting, F.text)
 async def question_save(message: types.Message, state: FSMContext):
     user = message.from_user
-    qid = add_question(
+    qid = await add_question(
         tg_id=user.id,
         username=user.username,
         name=user.full_name or "",
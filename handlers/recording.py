@@ -3,10 +3,12 @@ from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
-from config import OPERATOR_CHAT_ID
-from database import get_visible_games, add_lead, get_game, get_user_utm
+from config import OPERATOR_CHAT_ID, SCHEDULE_PAGE_SIZE
+from cache import get_visible_games_page, get_game, rendered
+from database import today
+from db_async import add_lead, get_user_utm
 from handlers.stories import show_story_screen
-from utils import text_to_telegram_html
+from utils import text_to_telegram_html, game_cursor, parse_game_cursor
 
 router = Router()
 
@@ -30,17 +32,39 @@ class RecordStates(StatesGroup):
 def _back_btn(callback_data="menu_back"):
     return [InlineKeyboardButton(text="🔙 Назад", callback_data=callback_data)]
 
-def _games_keyboard():
-    games = get_visible_games()
+async def _games_keyboard(direction: str = "", cursor=None):
+    """Страница выбора игры; None — видимых игр нет. direction — "n" / "p" от cursor."""
+    day = today()
+    return await rendered(
+        ("games",), ("games_keyboard", direction, cursor), _render_games_keyboard, direction, cursor, day=day
+    )
+
+
+async def _render_games_keyboard(direction: str, cursor):
+    after = cursor if direction == "n" else None
+    before = cursor if direction == "p" else None
+    games, has_more = await get_visible_games_page(None, after, before, SCHEDULE_PAGE_SIZE)
     if not games:
-        return None
+        # Игры страницы успели скрыть или удалить — показываем первую
+        return await _games_keyboard() if cursor else None
     kb = []
     for g in games:
-        gid, name, date, time, place, price, desc, limit = g
+        gid, name, date, time, place, price, desc, limit, starts_at = g
         label = f"{name} — {date}"
         if time:
             label += f" {time}"
         kb.append([InlineKeyboardButton(text=label, callback_data=f"rgame_{gid}")])
+    nav = []
+    if (has_more if before else bool(after)):
+        nav.append(InlineKeyboardButton(
+            text="◀️ Раньше", callback_data=f"rpage:p:{game_cursor(games[0][8], games[0][0])}"
+        ))
+    if (has_more if not before else True):
+        nav.append(InlineKeyboardButton(
+            text="Позже ▶️", callback_data=f"rpage:n:{game_cursor(games[-1][8], games[-1][0])}"
+        ))
+    if nav:
+        kb.append(nav)
     kb.append(_back_btn("rback_game"))
     return InlineKeyboardMarkup(inline_keyboard=kb)
 
@@ -56,12 +80,12 @@ def _count_keyboard():
 
 
 async def start_record(callback_or_msg, state: FSMContext):
-    games = get_visible_games()
+    kb = await _games_keyboard()
     is_callback = hasattr(callback_or_msg, "message") and hasattr(callback_or_msg, "bot")
     msg = callback_or_msg.message if is_callback else callback_or_msg
     bot = callback_or_msg.bot if is_callback else None
 
-    if not games:
+    if kb is None:
         text = "Пока нет доступных игр. Загляни в расписание или задай вопрос менеджеру."
         kb = InlineKeyboardMarkup(
             inline_keyboard=[
@@ -79,7 +103,6 @@ async def start_record(callback_or_msg, state: FSMContext):
         return False
 
     text = "Выбери игру/дату:"
-    kb = _games_keyboard()
     if is_callback and bot:
         # Для любых inline-кнопок ("Записаться") исходное сообщение не изменяем — открываем выбор игр новым сообщением
         await bot.send_message(chat_id=msg.chat.id, text=text, reply_markup=kb)
@@ -97,10 +120,22 @@ async def cb_record(callback: types.CallbackQuery, state: FSMContext):
 # Записаться обрабатывается в main.py handle_menu
 
 
+@router.callback_query(RecordStates.choose_game, F.data.startswith("rpage:"))
+async def record_games_page(callback: types.CallbackQuery):
+    _, direction, cursor = callback.data.split(":", 2)
+    cursor = parse_game_cursor(cursor)
+    kb = await _games_keyboard(direction if cursor else "", cursor)
+    try:
+        await callback.message.edit_reply_markup(reply_markup=kb)
+    except Exception:
+        pass
+    await safe_answer_callback(callback)
+
+
 @router.callback_query(RecordStates.choose_game, F.data.startswith("rgame_"))
 async def record_choose_game(callback: types.CallbackQuery, state: FSMContext):
     gid = int(callback.data.split("_")[1])
-    row = get_game(gid)
+    row = await get_game(gid)
     if not row:
         await callback.answer("Игра не найдена", show_alert=True)
         return
@@ -197,7 +232,7 @@ async def record_back_count(callback: types.CallbackQuery, state: FSMContext):
         chat_id=callback.message.chat.id,
         message_id=callback.message.message_id,
         text=text,
-        reply_markup=_games_keyboard(),
+        reply_markup=await _games_keyboard(),
     )
     await safe_answer_callback(callback)
 
@@ -354,8 +389,8 @@ async def record_back_confirm(callback: types.CallbackQuery, state: FSMContext):
 async def record_confirm_yes(callback: types.CallbackQuery, state: FSMContext):
     data = await state.get_data()
     user = callback.from_user
-    utm = get_user_utm(user.id)
-    lead_id = add_lead(
+    utm = await get_user_utm(user.id)
+    lead_id = await add_lead(
         tg_id=user.id,
         username=user.username,
         name=user.full_name or "",
@@ -1,23 +1,65 @@
-from aiogram import Router, types
+from datetime import datetime, timedelta
+
+from aiogram import Router, types, F
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
-from database import get_visible_games
-from config import CHAT_LINK
-from utils import text_to_telegram_html
+import screens
+from cache import get_visible_games_page, rendered
+from config import CHAT_LINK, SCHEDULE_PAGE_SIZE
+from database import today
+from utils import text_to_telegram_html, game_cursor, parse_game_cursor, split_telegram_html
 
 router = Router()
 
 # URL для Bronibiz/Афиша — можно задать в .env
 BRONIBIZ_URL = "https://example.com"  # заменить на реальный
 
+# Фильтр по датам: код в callback_data → (подпись, дней вперёд; 0 — без ограничения)
+RANGES = {"a": ("Все даты", 0), "w": ("Неделя", 7), "m": ("Месяц", 31)}
+TEXT_LIMIT = 4096
+
+
+def _range_until(day: str, rng: str) -> str | None:
+    days = RANGES.get(rng, RANGES["a"])[1]
+    if not days:
+        return None
+    return (datetime.fromisoformat(day) + timedelta(days=days)).strftime("%Y-%m-%d")
+
+
+async def get_schedule_content(with_back: bool = False, rng: str = "a", direction: str = "", cursor=None):
+    """Страница расписания: текст и клавиатура. direction — "n" (после cursor) / "p" (до cursor).
+
+    Каждая страница пересобирается только после правки игр или смены дня.
+    """
+    day = today()
+    return await rendered(
+        ("games",), ("schedule", with_back, rng, direction, cursor),
+        _render_schedule, day, with_back, rng, direction, cursor,
+        day=day,
+    )
 
-def get_schedule_content(with_back: bool = False):
-    games = get_visible_games()
+
+async def _render_schedule(day: str, with_back: bool, rng: str, direction: str, cursor):
+    after = cursor if direction == "n" else None
+    before = cursor if direction == "p" else None
+    games, has_more = await get_visible_games_page(_range_until(day, rng), after, before, SCHEDULE_PAGE_SIZE)
+    if not games and cursor:
+        # Игры страницы успели скрыть или удалить — показываем первую
+        return await get_schedule_content(with_back, rng)
+    has_prev = has_more if before else bool(after)
+    has_next = has_more if not before else True
+
+    flags = f"{int(with_back)}{rng}"
+    nav = []
     if not games:
-        text = "Пока нет запланированных игр. Следи за обновлениями в чате!"
+        text = (
+            "Пока нет запланированных игр. Следи за обновлениями в чате!"
+            if rng == "a" else "В эти даты игр нет — посмотри другие даты."
+        )
     else:
+        header = "📆 Ближайшие игры:\n\n"
         lines = []
-        for g in games:
-            gid, name, date, time, place, price, desc, limit = g
+        for i, g in enumerate(games):
+            gid, name, date, time, place, price, desc, limit, starts_at = g
             name_fmt = text_to_telegram_html(name)
             line = f"• {name_fmt} — {date}"
             if time:
@@ -28,9 +70,34 @@ def get_schedule_content(with_back: bool = False):
                 line += f"\n   💰 {price}"
             if desc:
                 line += f"\n   {text_to_telegram_html(desc)}"
+            # Одна игра длиннее страницы — обрезаем её описание, иначе Telegram отклонит сообщение
+            if len(header) + len(line) > TEXT_LIMIT:
+                parts = split_telegram_html(line, TEXT_LIMIT - len(header.encode("utf-16-le")) // 2 - 1)
+                if len(parts) > 1:
+                    line = parts[0] + "…"
+            # Страница не длиннее лимита сообщения: не влезшие игры уходят на следующую
+            if lines and len(header) + sum(len(x) + 2 for x in lines) + len(line) > TEXT_LIMIT:
+                games, has_next = games[:i], True
+                break
             lines.append(line)
-        text = "📆 Ближайшие игры:\n\n" + "\n\n".join(lines)
-    kb = [
+        text = header + "\n\n".join(lines)
+        if has_prev:
+            first = games[0]
+            nav.append(InlineKeyboardButton(
+                text="◀️ Раньше", callback_data=f"sch:{flags}:p:{game_cursor(first[8], first[0])}"
+            ))
+        if has_next:
+            last = games[-1]
+            nav.append(InlineKeyboardButton(
+                text="Позже ▶️", callback_data=f"sch:{flags}:n:{game_cursor(last[8], last[0])}"
+            ))
+    kb = [nav] if nav else []
+    kb.append([
+        InlineKeyboardButton(text=label, callback_data=f"sch:{int(with_back)}{code}::")
+        for code, (label, _) in RANGES.items()
+        if code != rng
+    ])
+    kb += [
         [InlineKeyboardButton(text="🎯 Записаться", callback_data="menu_record")],
         [InlineKeyboardButton(text="💬 Вступить в чат", url=CHAT_LINK)],
     ]
@@ -40,15 +107,25 @@ def get_schedule_content(with_back: bool = False):
 
 
 async def show_schedule(message: types.Message, with_back: bool = False):
-    text, kb = get_schedule_content(with_back)
-    await message.answer(text, parse_mode="HTML", reply_markup=kb)
+    text, kb = await get_schedule_content(with_back)
+    await screens.show(message, text, kb)
 
 
 @router.callback_query(lambda c: c.data == "schedule")
 async def cb_schedule(callback: types.CallbackQuery):
     await callback.answer()
-    text, kb = get_schedule_content(with_back=True)
-    try:
-        await callback.message.edit_text(text, parse_mode="HTML", reply_markup=kb)
-    except Exception:
-        await show_schedule(callback.message, with_back=True)
+    text, kb = await get_schedule_content(with_back=True)
+    await screens.show(callback, text, kb)
+
+
+@router.callback_query(F.data.startswith("sch:"))
+async def cb_schedule_page(callback: types.CallbackQuery):
+    """Листание и фильтр по датам: sch:<назад 0/1><фильтр>:<n/p/пусто>:<ключ игры>."""
+    await callback.answer()
+    _, flags, direction, cursor = callback.data.split(":", 3)
+    with_back, rng = flags[:1] == "1", flags[1:]
+    if rng not in RANGES:
+        rng = "a"
+    cursor = parse_game_cursor(cursor)
+    text, kb = await get_schedule_content(with_back, rng, direction if cursor else "", cursor)
+    await screens.show(callback, text, kb)
@@ -2,8 +2,10 @@ import logging
 from aiogram import Router, types, F
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 from config import CHAT_LINK
-from database import get_story, get_scenarios, get_stories_by_scenario
-from utils import text_to_telegram_html
+import db_async
+import screens
+from cache import get_story, get_scenarios, rendered, scenario_kind
+from utils import split_telegram_html, text_to_telegram_html
 
 logger = logging.getLogger(__name__)
 router = Router()
@@ -14,7 +16,7 @@ MESSAGE_MAX_LENGTH = 4096
 
 async def show_scenarios_list(callback: types.CallbackQuery):
     """Показать список сценариев кнопками."""
-    scenarios = get_scenarios()
+    scenarios = await get_scenarios()
     
     text = text_to_telegram_html("📚 *Библиотека сценариев*")
     if not scenarios:
@@ -27,44 +29,16 @@ async def show_scenarios_list(callback: types.CallbackQuery):
     
     kb.append([InlineKeyboardButton(text="🔙 Назад в меню", callback_data="menu_back")])
     reply_kb = InlineKeyboardMarkup(inline_keyboard=kb)
-    try:
-        await callback.bot.edit_message_text(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id,
-            text=text,
-            parse_mode="HTML",
-            reply_markup=reply_kb,
-        )
-    except Exception:
-        try:
-            await callback.bot.delete_message(
-                chat_id=callback.message.chat.id,
-                message_id=callback.message.message_id,
-            )
-        except Exception:
-            pass
-        await callback.bot.send_message(
-            chat_id=callback.message.chat.id,
-            text=text,
-            parse_mode="HTML",
-            reply_markup=reply_kb,
-        )
+    await screens.show(callback, text, reply_kb)
 
 
-async def show_story_screen(bot, chat_id, message_id, story_id: int, edit: bool = True, story_index: int = None, total_stories: int = None, scenario_id: int = None):
-    """Показать экран сюжетной линии сценария.
-    
-    Args:
-        story_id: ID сюжета
-        story_index: индекс текущего сюжета в сценарии (0-based)
-        total_stories: всего сюжетов в сценарии
-        scenario_id: ID сценария (для навигации)
+def _story_screen(story, story_index: int = None, total_stories: int = None, scenario_id: int = None):
+    """Готовые страницы сюжета: [(story_id, HTML-текст, подпись к фото, картинка, клавиатура), ...].
+
+    Длинный текст делится по лимитам Telegram: первая страница — фото с подписью
+    (или сообщение), остальные — сообщения. Листание страниц — внутри сценария.
+    story: (id, title, content, image_url, game_id, order_num, hidden, scenario_id, ...)
     """
-    story = get_story(story_id)
-    if not story:
-        return False
-    
-    # story: (id, title, content, image_url, game_id, order_num, hidden, scenario_id, created_at)
     sid, title, content, image_url, game_id, order_num, hidden, scen_id = story[:8]
     image_url = (image_url or "").strip()
     content = (content or "").strip()
@@ -73,15 +47,38 @@ async def show_story_screen(bot, chat_id, message_id, story_id: int, edit: bool
         header = f"Сюжет {story_index + 1}\n\n"
     else:
         header = ""
-    raw = f"{header}{content}"
-    if len(raw) > MESSAGE_MAX_LENGTH:
-        raw = raw[: MESSAGE_MAX_LENGTH - 3] + "..."
-    display_text = text_to_telegram_html(raw)
-    caption_for_photo = display_text[:CAPTION_MAX_LENGTH]
-    
-    # Кнопки навигации внутри сценария
+    display_text = text_to_telegram_html(f"{header}{content}")
+    parts = split_telegram_html(
+        display_text, MESSAGE_MAX_LENGTH, CAPTION_MAX_LENGTH if image_url else None
+    ) or [display_text]
+    if not scenario_id:
+        parts = parts[:1]
+    return [
+        (
+            sid, part, part if page == 0 else None, image_url if page == 0 else "",
+            _story_keyboard(story_index, total_stories, scenario_id, page, len(parts)),
+        )
+        for page, part in enumerate(parts)
+    ]
+
+
+def _story_keyboard(story_index, total_stories, scenario_id, page: int, pages: int):
     kb = []
-    
+
+    # Страницы длинного сюжета
+    if pages > 1:
+        page_buttons = []
+        if page > 0:
+            page_buttons.append(InlineKeyboardButton(
+                text=f"◀️ Стр. {page}", callback_data=f"story_nav_{scenario_id}_{story_index}_{page - 1}"
+            ))
+        if page < pages - 1:
+            page_buttons.append(InlineKeyboardButton(
+                text=f"Стр. {page + 2} ▶️", callback_data=f"story_nav_{scenario_id}_{story_index}_{page + 1}"
+            ))
+        kb.append(page_buttons)
+
+    # Кнопки навигации внутри сценария
     nav_buttons = []
     if story_index is not None and total_stories is not None and total_stories > 1 and scenario_id:
         if story_index > 0:
@@ -103,39 +100,52 @@ async def show_story_screen(bot, chat_id, message_id, story_id: int, edit: bool
         ],
     ])
     
-    reply_markup = InlineKeyboardMarkup(inline_keyboard=kb)
-
-    if edit:
-        try:
-            await bot.delete_message(chat_id=chat_id, message_id=message_id)
-        except Exception:
-            pass
-
-    if image_url:
-        try:
-            await bot.send_photo(
-                chat_id=chat_id,
-                photo=image_url,
-                caption=caption_for_photo,
-                parse_mode="HTML",
-                reply_markup=reply_markup,
-            )
-        except Exception as e:
-            logger.warning("Story photo send failed story_id=%s: %s", story_id, e)
-            await bot.send_message(
-                chat_id=chat_id,
-                text=display_text,
-                parse_mode="HTML",
-                reply_markup=reply_markup,
-            )
-    else:
-        await bot.send_message(
-            chat_id=chat_id,
-            text=display_text,
-            parse_mode="HTML",
-            reply_markup=reply_markup,
-        )
+    return InlineKeyboardMarkup(inline_keyboard=kb)
+
+
+async def scenario_screens(scenario_id: int):
+    """Видимые сюжеты сценария по порядку — готовые страницы _story_screen.
+
+    Пересобирается только после правки сюжетов этого сценария (версия «scenario:<id>»),
+    поэтому листание сюжетов не обращается к БД.
+    """
+    return await rendered((scenario_kind(scenario_id),), ("story_index", scenario_id), _build_story_index, scenario_id)
+
+
+async def _build_story_index(scenario_id: int):
+    stories = [s for s in await db_async.get_stories_by_scenario(scenario_id) if not s[6]]
+    return [_story_screen(s, i, len(stories), scenario_id) for i, s in enumerate(stories)]
+
+
+async def warm_scenario_screens():
+    """Собрать индексы всех сценариев до начала приёма апдейтов."""
+    for sid, _, _ in await get_scenarios():
+        await scenario_screens(sid)
+
+
+async def _send_story_screen(bot, chat_id, message_id, screen, edit: bool = True, kind: str = None):
+    story_id, display_text, caption_for_photo, image_url, reply_markup = screen
+    await screens.show_screen(
+        bot, chat_id, message_id if edit else None, display_text, reply_markup,
+        photo=image_url or None, caption=caption_for_photo, kind=kind,
+    )
+
 
+async def show_story_screen(bot, chat_id, message_id, story_id: int, edit: bool = True, story_index: int = None, total_stories: int = None, scenario_id: int = None):
+    """Показать экран сюжета по ID (вне листания сценария).
+    
+    Args:
+        story_id: ID сюжета
+        story_index: индекс текущего сюжета в сценарии (0-based)
+        total_stories: всего сюжетов в сценарии
+        scenario_id: ID сценария (для навигации)
+    """
+    story = await get_story(story_id)
+    if not story:
+        return False
+    await _send_story_screen(
+        bot, chat_id, message_id, _story_screen(story, story_index, total_stories, scenario_id)[0], edit
+    )
     return True
 
 
@@ -164,21 +174,14 @@ async def cb_story_scenario(callback: types.CallbackQuery):
     except ValueError:
         return
 
-    stories = get_stories_by_scenario(sid)
-    if not stories:
+    scenario = await scenario_screens(sid)
+    if not scenario:
         await callback.answer("В этом сценарии пока нет сюжетов", show_alert=True)
         return
 
-    first_story = stories[0]
-    await show_story_screen(
-        callback.bot,
-        callback.message.chat.id,
-        callback.message.message_id,
-        first_story[0],
-        edit=True,
-        story_index=0,
-        total_stories=len(stories),
-        scenario_id=sid
+    await _send_story_screen(
+        callback.bot, callback.message.chat.id, callback.message.message_id, scenario[0][0],
+        kind=screens.message_kind(callback.message),
     )
 
 
@@ -197,21 +200,17 @@ async def cb_story_nav(callback: types.CallbackQuery):
     try:
         scenario_id = int(parts[2])
         story_index = int(parts[3])
+        page = int(parts[4]) if len(parts) > 4 else 0
     except ValueError:
         return
     
-    stories = get_stories_by_scenario(scenario_id)
-    if not stories or story_index < 0 or story_index >= len(stories):
+    scenario = await scenario_screens(scenario_id)
+    if story_index < 0 or story_index >= len(scenario):
+        return
+    if page < 0 or page >= len(scenario[story_index]):
         return
     
-    story_id = stories[story_index][0]
-    await show_story_screen(
-        callback.bot,
-        callback.message.chat.id,
-        callback.message.message_id,
-        story_id,
-        edit=True,
-        story_index=story_index,
-        total_stories=len(stories),
-        scenario_id=scenario_id
+    await _send_story_screen(
+        callback.bot, callback.message.chat.id, callback.message.message_id, scenario[story_index][page],
+        kind=screens.message_kind(callback.message),
     )
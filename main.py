@@ -1,10 +1,12 @@
 import asyncio
+import time
+from contextlib import contextmanager
+from dataclasses import replace
 from datetime import datetime, timezone
 
 from aiogram import Bot, Dispatcher, F
 from aiogram.filters import Command
 from aiogram.types import Message, CallbackQuery, InlineKeyboardMarkup, InlineKeyboardButton
-from aiogram.exceptions import TelegramBadRequest
 from aiogram.fsm.context import FSMContext
 from aiogram.client.session.aiohttp import AiohttpSession
 
@@ -17,6 +19,7 @@ from config import (
     POST_CHAT_ID,
     POST_CHAT_THREAD_ID,
     TELEGRAM_PROXY,
+    USER_EVENTS_RETENTION_DAYS,
 )
 
 
@@ -29,29 +32,31 @@ def _post_chat_thread_kwargs(chat_id: int) -> dict:
     ):
         return {"message_thread_id": POST_CHAT_THREAD_ID}
     return {}
-from database import (
+import cache
+import db_async
+import funnel
+import media
+import outbound
+import screens
+from database import create_tables
+from db_async import (
     get_game,
-    create_tables,
     save_user_utm,
     add_subscription,
-    get_subscriptions,
-    get_active_funnel_steps,
-    get_funnel_log_sent_set,
     mark_funnel_step_sent,
     get_due_scheduled_posts,
     mark_scheduled_post_status,
     get_users_for_broadcast,
 )
-from middlewares.user_log import UserLogMiddleware
+from middlewares.user_log import UserLogMiddleware, event_log
 from keyboards import MENU_KB, MENU_TEXT, get_main_reply_kb
-from utils import normalize_telegram_button_url, text_to_telegram_html
 from handlers.main import router as main_router
 from handlers.recording import router as recording_router, start_record as recording_start
 from handlers.format_funnel import router as format_router, format_show_screen
 from handlers.schedule import router as schedule_router
 from handlers.question import router as question_router
 from handlers.admin import router as admin_router
-from handlers.stories import router as stories_router
+from handlers.stories import router as stories_router, warm_scenario_screens
 from handlers.holiday_quest import router as holiday_router
 
 session = AiohttpSession(proxy=TELEGRAM_PROXY) if TELEGRAM_PROXY else None
@@ -69,18 +74,6 @@ async def safe_answer_callback(callback: CallbackQuery):
         pass  # Игнорируем ошибки для старых/невалидных callback'ов
 
 
-def _is_html_parse_error(e: Exception) -> bool:
-    if not isinstance(e, TelegramBadRequest):
-        return False
-    msg = str(e).lower()
-    return (
-        "can't parse entities" in msg
-        or "cant parse entities" in msg
-        or "unsupported start tag" in msg
-        or "wrong tag" in msg
-    )
-
-
 @dp.callback_query(F.data == "menu_record")
 async def cb_menu_record(callback: CallbackQuery, state: FSMContext):
     await safe_answer_callback(callback)
@@ -111,29 +104,8 @@ async def cb_menu_question(callback: CallbackQuery, state: FSMContext):
 async def cb_menu_schedule(callback: CallbackQuery):
     from handlers.schedule import get_schedule_content
     await safe_answer_callback(callback)
-    text, kb = get_schedule_content(with_back=True)
-    try:
-        await callback.bot.edit_message_text(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id,
-            text=text,
-            parse_mode="HTML",
-            reply_markup=kb,
-        )
-    except Exception:
-        try:
-            await callback.bot.delete_message(
-                chat_id=callback.message.chat.id,
-                message_id=callback.message.message_id,
-            )
-        except Exception:
-            pass
-        await callback.bot.send_message(
-            chat_id=callback.message.chat.id,
-            text=text,
-            parse_mode="HTML",
-            reply_markup=kb,
-        )
+    text, kb = await get_schedule_content(with_back=True)
+    await screens.show(callback, text, kb)
 
 @dp.callback_query(F.data == "admin_followup")
 async def cb_admin_followup(callback: CallbackQuery):
@@ -164,7 +136,7 @@ async def cb_admin_edit_game(callback: CallbackQuery):
     except (IndexError, ValueError):
         await callback.answer("Ошибка", show_alert=True)
         return
-    row = get_game(gid)
+    row = await get_game(gid)
     if not row:
         await callback.answer("Игра не найдена", show_alert=True)
         return
@@ -183,169 +155,45 @@ async def cb_admin_edit_game(callback: CallbackQuery):
 async def cb_menu_back(callback: CallbackQuery, state: FSMContext):
     await state.clear()
     await safe_answer_callback(callback)
-    # Всегда удаляем текущее сообщение (может быть фото из сюжета — edit_message_text по нему падает),
-    # затем отправляем меню новым сообщением. Так «Назад» гарантированно срабатывает.
-    try:
-        await callback.bot.delete_message(
-            chat_id=callback.message.chat.id,
-            message_id=callback.message.message_id,
-        )
-    except Exception:
-        pass
-    await callback.bot.send_message(
-        chat_id=callback.message.chat.id,
-        text=MENU_TEXT,
-        reply_markup=MENU_KB,
-    )
+    # Экран правится на месте; с фото (сюжет, «Что за формат») — удаляется и отправляется заново
+    await screens.show(callback, MENU_TEXT, MENU_KB, parse_mode=None)
 
 
-def _funnel_build_queue():
-    """Синхронно собирает очередь
-
-    Элементы: (tg_id, step_id, text, media_type, media_file_id, button_text, button_url).
-    Один запрос на funnel_log — без блокировки БД.
-    """
-    steps = get_active_funnel_steps()
-    if not steps:
-        return []
-    sent_set = get_funnel_log_sent_set()
-    subs = get_subscriptions(limit=100000)
-    now = datetime.now(timezone.utc)
-    queue = []
-    for tg_id, username, first_name, last_name, started_at in subs:
-        if not started_at:
-            continue
-        try:
-            s = str(started_at).replace("Z", "+00:00").strip()
-            started_dt = datetime.fromisoformat(s)
-            if started_dt.tzinfo is None:
-                started_dt = started_dt.replace(tzinfo=timezone.utc)
-        except Exception:
-            continue
-        delta_hours = (now - started_dt).total_seconds() / 3600.0
-        for step in steps:
-            step_id, order_num, delay_hours, text, media_type, media_file_id, button_text, button_url = step
-            if delta_hours < float(delay_hours or 0):
-                continue
-            if (tg_id, step_id) in sent_set:
-                continue
-            queue.append(
-                (
-                    tg_id,
-                    step_id,
-                    text or "",
-                    media_type,
-                    media_file_id,
-                    button_text,
-                    button_url,
-                )
-            )
-    return queue
+async def _send_funnel_step(tg_id: int, step_id: int, msg: outbound.OutboundMessage):
+    status = outbound.SENT
+    if not msg.is_empty:
+        status, _ = await outbound.deliver(bot, tg_id, msg)
+    # Заблокировавшему бота шаг тоже засчитываем — иначе он возвращался бы в очередь
+    if status == outbound.FAILED:
+        await funnel.retry_later(tg_id)
+    else:
+        await mark_funnel_step_sent(tg_id, step_id)
 
 
-# Макс. сообщений автоворонки за один проход — чтобы не перегружать сессию и не задерживать ответы юзеру
-FUNNEL_SENDS_PER_CYCLE = 15
-
 async def funnel_worker():
-    """Фоновый воркер автоворонки. Сбор очереди в executor; за цикл шлём не больше FUNNEL_SENDS_PER_CYCLE."""
-    loop = asyncio.get_event_loop()
+    """Фоновый воркер автоворонки: непрерывно шлёт тем, у кого подошёл курсор, в темпе
+    funnel.acquire(); если слать некому — спит до ближайшей отправки."""
     while True:
         try:
-            queue = await loop.run_in_executor(None, _funnel_build_queue)
-            for tg_id, step_id, text, media_type, media_file_id, button_text, button_url in queue[:FUNNEL_SENDS_PER_CYCLE]:
-                try:
-                    reply_markup = None
-                    if button_text and button_url:
-                        safe_url = normalize_telegram_button_url(button_url)
-                        label = (button_text or "")[:64] or "Ссылка"
-                        reply_markup = InlineKeyboardMarkup(
-                            inline_keyboard=[
-                                [InlineKeyboardButton(text=label, url=safe_url)]
-                            ]
-                        )
-                    html_text = text_to_telegram_html(text) if text else None
-                    parse_mode = "HTML" if html_text else None
-                    if media_type == "photo" and media_file_id:
-                        try:
-                            await bot.send_photo(
-                                tg_id,
-                                media_file_id,
-                                caption=html_text or None,
-                                parse_mode=parse_mode,
-                                reply_markup=reply_markup,
-                            )
-                        except Exception as e:
-                            if _is_html_parse_error(e):
-                                await bot.send_photo(
-                                    tg_id,
-                                    media_file_id,
-                                    caption=(text or None),
-                                    reply_markup=reply_markup,
-                                )
-                            else:
-                                raise
-                    elif media_type == "video" and media_file_id:
-                        try:
-                            await bot.send_video(
-                                tg_id,
-                                media_file_id,
-                                caption=html_text or None,
-                                parse_mode=parse_mode,
-                                reply_markup=reply_markup,
-                            )
-                        except Exception as e:
-                            if _is_html_parse_error(e):
-                                await bot.send_video(
-                                    tg_id,
-                                    media_file_id,
-                                    caption=(text or None),
-                                    reply_markup=reply_markup,
-                                )
-                            else:
-                                raise
-                    elif media_type == "document" and media_file_id:
-                        try:
-                            await bot.send_document(
-                                tg_id,
-                                media_file_id,
-                                caption=html_text or None,
-                                parse_mode=parse_mode,
-                                reply_markup=reply_markup,
-                            )
-                        except Exception as e:
-                            if _is_html_parse_error(e):
-                                await bot.send_document(
-                                    tg_id,
-                                    media_file_id,
-                                    caption=(text or None),
-                                    reply_markup=reply_markup,
-                                )
-                            else:
-                                raise
-                    elif html_text:
-                        try:
-                            await bot.send_message(
-                                tg_id,
-                                html_text,
-                                parse_mode=parse_mode,
-                                reply_markup=reply_markup,
-                            )
-                        except Exception as e:
-                            if _is_html_parse_error(e):
-                                await bot.send_message(tg_id, text, reply_markup=reply_markup)
-                            else:
-                                raise
-                    else:
-                        continue
-                    mark_funnel_step_sent(tg_id, step_id)
-                except Exception:
+            await funnel.refresh()
+            batch = await funnel.due()
+            if not batch:
+                await funnel.wait()
+                continue
+            for tg_id, step_id in batch:
+                msg = funnel.payload(step_id)
+                if msg is None:
+                    # Шаг выключен или удалён — курсор пересчитается в funnel.refresh
                     continue
-                await asyncio.sleep(0.08)
+                await funnel.acquire()
+                funnel.start(tg_id, _send_funnel_step(tg_id, step_id, msg))
         except asyncio.CancelledError:
+            # Начатые отправки дописываем: иначе сообщение уйдёт, а отметка — нет
+            await funnel.drain(2.0)
             break
         except Exception as e:
             print(f"Ошибка воркера автоворонки: {e}")
-        await asyncio.sleep(60)
+            await asyncio.sleep(60)
 
 
 async def scheduled_posts_worker():
@@ -353,7 +201,7 @@ async def scheduled_posts_worker():
     while True:
         try:
             now_utc = datetime.now(timezone.utc).isoformat(timespec="seconds")
-            posts = get_due_scheduled_posts(now_utc, limit=50)
+            posts = await get_due_scheduled_posts(now_utc, limit=50)
             for pid, text, media_type, media_file_id, to_ch1, to_ch2, to_chat, to_admins, button_text, button_url in posts:
                 targets = []
                 if to_ch1 and POST_CHANNEL_1 is not None:
@@ -364,117 +212,61 @@ async def scheduled_posts_worker():
                     targets.append(POST_CHAT_ID)
                 if to_admins:
                     # всем пользователям бота (как в рассылке, фильтр all)
-                    user_ids = get_users_for_broadcast("all")
+                    user_ids = await get_users_for_broadcast("all")
                     targets.extend(user_ids)
                 # на всякий случай дедуп
                 targets = list(dict.fromkeys(targets))
                 if not targets:
-                    mark_scheduled_post_status(pid, "failed", "Нет целевых чатов/каналов для отправки")
+                    await mark_scheduled_post_status(pid, "failed", "Нет целевых чатов/каналов для отправки")
                     continue
                 ok = True
                 err = ""
-                html_text = text_to_telegram_html(text) if text else None
-                parse_mode = "HTML" if html_text else None
+                msg = outbound.post_message(text, media_type, media_file_id, button_text, button_url)
                 for chat_id in targets:
-                    try:
-                        th = _post_chat_thread_kwargs(chat_id)
-                        reply_markup = None
-                        if button_text and button_url:
-                            safe_url = normalize_telegram_button_url(button_url)
-                            label = (button_text or "")[:64] or "Ссылка"
-                            reply_markup = InlineKeyboardMarkup(
-                                inline_keyboard=[
-                                    [InlineKeyboardButton(text=label, url=safe_url)]
-                                ]
-                            )
-                        if media_type == "photo" and media_file_id:
-                            try:
-                                await bot.send_photo(
-                                    chat_id,
-                                    media_file_id,
-                                    caption=html_text or None,
-                                    parse_mode=parse_mode,
-                                    reply_markup=reply_markup,
-                                    **th,
-                                )
-                            except Exception as e:
-                                if _is_html_parse_error(e):
-                                    await bot.send_photo(
-                                        chat_id,
-                                        media_file_id,
-                                        caption=(text or None),
-                                        reply_markup=reply_markup,
-                                        **th,
-                                    )
-                                else:
-                                    raise
-                        elif media_type == "video" and media_file_id:
-                            try:
-                                await bot.send_video(
-                                    chat_id,
-                                    media_file_id,
-                                    caption=html_text or None,
-                                    parse_mode=parse_mode,
-                                    reply_markup=reply_markup,
-                                    **th,
-                                )
-                            except Exception as e:
-                                if _is_html_parse_error(e):
-                                    await bot.send_video(
-                                        chat_id,
-                                        media_file_id,
-                                        caption=(text or None),
-                                        reply_markup=reply_markup,
-                                        **th,
-                                    )
-                                else:
-                                    raise
-                        elif media_type == "document" and media_file_id:
-                            try:
-                                await bot.send_document(
-                                    chat_id,
-                                    media_file_id,
-                                    caption=html_text or None,
-                                    parse_mode=parse_mode,
-                                    reply_markup=reply_markup,
-                                    **th,
-                                )
-                            except Exception as e:
-                                if _is_html_parse_error(e):
-                                    await bot.send_document(
-                                        chat_id,
-                                        media_file_id,
-                                        caption=(text or None),
-                                        reply_markup=reply_markup,
-                                        **th,
-                                    )
-                                else:
-                                    raise
-                        else:
-                            try:
-                                await bot.send_message(
-                                    chat_id,
-                                    html_text or "",
-                                    parse_mode=parse_mode,
-                                    reply_markup=reply_markup,
-                                    **th,
-                                )
-                            except Exception as e:
-                                if _is_html_parse_error(e):
-                                    await bot.send_message(chat_id, text or "", reply_markup=reply_markup, **th)
-                                else:
-                                    raise
-                        await asyncio.sleep(0.1)
-                    except Exception as e:
+                    th = _post_chat_thread_kwargs(chat_id)
+                    target_msg = replace(msg, thread_id=th["message_thread_id"]) if th else msg
+                    status, error = await outbound.deliver(bot, chat_id, target_msg)
+                    if status != outbound.SENT:
                         ok = False
-                        err = str(e)[:200]
-                mark_scheduled_post_status(pid, "sent" if ok else "failed", err)
+                        err = error
+                    await asyncio.sleep(0.1)
+                await mark_scheduled_post_status(pid, "sent" if ok else "failed", err)
         except asyncio.CancelledError:
             break
         except Exception as e:
             print(f"Ошибка воркера отложенных постов: {e}")
         await asyncio.sleep(30)
 
+async def media_warm_worker():
+    """Один раз при запуске: загрузить картинки сюжетов и «Что за формат» в служебный чат ради file_id."""
+    try:
+        started = time.perf_counter()
+        warmed = await media.warm(bot)
+        if warmed:
+            print(f"Картинки: загружено {warmed} за {time.perf_counter() - started:.1f} с")
+    except asyncio.CancelledError:
+        pass
+    except Exception as e:
+        print(f"Ошибка прогрева картинок: {e}")
+
+async def maintenance_worker():
+    """Раз в сутки: свёртки user_events, перенос старых сырых событий в архив, освобождение места."""
+    await asyncio.sleep(60)
+    while True:
+        try:
+            started = time.perf_counter()
+            result = await db_async.maintain_user_events(USER_EVENTS_RETENTION_DAYS)
+            if result["rolled_days"] or result["archived_rows"]:
+                print(
+                    f"user_events: свёрнуто дней {result['rolled_days']}, в архив {result['archived_rows']} строк, "
+                    f"освобождено страниц {result['freed_pages']} за {time.perf_counter() - started:.1f} с"
+                )
+        except asyncio.CancelledError:
+            break
+        except Exception as e:
+            print(f"Ошибка обслуживания user_events: {e}")
+        await asyncio.sleep(24 * 3600)
+
 dp.include_router(admin_router)  # первым — admin callbacks (adm_edit_, adm_ef_ и т.д.)
 dp.include_router(question_router)
 dp.include_router(holiday_router)
@@ -488,12 +280,13 @@ dp.include_router(stories_router)
 @dp.message(Command("start"))
 async def cmd_start(message: Message):
     user = message.from_user
-    add_subscription(
+    if await add_subscription(
         user.id,
         username=user.username,
         first_name=user.first_name,
         last_name=user.last_name,
-    )
+    ):
+        funnel.subscribed()
     utm = {}
     if message.text and message.text.startswith("/start ") and len(message.text.split()) >= 2:
         args = message.text.split(maxsplit=1)[1]
@@ -505,7 +298,7 @@ async def cmd_start(message: Message):
         if len(parts) >= 3:
             utm["utm_campaign"] = parts[2]
     if utm:
-        save_user_utm(user.id, **utm)
+        await save_user_utm(user.id, **utm)
     # Ставим reply-клавиатуру (над полем ввода), затем отправляем inline-меню
     await message.answer("Кнопки:", reply_markup=get_main_reply_kb(user.id))
     await message.answer(MENU_TEXT, reply_markup=MENU_KB)
@@ -526,34 +319,75 @@ async def btn_admin(message: Message):
     await _cmd_admin(message)
 
 
+_boot_timings: list[tuple[str, float]] = []
+
+
+@contextmanager
+def _boot_step(name: str):
+    """Замерить шаг запуска для отчёта _print_boot_report()."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        _boot_timings.append((name, time.perf_counter() - started))
+
+
+def _print_boot_report(details: list[tuple[str, float]]):
+    total = sum(sec for _, sec in _boot_timings)
+    print(f"Запуск: {total * 1000:.1f} мс")
+    for name, sec in _boot_timings:
+        print(f"  {name}: {sec * 1000:.1f} мс")
+    for name, sec in details:
+        print(f"    миграция {name}: {sec * 1000:.1f} мс")
+
+
+# Сколько ждать воркеры при остановке: воронке нужно дописать начатые отправки (drain — до 2 с)
+WORKERS_STOP_TIMEOUT = 5.0
+
+
+async def _stop_workers(tasks):
+    """Отменить фоновые воркеры и дождаться их завершения (не дольше WORKERS_STOP_TIMEOUT)."""
+    for task in tasks:
+        task.cancel()
+    await asyncio.wait(tasks, timeout=WORKERS_STOP_TIMEOUT)
+
+
 async def main():
-    create_tables()
-    from database import seed_demo_data
-    seed_demo_data()
+    with _boot_step("схема БД"):
+        migrations = create_tables()
+    with _boot_step("прогрев кэша контента"):
+        await cache.warm()
+        await warm_scenario_screens()
+    with _boot_step("очередь автоворонки"):
+        await funnel.refresh()
+    _print_boot_report(migrations)
     print("Бот запущен. ADMIN_IDS:", ADMIN_IDS or "(пусто)")
+    event_log.start()
     funnel_task = asyncio.create_task(funnel_worker())
     scheduled_task = asyncio.create_task(scheduled_posts_worker())
+    maintenance_task = asyncio.create_task(maintenance_worker())
+    media_task = asyncio.create_task(media_warm_worker())
     try:
         await dp.start_polling(bot)
     except asyncio.CancelledError:
         print("\nБот остановлен.")
-        for task in (funnel_task, scheduled_task):
-            task.cancel()
-            try:
-                await asyncio.wait_for(asyncio.shield(task), timeout=2.0)
-            except (asyncio.CancelledError, asyncio.TimeoutError):
-                pass
-        try:
-            await bot.session.close()
-        except Exception:
-            pass
         raise
     except KeyboardInterrupt:
         print("\nБот остановлен пользователем.")
     except Exception as e:
         print(f"Ошибка при работе бота: {e}")
         raise
-
+    finally:
+        # start_polling сам ловит SIGINT/SIGTERM и возвращается — воркеры останавливаем здесь,
+        # пока БД ещё работает: воронка дописывает начатые отправки и их отметки (funnel.drain)
+        await _stop_workers((funnel_task, scheduled_task, maintenance_task, media_task))
+        try:
+            await bot.session.close()
+        except Exception:
+            pass
+        # Дописываем буфер событий и то, что уже стоит в очереди писателя БД
+        await event_log.stop()
+        db_async.shutdown()
 
 if __name__ == "__main__":
     try:
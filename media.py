@@ -0,0 +1,92 @@
+"""Реестр file_id для картинок по URL (stories.image_url, format_info.image_url).
+
+Первая успешная отправка URL запоминает file_id из ответа Telegram, дальше отправляется
+file_id — Telegram не скачивает картинку заново. При запуске картинки прогреваются
+отправкой в MEDIA_STORAGE_CHAT_ID. Смена картинки в админке удаляет запись (триггер
+миграции 11); другие процессы замечают это по версии контента «media».
+"""
+import asyncio
+
+import database
+import db_async
+from config import MEDIA_STORAGE_CHAT_ID
+
+_files: dict = {}
+_version = None
+hits = 0
+misses = 0
+uploads = 0
+
+
+def is_url(ref: str | None) -> bool:
+    return bool(ref) and ref.startswith(("http://", "https://"))
+
+
+async def _registry() -> dict:
+    global _files, _version
+    # Версия снимается до чтения: запись, добавленная во время чтения, перечитается в следующий раз
+    version = database.content_version("media")
+    if version != _version:
+        _files = await db_async.get_media_files()
+        _version = version
+    return _files
+
+
+async def resolve(ref: str) -> str:
+    """file_id вместо URL, если картинка уже загружена; иначе ref как есть."""
+    global hits, misses
+    if not is_url(ref):
+        return ref
+    file_id = (await _registry()).get(ref)
+    if file_id:
+        hits += 1
+        return file_id
+    misses += 1
+    return ref
+
+
+async def remember(ref: str, message):
+    """Запомнить file_id из ответа send_photo / edit_message_media для URL ref."""
+    global uploads
+    photo = getattr(message, "photo", None)
+    if not is_url(ref) or not photo:
+        return
+    file_id = photo[-1].file_id
+    if _files.get(ref) == file_id:
+        return
+    _files[ref] = file_id
+    uploads += 1
+    await db_async.save_media_file(ref, file_id)
+
+
+async def forget(ref: str):
+    """file_id больше не принимается Telegram — следующая отправка пойдёт по URL."""
+    _files.pop(ref, None)
+    await db_async.delete_media_file(ref)
+
+
+async def warm(bot) -> int:
+    """Загрузить в Telegram картинки, для которых ещё нет file_id. Возвращает число загруженных."""
+    if MEDIA_STORAGE_CHAT_ID is None:
+        return 0
+    known = await _registry()
+    warmed = 0
+    for url in await db_async.get_image_urls():
+        if url in known:
+            continue
+        try:
+            msg = await bot.send_photo(MEDIA_STORAGE_CHAT_ID, url, disable_notification=True)
+            await remember(url, msg)
+            warmed += 1
+            try:
+                await bot.delete_message(MEDIA_STORAGE_CHAT_ID, msg.message_id)
+            except Exception:
+                pass
+        except Exception as e:
+            print(f"media: не удалось загрузить {url}: {e}")
+        await asyncio.sleep(0.1)
+    return warmed
+
+
+def stats() -> dict:
+    return {"files": len(_files), "hits": hits, "misses": misses, "uploads": uploads}
@@ -1,18 +1,139 @@
-"""Логирует каждое действие пользователя (кроме админов) в user_events. В executor, чтобы не блокировать ответ бота."""
+"""Логирует каждое действие пользователя (кроме админов) в user_events.
+
+События складываются в ограниченную очередь в памяти; фоновая задача пишет их пачками
+(одна транзакция на пачку) каждые USER_LOG_FLUSH_MS мс или по USER_LOG_FLUSH_ROWS строк.
+Ответ бота не ждёт БД, а записи не дёргают fsync на каждое нажатие.
+"""
 import asyncio
+import time
 from typing import Callable, Dict, Any, Awaitable
 from aiogram import BaseMiddleware
 from aiogram.types import Message, CallbackQuery, TelegramObject
 
-from config import ADMIN_IDS
-from database import log_user_event
+from config import (
+    ADMIN_IDS,
+    USER_LOG_QUEUE_SIZE,
+    USER_LOG_FLUSH_MS,
+    USER_LOG_FLUSH_ROWS,
+    USER_LOG_OVERFLOW,
+    USER_LOG_SAMPLE_EVERY,
+)
+import db_async
+
+
+class EventLogQueue:
+    """Очередь событий с групповой записью. Политика переполнения: drop / sample / block."""
+
+    def __init__(self, maxsize: int, flush_ms: int, flush_rows: int, overflow: str, sample_every: int):
+        self._queue: asyncio.Queue = asyncio.Queue(maxsize=maxsize)
+        self._flush_s = flush_ms / 1000
+        self._flush_rows = flush_rows
+        self._overflow = overflow if overflow in ("drop", "sample", "block") else "drop"
+        self._sample_every = sample_every
+        self._task: asyncio.Task | None = None
+        self._batch: list = []
+        self._sample_n = 0
+        self.enqueued = 0
+        self.flushed = 0
+        self.dropped = 0
+        self.batches = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+
+    async def put(self, row: tuple):
+        q = self._queue
+        if self._overflow == "block":
+            await q.put(row)
+            self.enqueued += 1
+            return
+        if self._overflow == "sample" and q.qsize() >= q.maxsize // 2:
+            self._sample_n += 1
+            if self._sample_n % self._sample_every:
+                self.dropped += 1
+                return
+        try:
+            q.put_nowait(row)
+            self.enqueued += 1
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Остановить фоновую запись и дописать всё, что осталось в очереди."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        # Пачка, которую задача собирала в момент остановки, + остаток очереди
+        batch, self._batch = self._batch, []
+        batch += self._drain(self._flush_rows)
+        while batch:
+            await self._flush(batch)
+            batch = self._drain(self._flush_rows)
+
+    def _drain(self, limit: int) -> list:
+        batch = []
+        while len(batch) < limit:
+            try:
+                batch.append(self._queue.get_nowait())
+            except asyncio.QueueEmpty:
+                break
+        return batch
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            self._batch = [await self._queue.get()]
+            deadline = loop.time() + self._flush_s
+            while len(self._batch) < self._flush_rows:
+                self._batch += self._drain(self._flush_rows - len(self._batch))
+                timeout = deadline - loop.time()
+                if len(self._batch) >= self._flush_rows or timeout <= 0:
+                    break
+                try:
+                    self._batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            batch, self._batch = self._batch, []
+            await self._flush(batch)
+
+    async def _flush(self, batch: list):
+        started = time.perf_counter()
+        try:
+            # shield: пачка, уже отданная писателю, дописывается и при остановке
+            await asyncio.shield(db_async.log_user_events(batch))
+            self.flushed += len(batch)
+            self.batches += 1
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            self.errors += 1
+            self.dropped += len(batch)
+            print(f"user_log: не удалось записать {len(batch)} событий: {e}")
+        self.last_flush_ms = (time.perf_counter() - started) * 1000
+
+    def stats(self) -> dict:
+        return {
+            "policy": self._overflow,
+            "queued": self._queue.qsize(),
+            "enqueued": self.enqueued,
+            "flushed": self.flushed,
+            "dropped": self.dropped,
+            "batches": self.batches,
+            "errors": self.errors,
+            "last_flush_ms": self.last_flush_ms,
+        }
 
 
-def _log_user_event_sync(tg_id: int, username: str, first_name: str, last_name: str, event_type: str) -> None:
-    try:
-        log_user_event(tg_id, username, first_name, last_name, event_type)
-    except Exception:
-        pass
+event_log = EventLogQueue(
+    USER_LOG_QUEUE_SIZE, USER_LOG_FLUSH_MS, USER_LOG_FLUSH_ROWS, USER_LOG_OVERFLOW, USER_LOG_SAMPLE_EVERY
+)
 
 
 class UserLogMiddleware(BaseMiddleware):
@@ -37,16 +158,12 @@ class UserLogMiddleware(BaseMiddleware):
             event_type = "cb:" + (event.data[:80] if event.data else "?")
 
         if user and user.id not in ADMIN_IDS and event_type:
-            loop = asyncio.get_event_loop()
-            loop.run_in_executor(
-                None,
-                lambda: _log_user_event_sync(
-                    user.id,
-                    user.username or "",
-                    user.first_name or "",
-                    user.last_name or "",
-                    event_type,
-                ),
-            )
+            await event_log.put((
+                user.id,
+                user.username or "",
+                user.first_name or "",
+                user.last_name or "",
+                event_type,
+            ))
 
         return await handler(event, data)
@@ -0,0 +1,223 @@
+"""Исходящие сообщения воркеров и рассылок: одно описание сообщения и одна функция доставки.
+
+OutboundMessage — что отправить (текст, медиа или альбом, клавиатура, тема форума).
+Длинный текст заранее разбит по лимитам Telegram: первая часть — подпись или сообщение,
+остальные уходят следом, клавиатура — под последней.
+deliver() — как: send_* по виду медиа, повтор без разметки при ошибке HTML, ожидание
+RetryAfter, повтор при таймауте — с той части, на которой отправка прервалась;
+заблокировавший бота пользователь — отдельный статус.
+"""
+import asyncio
+import time
+from collections import Counter
+from dataclasses import dataclass
+from functools import lru_cache, partial
+from html import escape
+
+from aiogram.exceptions import (
+    TelegramBadRequest,
+    TelegramForbiddenError,
+    TelegramNetworkError,
+    TelegramRetryAfter,
+)
+from aiogram.types import (
+    InlineKeyboardMarkup,
+    InlineKeyboardButton,
+    InputMediaPhoto,
+    InputMediaVideo,
+    InputMediaDocument,
+)
+
+from utils import (
+    normalize_telegram_button_url,
+    split_telegram_html,
+    telegram_html_error,
+    telegram_html_to_text,
+    text_to_telegram_html,
+)
+
+SENT = "sent"
+BLOCKED = "blocked"
+FAILED = "failed"
+
+# Таймаут одного запроса к Bot API и число повторов при таймауте / RetryAfter
+SEND_TIMEOUT = 30
+SEND_ATTEMPTS = 3
+
+CAPTION_MAX_LENGTH = 1024
+MESSAGE_MAX_LENGTH = 4096
+
+_ALBUM_MEDIA = {"photo": InputMediaPhoto, "video": InputMediaVideo, "document": InputMediaDocument}
+
+_counters: Counter = Counter()
+# До какого момента (time.monotonic) Telegram просил не слать после последнего RetryAfter —
+# по нему притормаживают фоновые рассылки
+flood_until = 0.0
+
+
+@dataclass(frozen=True, eq=False)
+class OutboundMessage:
+    """Готовое к отправке сообщение; html уже посчитан и разбит: html — подпись к медиа
+    или первое сообщение, more — следующие сообщения."""
+
+    text: str = ""
+    html: str = ""
+    more: tuple = ()
+    media_kind: str | None = None  # photo / video / document
+    file_id: str | None = None
+    album: tuple = ()  # file_id для альбома (2–10 штук одного media_kind)
+    reply_markup: InlineKeyboardMarkup | None = None
+    thread_id: int | None = None
+
+    @property
+    def is_empty(self) -> bool:
+        return not self.text and not self.file_id and not self.album
+
+
+def make_message(text: str, media_kind=None, file_id=None, album=(), reply_markup=None, thread_id=None):
+    """OutboundMessage из исходного текста с разметкой *жирный* / _курсив_ и т.д."""
+    text = text if text and text.strip() else ""
+    html = text_to_telegram_html(text)
+    if html and telegram_html_error(html):
+        # Telegram такой HTML не примет — сразу шлём текст как есть, без лишнего запроса с ошибкой
+        _counters["html_rejected"] += 1
+        html = escape(text, quote=False)
+    if len(album) < 2:
+        file_id = file_id or (album[0] if album else None)
+        album = ()
+    # У альбома с кнопками текст идёт сообщениями, а не подписью
+    with_caption = bool(media_kind and (file_id or (album and not reply_markup)))
+    parts = split_telegram_html(html, MESSAGE_MAX_LENGTH, CAPTION_MAX_LENGTH if with_caption else None)
+    return OutboundMessage(
+        text=text,
+        html=parts[0] if parts else "",
+        more=tuple(parts[1:]),
+        media_kind=media_kind if (file_id or album) else None,
+        file_id=file_id if media_kind else None,
+        album=tuple(album),
+        reply_markup=reply_markup,
+        thread_id=thread_id,
+    )
+
+
+def url_button_markup(button_text: str | None, button_url: str | None) -> InlineKeyboardMarkup | None:
+    """Одна кнопка-ссылка под постом (шаги автоворонки, отложенные посты)."""
+    if not (button_text and button_url):
+        return None
+    label = button_text[:64] or "Ссылка"
+    return InlineKeyboardMarkup(
+        inline_keyboard=[[InlineKeyboardButton(text=label, url=normalize_telegram_button_url(button_url))]]
+    )
+
+
+@lru_cache(maxsize=256)
+def post_message(text, media_kind, file_id, button_text, button_url) -> OutboundMessage:
+    """Пост с кнопкой-ссылкой. Кэш по содержимому: одинаковый пост собирается один раз,
+    правка даёт новые аргументы — и новую запись."""
+    return make_message(text, media_kind, file_id, reply_markup=url_button_markup(button_text, button_url))
+
+
+def is_html_parse_error(e: Exception) -> bool:
+    if not isinstance(e, TelegramBadRequest):
+        return False
+    msg = str(e).lower()
+    return (
+        "can't parse entities" in msg
+        or "cant parse entities" in msg
+        or "unsupported start tag" in msg
+        or "wrong tag" in msg
+    )
+
+
+def _requests(bot, chat_id: int, msg: OutboundMessage, html: bool) -> list:
+    """Запросы к Bot API по порядку (без вызова): медиа или первое сообщение, затем продолжение текста."""
+    common = {"request_timeout": SEND_TIMEOUT}
+    if msg.thread_id is not None:
+        common["message_thread_id"] = msg.thread_id
+    parse_mode = "HTML" if html else None
+    body = (lambda part: part) if html else telegram_html_to_text
+    head = body(msg.html)
+    # Сообщения после медиа: продолжение текста; клавиатура — под последним отправленным
+    texts = [body(part) for part in msg.more]
+    if msg.album:
+        media_cls = _ALBUM_MEDIA.get(msg.media_kind, InputMediaPhoto)
+        # У альбома нет клавиатуры: с кнопками текст уходит отдельным сообщением после альбома
+        if msg.reply_markup:
+            texts.insert(0, head or "👇")
+            head = ""
+        items = [
+            media_cls(media=fid, caption=head or None, parse_mode=parse_mode) if i == 0 else media_cls(media=fid)
+            for i, fid in enumerate(msg.album[:10])
+        ]
+        requests = [partial(bot.send_media_group, chat_id, media=items, **common)]
+    else:
+        kwargs = {"reply_markup": None if texts else msg.reply_markup, "parse_mode": parse_mode, **common}
+        if msg.file_id and msg.media_kind == "photo":
+            requests = [partial(bot.send_photo, chat_id, msg.file_id, caption=head or None, **kwargs)]
+        elif msg.file_id and msg.media_kind == "video":
+            requests = [partial(bot.send_video, chat_id, msg.file_id, caption=head or None, **kwargs)]
+        elif msg.file_id and msg.media_kind == "document":
+            requests = [partial(bot.send_document, chat_id, msg.file_id, caption=head or None, **kwargs)]
+        else:
+            requests = [partial(bot.send_message, chat_id, head, **kwargs)]
+    for i, part in enumerate(texts):
+        markup = msg.reply_markup if i == len(texts) - 1 else None
+        requests.append(partial(bot.send_message, chat_id, part, parse_mode=parse_mode, reply_markup=markup, **common))
+    return requests
+
+
+async def deliver(bot, chat_id: int, msg: OutboundMessage) -> tuple[str, str]:
+    """Отправить msg в chat_id. Возвращает (SENT / BLOCKED / FAILED, текст ошибки).
+
+    Повтор после RetryAfter, таймаута или ошибки разметки продолжает с упавшей части:
+    уже доставленные медиа и сообщения второй раз не уходят.
+    """
+    global flood_until
+    if msg.is_empty:
+        _counters[FAILED] += 1
+        return FAILED, "пустое сообщение"
+    html = bool(msg.html)
+    requests = _requests(bot, chat_id, msg, html)
+    done = 0
+    attempts = 0
+    while True:
+        try:
+            while done < len(requests):
+                await requests[done]()
+                done += 1
+            _counters[SENT] += 1
+            return SENT, ""
+        except TelegramRetryAfter as e:
+            _counters["retry_after"] += 1
+            flood_until = max(flood_until, time.monotonic() + e.retry_after)
+            attempts += 1
+            if attempts >= SEND_ATTEMPTS:
+                error = str(e)
+                break
+            await asyncio.sleep(e.retry_after)
+        except TelegramForbiddenError as e:
+            # Пользователь заблокировал бота или бот удалён из чата — повторять бессмысленно
+            _counters[BLOCKED] += 1
+            return BLOCKED, str(e)[:200]
+        except (TelegramNetworkError, asyncio.TimeoutError) as e:
+            _counters["timeouts"] += 1
+            attempts += 1
+            if attempts >= SEND_ATTEMPTS:
+                error = str(e) or "timeout"
+                break
+            await asyncio.sleep(attempts)
+        except Exception as e:
+            if html and is_html_parse_error(e):
+                # Разметка не разобралась — оставшиеся части тем же текстом без parse_mode
+                _counters["parse_fallbacks"] += 1
+                html = False
+                requests = _requests(bot, chat_id, msg, html)
+                continue
+            error = str(e)
+            break
+    _counters[FAILED] += 1
+    return FAILED, error[:200]
+
+
+def stats() -> dict:
+    return dict(_counters)
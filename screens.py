@@ -0,0 +1,151 @@
+"""Навигация «на месте»: экран чата — одно сообщение, которое правится, а не пересоздаётся.
+
+Для каждого чата помним id сообщения-экрана, его вид (text / photo) и картинку. Переход:
+- текст → текст: edit_message_text;
+- фото → фото с той же картинкой: edit_message_caption, с другой — edit_message_media;
+- текст ↔ фото: Telegram не меняет вид сообщения — delete + send.
+Если правка не удалась (сообщение удалено, старше 48 ч и т.п.) — экран отправляется заново.
+Картинки по URL отправляются по file_id из реестра media.
+"""
+import logging
+from collections import Counter, OrderedDict
+
+from aiogram.exceptions import TelegramBadRequest
+from aiogram.types import CallbackQuery, InputMediaPhoto
+
+import media
+
+logger = logging.getLogger(__name__)
+
+# Экранов в памяти; самые давние забываются (для них вид берётся из самого сообщения)
+SCREENS_MAX = 100_000
+
+_screens: OrderedDict = OrderedDict()  # chat_id -> (message_id, kind, photo)
+_calls: Counter = Counter()
+_navigations = 0
+_resends = 0
+
+
+def _remember(chat_id: int, message_id: int, kind: str, photo: str | None):
+    _screens[chat_id] = (message_id, kind, photo)
+    _screens.move_to_end(chat_id)
+    if len(_screens) > SCREENS_MAX:
+        _screens.popitem(last=False)
+
+
+def message_kind(message) -> str:
+    """Вид сообщения для show_screen(kind=...)."""
+    return "photo" if getattr(message, "photo", None) else "text"
+
+
+def _not_modified(e: Exception) -> bool:
+    return "message is not modified" in str(e).lower()
+
+
+async def _call(method, **kwargs):
+    _calls[method.__name__] += 1
+    return await method(**kwargs)
+
+
+async def _send_photo(bot, chat_id: int, photo: str, **kwargs):
+    """send_photo по file_id из реестра media (если есть), иначе по URL с запоминанием file_id."""
+    ref = await media.resolve(photo)
+    try:
+        msg = await _call(bot.send_photo, chat_id=chat_id, photo=ref, **kwargs)
+    except TelegramBadRequest:
+        if ref == photo:
+            raise
+        # file_id перестал приниматься (например, сменился токен бота) — шлём по URL
+        await media.forget(photo)
+        msg = await _call(bot.send_photo, chat_id=chat_id, photo=photo, **kwargs)
+    await media.remember(photo, msg)
+    return msg
+
+
+async def _send(bot, chat_id: int, text: str, reply_markup, photo, caption, parse_mode):
+    if photo:
+        try:
+            msg = await _send_photo(
+                bot, chat_id, photo, caption=caption, parse_mode=parse_mode, reply_markup=reply_markup,
+            )
+            _remember(chat_id, msg.message_id, "photo", photo)
+            return msg
+        except Exception as e:
+            logger.warning("Screen photo send failed chat_id=%s: %s", chat_id, e)
+    msg = await _call(bot.send_message, chat_id=chat_id, text=text, parse_mode=parse_mode, reply_markup=reply_markup)
+    _remember(chat_id, msg.message_id, "text", None)
+    return msg
+
+
+async def show_screen(
+    bot, chat_id: int, message_id: int | None, text: str, reply_markup=None,
+    photo: str | None = None, caption: str | None = None, parse_mode: str | None = "HTML", kind: str | None = None,
+):
+    """Показать экран в сообщении message_id (None — новым сообщением).
+
+    kind — вид сообщения message_id, если он известен вызывающему; иначе берётся из памяти
+    (или считается текстом — при ошибке правки экран просто отправится заново).
+    """
+    global _navigations, _resends
+    _navigations += 1
+    caption = text if caption is None else caption
+    current = _screens.get(chat_id)
+    current_photo = None
+    if current and current[0] == message_id:
+        kind, current_photo = current[1], current[2]
+    want = "photo" if photo else "text"
+    if message_id is not None and want == (kind or "text"):
+        try:
+            if want == "text":
+                await _call(
+                    bot.edit_message_text, chat_id=chat_id, message_id=message_id, text=text,
+                    parse_mode=parse_mode, reply_markup=reply_markup,
+                )
+            elif photo == current_photo:
+                await _call(
+                    bot.edit_message_caption, chat_id=chat_id, message_id=message_id, caption=caption,
+                    parse_mode=parse_mode, reply_markup=reply_markup,
+                )
+            else:
+                msg = await _call(
+                    bot.edit_message_media, chat_id=chat_id, message_id=message_id,
+                    media=InputMediaPhoto(media=await media.resolve(photo), caption=caption, parse_mode=parse_mode),
+                    reply_markup=reply_markup,
+                )
+                await media.remember(photo, msg)
+            _remember(chat_id, message_id, want, photo)
+            return None
+        except Exception as e:
+            if _not_modified(e):
+                _remember(chat_id, message_id, want, photo)
+                return None
+    _resends += 1
+    if message_id is not None:
+        try:
+            await _call(bot.delete_message, chat_id=chat_id, message_id=message_id)
+        except Exception:
+            pass
+    return await _send(bot, chat_id, text, reply_markup, photo, caption, parse_mode)
+
+
+async def show(target, text: str, reply_markup=None, photo: str | None = None, caption: str | None = None,
+               parse_mode: str | None = "HTML"):
+    """Экран в ответ на нажатие (правится сообщение с кнопкой) или на сообщение (новый экран)."""
+    if isinstance(target, CallbackQuery):
+        msg = target.message
+        return await show_screen(
+            target.bot, msg.chat.id, msg.message_id, text, reply_markup, photo, caption, parse_mode, message_kind(msg)
+        )
+    return await show_screen(target.bot, target.chat.id, None, text, reply_markup, photo, caption, parse_mode)
+
+
+def stats() -> dict:
+    api_calls = sum(_calls.values())
+    return {
+        "navigations": _navigations,
+        "api_calls": api_calls,
+        "calls_per_nav": api_calls / _navigations if _navigations else 0.0,
+        "resends": _resends,
+        "methods": dict(_calls),
+        "screens": len(_screens),
+    }
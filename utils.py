@@ -1,24 +1,217 @@
 """Экранирование для Telegram Markdown. Без parse_mode надёжнее для контента из БД/пользователя."""
 
 import re
+from bisect import bisect_right
+from datetime import datetime
+from functools import lru_cache
+from html import unescape
+from itertools import accumulate
 
 
+_MARKUP_TAGS = {"__": "u", "*": "b", "_": "i", "~": "s"}
+_MARKUP_SPLIT = re.compile(r"(__|[*_~])")
+
+
+@lru_cache(maxsize=4096)
 def text_to_telegram_html(text: str) -> str:
     """
     Конвертирует разметку в HTML для Telegram (по всему проекту).
     Поддерживает: *жирный*, _курсив_, __подчёркнутый__, ~зачёркнутый~.
     Отправлять с parse_mode="HTML".
+
+    Один проход по тексту: одинаковые маркеры парно открывают и закрывают тег,
+    непарный маркер остаётся символом. Если пары пересекаются (*a _b* c_), внутренний
+    тег закрывается и открывается заново — HTML всегда правильно вложен.
+    Результат кэшируется: шаги воронки и экраны конвертируются один раз.
     """
     if not text or not text.strip():
         return ""
     s = str(text)
     # Telegram HTML parse_mode: минимально экранируем HTML-спецсимволы
     s = s.replace("&", "&amp;").replace("<", "&lt;").replace(">", "&gt;")
-    s = re.sub(r"__(.+?)__", r"<u>\1</u>", s, flags=re.DOTALL)
-    s = re.sub(r"\*(.+?)\*", r"<b>\1</b>", s, flags=re.DOTALL)
-    s = re.sub(r"_(.+?)_", r"<i>\1</i>", s, flags=re.DOTALL)
-    s = re.sub(r"~(.+?)~", r"<s>\1</s>", s, flags=re.DOTALL)
-    return s
+    parts = _MARKUP_SPLIT.split(s)  # текст, маркер, текст, маркер, ...
+    # Пары по порядку для каждого маркера; пустая пара (**) и последний непарный — просто символы
+    closers = {}
+    pending = {}
+    for i in range(1, len(parts), 2):
+        m = parts[i]
+        j = pending.pop(m, None)
+        if j is None:
+            pending[m] = i
+        elif i == j + 2 and not parts[j + 1]:
+            pending[m] = i
+        else:
+            closers[j] = i
+    closing = set(closers.values())
+    out = []
+    stack = []
+
+    def close(tag):
+        if out and out[-1] == f"<{tag}>":
+            out.pop()  # тег без содержимого
+        else:
+            out.append(f"</{tag}>")
+
+    for i, part in enumerate(parts):
+        if i % 2 == 0 or (i not in closers and i not in closing):
+            if part:
+                out.append(part)
+            continue
+        tag = _MARKUP_TAGS[part]
+        if i in closers:
+            out.append(f"<{tag}>")
+            stack.append(tag)
+            continue
+        reopen = []
+        while stack[-1] != tag:
+            inner = stack.pop()
+            close(inner)
+            reopen.append(inner)
+        stack.pop()
+        close(tag)
+        for inner in reversed(reopen):
+            out.append(f"<{inner}>")
+            stack.append(inner)
+    return "".join(out)
+
+
+_TELEGRAM_TAGS = {
+    "b", "strong", "i", "em", "u", "ins", "s", "strike", "del", "span", "tg-spoiler",
+    "a", "code", "pre", "blockquote", "tg-emoji",
+}
+_TELEGRAM_ENTITIES = {"lt", "gt", "amp", "quot"}
+_HTML_TOKEN = re.compile(
+    r"<(/?)([A-Za-z][\w-]*)([^<>]*)>|&(#[0-9]+|#x[0-9A-Fa-f]+|[A-Za-z]+);|[<>&]"
+)
+
+
+def telegram_html_error(html: str) -> str | None:
+    """Почему Telegram не примет html с parse_mode="HTML"; None — примет.
+
+    Правила Bot API: только поддерживаемые теги, теги правильно вложены и закрыты,
+    символы <, > и & вне тегов и сущностей экранированы, из именованных сущностей —
+    только &lt; &gt; &amp; &quot;.
+    """
+    stack = []
+    for m in _HTML_TOKEN.finditer(html or ""):
+        slash, name, attrs, entity = m.group(1), m.group(2), m.group(3), m.group(4)
+        if name is not None:
+            name = name.lower()
+            if name not in _TELEGRAM_TAGS:
+                return f"неподдерживаемый тег <{name}> (позиция {m.start()})"
+            if not slash:
+                if name == "span" and "tg-spoiler" not in attrs:
+                    return f"<span> без class=\"tg-spoiler\" (позиция {m.start()})"
+                stack.append(name)
+            elif not stack or stack[-1] != name:
+                return f"</{name}> не закрывает открытый тег (позиция {m.start()})"
+            else:
+                stack.pop()
+        elif entity is not None:
+            if not entity.startswith("#") and entity not in _TELEGRAM_ENTITIES:
+                return f"неизвестная сущность &{entity}; (позиция {m.start()})"
+        else:
+            return f"неэкранированный символ {m.group(0)!r} (позиция {m.start()})"
+    if stack:
+        return f"не закрыт тег <{stack[-1]}>"
+    return None
+
+
+_HTML_PIECE = re.compile(r"<(/?)([A-Za-z][\w-]*)[^<>]*>|&#?\w+;|[^<&]+|[<&]")
+_SENTENCE_END = re.compile(r"[.!?…]+[)»\"]*\s")
+
+
+def _utf16_len(s: str) -> int:
+    # Лимиты Telegram считаются в UTF-16: эмодзи вне BMP — два символа
+    return len(s.encode("utf-16-le")) // 2
+
+
+def _break_at(text: str, start: int, end: int) -> int:
+    """Где закончить кусок text[start:end]: абзац, строка, предложение, пробел — что найдётся
+    во второй и третьей трети куска; иначе жёсткий разрез по лимиту."""
+    floor = start + (end - start) // 3
+    for sep in ("\n\n", "\n"):
+        k = text.rfind(sep, floor, end)
+        if k != -1:
+            return k + len(sep)
+    k = None
+    for m in _SENTENCE_END.finditer(text, floor, end):
+        k = m.end()
+    if k is not None:
+        return k
+    k = text.rfind(" ", floor, end)
+    return k + 1 if k != -1 else end
+
+
+def _render_chars(chars: list, start: int, stop: int) -> str:
+    """HTML символов chars[start:stop]: открытые на первом символе теги открываются заново,
+    открытые на последнем — закрываются."""
+    out = []
+    cur = ()
+    for piece, stack in chars[start:stop]:
+        if stack != cur:
+            common = 0
+            while common < min(len(cur), len(stack)) and cur[common] == stack[common]:
+                common += 1
+            out.extend(f"</{name}>" for name, _ in reversed(cur[common:]))
+            out.extend(tag for _, tag in stack[common:])
+            cur = stack
+        out.append(piece)
+    out.extend(f"</{name}>" for name, _ in reversed(cur))
+    return "".join(out)
+
+
+def split_telegram_html(html: str, limit: int = 4096, first_limit: int | None = None) -> list[str]:
+    """Разбить HTML для parse_mode="HTML" на части не длиннее limit видимых символов.
+
+    first_limit — лимит первой части (1024 для подписи к фото). Режем по абзацу, строке,
+    концу предложения или пробелу; теги, открытые на месте разреза, закрываются в конце
+    части и открываются в начале следующей. Короткий текст возвращается как есть.
+    """
+    cap = first_limit or limit
+    if not html or _utf16_len(html) <= cap:
+        return [html] if html else []
+    chars = []  # (HTML одного видимого символа, открытые теги)
+    stack = []
+    for m in _HTML_PIECE.finditer(html):
+        piece = m.group(0)
+        if m.group(2) is not None:
+            name = m.group(2).lower()
+            if not m.group(1):
+                stack.append((name, piece))
+            elif any(n == name for n, _ in stack):
+                while stack.pop()[0] != name:
+                    pass
+            continue
+        tags = tuple(stack)
+        if piece[0] == "&" and len(piece) > 1:
+            chars.append((piece, tags))
+        else:
+            chars.extend((ch, tags) for ch in piece)
+    text = "".join(unescape(piece) if piece[0] == "&" else piece for piece, _ in chars)
+    units = list(accumulate(_utf16_len(unescape(piece)) for piece, _ in chars))
+    parts = []
+    start, n = 0, len(chars)
+    while start < n:
+        base = units[start - 1] if start else 0
+        end = bisect_right(units, base + cap, start)
+        end = n if end >= n else _break_at(text, start, max(end, start + 1))
+        stop = end
+        while stop > start and text[stop - 1].isspace():
+            stop -= 1
+        if stop > start:
+            parts.append(_render_chars(chars, start, stop))
+            # first_limit — для первой непустой части: пробелы в начале текста его не расходуют
+            cap = limit
+        start = end
+        while start < n and text[start].isspace():
+            start += 1
+    return parts
+
+
+def telegram_html_to_text(html: str) -> str:
+    """Тот же текст без разметки — для отправки без parse_mode."""
+    return unescape(re.sub(r"<[^<>]*>", "", html or ""))
 
 
 # для обратной совместимости в рассылке
@@ -35,6 +228,54 @@ def normalize_telegram_button_url(url: str) -> str:
     return u
 
 
+def parse_game_date(text: str) -> str | None:
+    """«22.02.2026» / «22.02.26» / «22/02/2026» → «22.02.2026»; None, если это не дата."""
+    m = re.fullmatch(r"(\d{1,2})[./-](\d{1,2})[./-](\d{2}|\d{4})", (text or "").strip())
+    if not m:
+        return None
+    day, month, year = (int(x) for x in m.groups())
+    if year < 100:
+        year += 2000
+    try:
+        return datetime(year, month, day).strftime("%d.%m.%Y")
+    except ValueError:
+        return None
+
+
+def parse_game_time(text: str) -> str | None:
+    """«19:00» / «19.00» / «9:30» → «19:00»; пустая строка — без времени; None, если не время."""
+    t = (text or "").strip()
+    if not t:
+        return ""
+    m = re.fullmatch(r"(\d{1,2})[:.](\d{2})", t)
+    if not m or int(m.group(1)) > 23 or int(m.group(2)) > 59:
+        return None
+    return f"{int(m.group(1)):02d}:{m.group(2)}"
+
+
+def game_starts_at(game_date: str, game_time: str | None) -> str | None:
+    """Сортируемое начало игры для games.starts_at: «2026-02-22 19:00» (без времени — 00:00)."""
+    date = parse_game_date(game_date)
+    time = parse_game_time(game_time or "")
+    if date is None or time is None:
+        return None
+    d, m, y = date.split(".")
+    return f"{y}-{m}-{d} {time or '00:00'}"
+
+
+def game_cursor(starts_at: str, game_id: int) -> str:
+    """Ключ игры для callback_data листания: «2026-02-22 19:00|12»."""
+    return f"{starts_at}|{game_id}"
+
+
+def parse_game_cursor(value: str):
+    """Ключ из callback_data обратно в (starts_at, id); пустой или битый — None (первая страница)."""
+    starts_at, _, gid = (value or "").rpartition("|")
+    if not starts_at or not gid.isdigit():
+        return None
+    return starts_at, int(gid)
+
+
 def escape_md(text: str) -> str:
     if not text:
         return ""